@@ -2,10 +2,10 @@
 # This script updates the links in distro.json to point to the latest distro release.
 # Currently only needed for fedora
 
-from urllib.request import urlretrieve
 import json
 
 from functions import *
+import downloader
 
 if __name__ == '__main__':
     print("\033[96m" + "Starting update script" + "\033[0m")
@@ -15,8 +15,8 @@ if __name__ == '__main__':
     print("\033[96m" + "Getting version numbers" + "\033[0m")
     for version in distros_dict["fedora"]:
         print(f"https://kojipkgs.fedoraproject.org/packages/Fedora-Cloud-Base/{version}/")
-        urlretrieve(f"https://kojipkgs.fedoraproject.org/packages/Fedora-Cloud-Base/{version}/",
-                    f"fedora_link.html")
+        downloader.download(f"https://kojipkgs.fedoraproject.org/packages/Fedora-Cloud-Base/{version}/",
+                            "fedora_link.html")
         with open(f"fedora_link.html", 'r') as file:
             html = file.readlines()
         if version == "Rawhide":
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# Extraction and creation of the build's archives: rootfs and kernel tarballs, rootfs snapshots and the Fedora raw disk
+# image. Archives are (de)compressed by separate multithreaded tools if they are installed, otherwise python is used.
+# src of the extraction functions can be a file path or an iterable of bytes chunks, e.g. a download that is still in
+# progress, see cache.stream()
+
+import os
+import lzma
+import zlib
+import shutil
+import struct
+import tarfile
+import subprocess
+from threading import Thread, Event
+from queue import Queue, Full
+from typing import Optional
+
+from functions import *
+import progress
+
+
+# get a command that decompresses stdin to stdout, using all cores if possible. Returns None if no tool is installed
+def get_decompressor(compression: str) -> Optional[list]:
+    if compression == "xz":
+        # xz 5.4+ decompresses multi-block files(e.g. made with xz -T0) in parallel
+        if shutil.which("xz") and __xz_version() >= (5, 4):
+            return ["xz", "-dc", "-T0"]
+        if shutil.which("pixz"):
+            return ["pixz", "-d"]
+        if shutil.which("xz"):
+            return ["xz", "-dc"]
+    elif compression == "gz":
+        if shutil.which("pigz"):  # pigz reads, decompresses and writes on separate threads
+            return ["pigz", "-dc"]
+        if shutil.which("gzip"):
+            return ["gzip", "-dc"]
+    elif compression == "zst":
+        if shutil.which("zstd"):
+            return ["zstd", "-dc"]
+    return None
+
+
+# get a command that compresses stdin to stdout on all cores, with a fast compression level.
+# Returns (command, compression), zstd is preferred. Returns None if no tool is installed
+def get_compressor() -> Optional[tuple]:
+    if shutil.which("zstd"):
+        return ["zstd", "-c", "-T0", "-3"], "zst"
+    if shutil.which("pigz"):
+        return ["pigz", "-c", "-3"], "gz"
+    if shutil.which("gzip"):
+        return ["gzip", "-c", "-3"], "gz"
+    return None
+
+
+# create a compressed tar archive of all files in src_dir. Everything is kept: owners(as numbers), permissions, xattrs
+# and ACLs. Other filesystems mounted inside src_dir are skipped. Returns the compression used, see get_compressor()
+# If no compressor is installed, the archive is not compressed and None is returned
+def create_tar(src_dir: str, dst_file: str, exclude: list = None) -> Optional[str]:
+    compressor, compression = get_compressor() or (None, None)
+    tar_cmd = ["tar", "cpf", "-", "-C", src_dir, "--one-file-system", "--numeric-owner", "--xattrs",
+               "--xattrs-include=*", "--acls"]
+    tar_cmd.extend(f"--exclude={pattern}" for pattern in exclude or [])
+    tar_cmd.append(".")
+    processes = []
+    with open(dst_file, "wb") as file:
+        if compressor is None:
+            processes.append(subprocess.Popen(tar_cmd, stdout=file))
+        else:  # tar -> compressor
+            processes.append(subprocess.Popen(tar_cmd, stdout=subprocess.PIPE))
+            processes.append(subprocess.Popen(compressor, stdin=processes[0].stdout, stdout=file))
+            processes[0].stdout.close()  # only the compressor reads from the pipe now
+    # bytes read by tar / used space of the filesystem. The used space includes excluded files and other filesystems,
+    # so the total is only an estimate
+    fs_stat = os.statvfs(src_dir)
+    used_space = (fs_stat.f_blocks - fs_stat.f_bfree) * fs_stat.f_frsize
+    progress.start_progress(force_show=True, get_progress=lambda: __get_read_bytes(processes[0].pid, used_space),
+                   label="Archived")
+    try:
+        for process in processes:
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+    finally:
+        progress.stop_progress(force_show=True)
+    return compression
+
+
+# extract a tar archive into dst_dir. src is either a file path or an iterable of bytes chunks, e.g. a download that
+# is still in progress. compression("xz", "gz", "zst" or None) is detected from the file name if src is a path
+# strip_components and members are passed to tar as --strip-components and the list of members to extract
+# preserve_all keeps xattrs, ACLs and the numeric owners of an archive made with create_tar()
+# The archive is decompressed by a separate multithreaded process, if neither tar nor a decompressor is installed,
+# python is used
+def extract_tar(src, dst_dir: str, compression: str = None, skip_old_files: bool = False, strip_components: int = 0,
+                members: list = None, use_python: bool = False, preserve_all: bool = False) -> None:
+    if compression is None and isinstance(src, str):
+        if src.endswith(".xz"):
+            compression = "xz"
+        elif src.endswith(".gz"):
+            compression = "gz"
+        elif src.endswith(".zst"):
+            compression = "zst"
+
+    decompressor = get_decompressor(compression) if compression else []
+    if use_python or decompressor is None or not shutil.which("tar"):
+        __extract_tar_python(src, dst_dir, compression, skip_old_files, strip_components, members)
+        return
+
+    tar_cmd = ["tar", "xpf", "-", "-C", dst_dir]
+    if skip_old_files:
+        tar_cmd.append("--skip-old-files")
+    if strip_components:
+        tar_cmd.append(f"--strip-components={strip_components}")
+    if preserve_all:
+        tar_cmd.extend(["--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls"])
+    if members:
+        tar_cmd.extend(members)
+
+    if isinstance(src, str):
+        src_file = open(src, "rb")
+        chunks = None
+    else:
+        src_file = subprocess.PIPE
+        chunks = iter(src)
+        first_chunk = next(chunks, b"")  # fail before starting tar if the download can't be started at all
+
+    # decompressor -> tar
+    processes = []
+    if decompressor:
+        processes.append(subprocess.Popen(decompressor, stdin=src_file, stdout=subprocess.PIPE))
+        processes.append(subprocess.Popen(tar_cmd, stdin=processes[0].stdout))
+        processes[0].stdout.close()  # only tar reads from the pipe now
+    else:
+        processes.append(subprocess.Popen(tar_cmd, stdin=src_file))
+    if isinstance(src, str):
+        src_file.close()
+        # the position of the first process in the archive is the progress of the extraction
+        src_size = os.path.getsize(src)
+        progress.start_progress(force_show=True, get_progress=lambda: __get_file_position(processes[0].pid, src_size),
+                       label=f"Extracting {os.path.basename(src)}")
+
+    try:
+        if chunks is not None:
+            written = len(first_chunk)
+            progress.start_progress(force_show=True, get_progress=lambda: (written, None), label="Extracting")
+            try:
+                processes[0].stdin.write(first_chunk)
+                for chunk in chunks:
+                    processes[0].stdin.write(chunk)
+                    written += len(chunk)
+                processes[0].stdin.close()
+            except BrokenPipeError:  # tar exited early, the return codes below have the reason
+                pass
+            except BaseException:  # download failed -> don't leave tar waiting for more input
+                for process in processes:
+                    process.kill()
+                    process.wait()
+                raise
+        for process in reversed(processes):  # tar's error is more useful than the decompressor's broken pipe
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+    finally:
+        progress.stop_progress(force_show=True)
+
+
+# Do not call this function directly
+# Get the position of a process in its stdin file, from /proc/<pid>/fdinfo/0
+def __get_file_position(pid: int, total: int) -> Optional[tuple]:
+    try:
+        with open(f"/proc/{pid}/fdinfo/0", "r") as file:
+            return int(file.readline().split()[1]), total  # first line: "pos:    1234"
+    except (OSError, IndexError, ValueError):  # process already exited
+        return None
+
+
+# Do not call this function directly
+# Get the bytes read by a process, from /proc/<pid>/io
+def __get_read_bytes(pid: int, total: int) -> Optional[tuple]:
+    try:
+        with open(f"/proc/{pid}/io", "r") as file:
+            return int(file.readline().split()[1]), total  # first line: "rchar: 1234"
+    except (OSError, IndexError, ValueError):  # process already exited
+        return None
+
+
+# read a file in chunks
+def read_chunks(path: str, chunk_size: int = 1048576):
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+# decompress an iterable of xz or gz compressed chunks. Output chunks are at most chunk_size big, even for very well
+# compressed input like the empty space in a disk image.
+# Decompression runs in a separate multithreaded process, or a python thread if no decompressor is installed
+def decompress_chunks(chunks, compression: str, chunk_size: int = 1048576, use_python: bool = False):
+    decompressor = get_decompressor(compression)
+    if use_python or decompressor is None:
+        yield from __pipeline(__decompress_chunks_python(chunks, compression, chunk_size))
+        return
+
+    process = subprocess.Popen(decompressor, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    feed_errors = []
+
+    def feed() -> None:
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except BaseException as err:
+            feed_errors.append(err)
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while data := process.stdout.read(chunk_size):
+            yield data
+    except BaseException:  # reader stopped early
+        process.kill()
+        process.wait()
+        feeder.join()
+        raise
+    process.wait()
+    feeder.join()
+    if feed_errors:
+        raise feed_errors[0]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, decompressor)
+
+
+# Do not call this function directly, use decompress_chunks() instead
+def __decompress_chunks_python(chunks, compression: str, chunk_size: int):
+    if compression == "xz":
+        decompressor = lzma.LZMADecompressor()
+        for chunk in chunks:
+            while not decompressor.eof:
+                output = decompressor.decompress(chunk, chunk_size)
+                chunk = b""
+                if output:
+                    yield output
+                if decompressor.needs_input:
+                    break
+    elif compression == "gz":
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        for chunk in chunks:
+            while chunk and not decompressor.eof:
+                output = decompressor.decompress(chunk, chunk_size)
+                chunk = decompressor.unconsumed_tail
+                if output:
+                    yield output
+    elif compression == "zst":
+        raise ValueError("zstd is not installed")  # python has no zstd module
+    else:
+        yield from chunks
+
+
+# Run a generator on a separate thread and yield its output, so that producing(e.g. decompressing) and consuming the
+# chunks happens at the same time. lzma and zlib release the GIL, so this uses two cores
+def __pipeline(chunks, queue_size: int = 16):
+    queue = Queue(maxsize=queue_size)
+    stop = Event()
+
+    def put(item) -> bool:  # returns False if the consumer has stopped
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(None)
+        except BaseException as err:
+            put(err)
+
+    Thread(target=produce, daemon=True).start()
+    try:
+        while (chunk := queue.get()) is not None:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+
+
+# Do not call this function directly, use extract_tar() instead
+def __extract_tar_python(src, dst_dir: str, compression: str, skip_old_files: bool, strip_components: int,
+                         members: list) -> None:
+    chunks = read_chunks(src) if isinstance(src, str) else src
+    read_fd, write_fd = os.pipe()
+
+    decompress_errors = []
+
+    # decompress on a separate thread and write the tar stream into a pipe, which is read by tarfile below
+    def decompress() -> None:
+        with open(write_fd, "wb") as pipe:
+            try:
+                for chunk in __decompress_chunks_python(chunks, compression, 1048576):
+                    pipe.write(chunk)
+            except BrokenPipeError:
+                pass
+            except BaseException as err:
+                decompress_errors.append(err)
+
+    def filter_members(tar):
+        for count, member in enumerate(tar, start=1):
+            if count % 10000 == 0:
+                print(".", end="", flush=True)
+            if members and not any(member.name == name or member.name.startswith(f"{name}/") for name in members):
+                continue
+            if strip_components:
+                name_parts = member.name.split("/")[strip_components:]
+                if not name_parts or name_parts == [""]:
+                    continue
+                member.name = "/".join(name_parts)
+                if member.islnk():  # hardlink targets are paths in the archive
+                    member.linkname = "/".join(member.linkname.split("/")[strip_components:])
+            if skip_old_files and os.path.lexists(os.path.join(dst_dir, member.name)):
+                continue
+            yield member
+
+    decompress_thread = Thread(target=decompress, daemon=True)
+    decompress_thread.start()
+    try:
+        with open(read_fd, "rb") as pipe, tarfile.open(fileobj=pipe, mode="r|") as tar:
+            if hasattr(tarfile, "fully_trusted_filter"):  # rootfs tarballs have absolute symlinks, device nodes etc.
+                tar.extractall(dst_dir, members=filter_members(tar), filter="fully_trusted")
+            else:
+                tar.extractall(dst_dir, members=filter_members(tar))
+    finally:
+        decompress_thread.join()
+        if decompress_errors:  # the download/decompression error is the root cause of any tarfile error
+            raise decompress_errors[0]
+
+
+def __xz_version() -> tuple:
+    try:
+        version = subprocess.check_output(["xz", "--robot", "--version"], text=True).splitlines()[0]
+        version_number = int(version.split("=")[1])  # XZ_VERSION=50040002 -> 5.4.0
+        return version_number // 10000000, version_number // 10000 % 1000
+    except (subprocess.CalledProcessError, IndexError, ValueError):
+        return 0, 0
+
+
+# write partition number part_number of a decompressed GPT disk image stream to dst_file. Only the partition is
+# written, and empty blocks are skipped, so dst_file is a sparse file with the size of the data in the partition
+def extract_partition(chunks, part_number: int, dst_file: str, sector_size: int = 512) -> None:
+    chunks = iter(chunks)
+    buffer = bytearray()
+
+    def read_until(size: int) -> None:
+        while len(buffer) < size:
+            try:
+                buffer.extend(next(chunks))
+            except StopIteration:
+                raise ValueError("Disk image ended before the partition table")
+
+    # GPT header is in the 2nd sector, the partition entries are usually right after it
+    read_until(2 * sector_size)
+    if buffer[sector_size:sector_size + 8] != b"EFI PART":
+        raise ValueError("Disk image has no GPT partition table")
+    entries_lba, entries_count, entry_size = struct.unpack_from("<QII", buffer, sector_size + 72)
+    if part_number > entries_count:
+        raise ValueError(f"Disk image has no partition {part_number}")
+    entry_offset = entries_lba * sector_size + (part_number - 1) * entry_size
+    read_until(entry_offset + entry_size)
+    first_lba, last_lba = struct.unpack_from("<QQ", buffer, entry_offset + 32)
+    if first_lba == 0:
+        raise ValueError(f"Disk image has no partition {part_number}")
+    part_start = first_lba * sector_size
+    part_end = (last_lba + 1) * sector_size
+
+    position = 0  # position of buffer[0] in the disk image
+    empty_block = bytes(65536)
+    with open(dst_file, "wb") as file:
+        while position < part_end:
+            if position + len(buffer) > part_start:
+                data = memoryview(buffer)[max(part_start - position, 0):part_end - position]
+                file.seek(max(position - part_start, 0))
+                for block_start in range(0, len(data), 65536):
+                    block = data[block_start:block_start + 65536]
+                    if block == empty_block[:len(block)]:
+                        file.seek(len(block), 1)  # leave a hole
+                    else:
+                        file.write(block)
+                data.release()
+            position += len(buffer)
+            buffer = next(chunks, None)
+            if buffer is None:
+                break
+        file.truncate(part_end - part_start)
+    if position < part_end:
+        raise ValueError("Disk image ended before the end of the partition")
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# Build several images/USB-drives from one manifest, e.g. for a classroom or a fleet of chromebooks.
+# Every build runs as its own main.py process in a private mount namespace, with its own /tmp/eupnea-build(bind mounted
+# from its workspace), loop device and image. Whatever a build mounts on /mnt/eupnea is only visible inside its
+# namespace, so builds can't see each other's rootfs.
+# The download cache, the package caches and the rootfs snapshots are shared. The first build of every distro + DE
+# saves a snapshot, the other builds with the same distro + DE wait for it and only configure their user on top.
+#
+# Manifest(.json or .toml, toml needs python 3.11+):
+#   jobs: number of builds to run at the same time(default: 1, --jobs overrides it)
+#   workspace: directory for the build workspaces(default: eupnea-batch). Every build gets <workspace>/<name> with its
+#              image, build log and /tmp/eupnea-build
+#   defaults: build options for all builds
+#   builds: list of build options, missing options are taken from defaults
+# Build options: name(default: hostname), distro_name, distro_version, de_name, username, password, hostname,
+# device("image" or a USB-drive/SD-card, e.g. "sdb"), rebind_search
+
+import os
+import sys
+import json
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+
+from functions import *
+import build
+
+try:
+    import tomllib
+except ImportError:  # python 3.10
+    tomllib = None
+
+default_options = {
+    "distro_name": "ubuntu",
+    "distro_version": "",
+    "de_name": "gnome",
+    "username": "localuser",
+    "password": "",
+    "hostname": "eupnea-chromebook",
+    "device": "image",
+    "rebind_search": False
+}
+# main.py arguments that are not passed on to the builds
+batch_args = ["--batch", "--jobs"]
+
+
+# Run all builds of a manifest. builder_args are the main.py arguments for every build, use_snapshots is False if
+# the builds can't share a snapshot(snapshots or cache disabled, local files)
+def run(manifest_path: str, jobs: int | None, user_id: str, builder_args: list, use_snapshots: bool) -> None:
+    manifest = load_manifest(manifest_path)
+    builds = get_builds(manifest)
+    jobs = jobs or manifest.get("jobs", 1)
+    workspace = get_full_path(manifest.get("workspace", "eupnea-batch"))
+    if not shutil.which("unshare"):
+        print_error("unshare not found, please install util-linux")
+        exit(1)
+    print_status(f"Building {len(builds)} images/devices, {jobs} at a time. Workspace: {workspace}")
+
+    # install the build tools once, instead of every build at the same time
+    for distro_name in dict.fromkeys(build_options["distro_name"] for build_options in builds):
+        build.install_host_packages(distro_name, user_id)
+    for build_options in builds:
+        build_options["workspace"] = f"{workspace}/{build_options['name']}"
+        mkdir(f"{build_options['workspace']}/tmp", create_parents=True)
+
+    builder_args = __remove_batch_args(builder_args)
+    results = __schedule(builds, jobs, use_snapshots, lambda build_options: run_build(build_options, builder_args))
+
+    print_header("Batch build summary:")
+    for build_options in builds:
+        status, duration = results[build_options["name"]]
+        output = f"{build_options['workspace']}/eupnea.img" if build_options["device"] == "image" else \
+            f"/dev/{build_options['device']}"
+        print(f"{build_options['name']:<24} {status:<8} {duration / 60:>6.1f}min  {output}")
+    failed = [name for name, (status, _) in results.items() if status != "done"]
+    if failed:
+        print_error(f"{len(failed)} builds failed, see build.log in their workspace: {', '.join(failed)}")
+        exit(1)
+
+
+def load_manifest(manifest_path: str) -> dict:
+    try:
+        if manifest_path.endswith(".toml"):
+            if tomllib is None:
+                print_error("TOML manifests need python 3.11 or higher, use a json manifest instead")
+                exit(1)
+            with open(manifest_path, "rb") as file:
+                return tomllib.load(file)
+        with open(manifest_path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        print_error(f"Manifest not found: {manifest_path}")
+        exit(1)
+    except ValueError as err:  # json and toml decode errors are ValueErrors
+        print_error(f"Invalid manifest {manifest_path}: {err}")
+        exit(1)
+
+
+# Complete and check the build options of all builds, with the same rules as the interactive setup in cli_input.py
+def get_builds(manifest: dict) -> list:
+    with open("distros.json", "r") as file:
+        distros = json.load(file)
+    with open("packages.json", "r") as file:
+        packages = json.load(file)
+
+    builds = []
+    for index, build_entry in enumerate(manifest.get("builds", [])):
+        build_options = default_options | manifest.get("defaults", {}) | build_entry
+        build_options.setdefault("name", build_options["hostname"])
+        name = build_options["name"]
+        unknown_options = set(build_options) - set(default_options) - {"name"}
+        if unknown_options:
+            __invalid_build(name, f"unknown options: {', '.join(sorted(unknown_options))}")
+
+        match build_options["distro_name"]:
+            case "ubuntu":
+                build_options["distro_version"] = build_options["distro_version"] or max(distros["ubuntu"])
+                if build_options["distro_version"] not in distros["ubuntu"]:
+                    __invalid_build(name, f"Ubuntu {build_options['distro_version']} is not available")
+                build_options["distro_link"] = ""
+            case "debian":
+                build_options["distro_link"] = ""
+            case "arch":
+                build_options["distro_link"] = distros["arch"]
+            case "fedora":
+                build_options["distro_version"] = build_options["distro_version"] or \
+                    max(version for version in distros["fedora"] if version != "Rawhide")
+                if build_options["distro_version"] not in distros["fedora"]:
+                    __invalid_build(name, f"Fedora {build_options['distro_version']} is not available")
+                build_options["distro_link"] = distros["fedora"][build_options["distro_version"]]
+            case _:
+                __invalid_build(name, f"unknown distro: {build_options['distro_name']}")
+        if build_options["de_name"] not in packages[build_options["distro_name"]]["de"]:
+            __invalid_build(name, f"{build_options['de_name']} is not available for {build_options['distro_name']}")
+
+        # gnome creates the user in its first time setup
+        if build_options["de_name"] != "gnome" and not build_options["password"]:
+            __invalid_build(name, "password is required")
+        if "(" in build_options["password"] or ")" in build_options["password"]:
+            __invalid_build(name, "password cannot contain ( or )")
+        if not build_options["hostname"] or build_options["hostname"].startswith("-") or \
+                __has_invalid_chars(build_options["hostname"], "-"):
+            __invalid_build(name, f"invalid hostname: {build_options['hostname']}")
+        if __has_invalid_chars(build_options["username"], "._-"):
+            __invalid_build(name, f"invalid username: {build_options['username']}")
+        if not name or __has_invalid_chars(name, "._-"):
+            __invalid_build(f"#{index + 1}", f"invalid name: {name}")
+        builds.append(build_options)
+
+    if not builds:
+        print_error("The manifest has no builds")
+        exit(1)
+    names = [build_options["name"] for build_options in builds]
+    devices = [build_options["device"] for build_options in builds if build_options["device"] != "image"]
+    for duplicates, kind in [(names, "name"), (devices, "device")]:
+        for value in dict.fromkeys(duplicates):
+            if duplicates.count(value) > 1:
+                print_error(f"More than one build uses the {kind} {value}")
+                exit(1)
+    return builds
+
+
+# Run a single build in its own mount namespace. Returns (status, duration in seconds)
+def run_build(build_options: dict, builder_args: list) -> tuple:
+    workspace = build_options["workspace"]
+    print_status(f"Starting build {build_options['name']}")
+    start_time = time()
+
+    # the options file contains the password -> only readable by root
+    with open(os.open(f"{workspace}/options.json", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+        json.dump({key: value for key, value in build_options.items() if key in default_options}, file)
+    main_command = [sys.executable, get_full_path("main.py"), *builder_args, "--options", f"{workspace}/options.json",
+                    "--image", f"{workspace}/eupnea.img"]
+    # the bind mount only exists inside the new namespace and disappears with it
+    script = f"mount --bind {shlex.quote(workspace + '/tmp')} /tmp/eupnea-build && exec {shlex.join(main_command)}"
+    try:
+        with open(f"{workspace}/build.log", "w") as log:
+            process = subprocess.run(["unshare", "--mount", "--propagation", "private", "sh", "-c", script],
+                                     stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    finally:
+        rmfile(f"{workspace}/options.json")  # don't leave the password in the workspace
+
+    duration = time() - start_time
+    if process.returncode != 0:
+        print_error(f"Build {build_options['name']} failed after {duration / 60:.1f}min, see {workspace}/build.log")
+        return "failed", duration
+    print_status(f"Build {build_options['name']} finished in {duration / 60:.1f}min")
+    return "done", duration
+
+
+# Do not call this function directly
+# Run the builds, at most jobs at a time. The first build of every distro + DE runs before the others with the same
+# distro + DE, as it saves the snapshot they restore. Returns build name -> result of run_function
+def __schedule(builds: list, jobs: int, use_snapshots: bool, run_function) -> dict:
+    ready = []
+    waiting = {}  # snapshot group -> builds that wait for the first build of the group
+    for build_options in builds:
+        group = __get_group(build_options) if use_snapshots else build_options["name"]
+        if group in waiting:
+            waiting[group].append(build_options)
+        else:
+            waiting[group] = []
+            ready.append(build_options)
+
+    results = {}
+    running = {}  # future -> build options
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while ready or running:
+            while ready and len(running) < jobs:
+                build_options = ready.pop(0)
+                running[pool.submit(run_function, build_options)] = build_options
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                build_options = running.pop(future)
+                results[build_options["name"]] = future.result()
+                # the others start even if the first build failed, they just don't get a snapshot
+                group = __get_group(build_options) if use_snapshots else build_options["name"]
+                ready.extend(waiting.pop(group, []))
+    return results
+
+
+# Do not call this function directly
+def __get_group(build_options: dict) -> tuple:
+    return build_options["distro_name"], build_options["distro_version"], build_options["de_name"]
+
+
+# Do not call this function directly
+def __remove_batch_args(args: list) -> list:
+    builder_args = []
+    skip_value = False
+    for arg in args:
+        if skip_value:
+            skip_value = False
+        elif arg in batch_args:
+            skip_value = True
+        elif not arg.startswith(tuple(f"{batch_arg}=" for batch_arg in batch_args)):
+            builder_args.append(arg)
+    return builder_args
+
+
+# Do not call this function directly
+def __has_invalid_chars(value: str, extra_chars: str) -> bool:
+    return any(char not in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789" + extra_chars
+               for char in value)
+
+
+# Do not call this function directly
+def __invalid_build(name: str, reason: str) -> None:
+    print_error(f"Invalid build {name} in manifest: {reason}")
+    exit(1)
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
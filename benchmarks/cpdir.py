@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Benchmark cpdir() in file_ops.py against cp -rp on a synthetic tree with many small files, like a rootfs.
+# Run from the repo root: ./benchmarks/cpdir.py [--size MB] [--dst DIR]. Needs no root or network access.
+# Use --dst to copy to another filesystem, e.g. a mounted image, as the build does.
+
+import os
+import sys
+import argparse
+import shutil
+import subprocess
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import *
+import file_ops
+
+
+# create a tree with a rootfs-like size distribution: mostly small files, a few big ones, symlinks and hardlinks
+def create_tree(path: str, total_size: int) -> int:
+    sizes = [512, 4096, 16384, 65536, 1048576]
+    created_size = 0
+    index = 0
+    while created_size < total_size:
+        dir_path = f"{path}/dir{index // 200}/sub{index // 20 % 10}"
+        mkdir(dir_path, create_parents=True)
+        size = sizes[index % len(sizes)] if index % 50 else 8 * 1048576
+        with open(f"{dir_path}/file{index}", "wb") as file:
+            file.write(os.urandom(size))
+        if index % 10 == 0:
+            os.symlink(f"file{index}", f"{dir_path}/link{index}")
+        if index % 25 == 0:
+            os.link(f"{dir_path}/file{index}", f"{dir_path}/hardlink{index}")
+        created_size += size
+        index += 1
+    return index
+
+
+def time_copy(src_dir: str, dst_dir: str, copy) -> float:
+    shutil.rmtree(dst_dir, ignore_errors=True)
+    mkdir(dst_dir)
+    subprocess.run(["sync"], check=True)  # don't measure writeback of the previous run
+    start = perf_counter()
+    copy(src_dir, dst_dir)
+    subprocess.run(["sync"], check=True)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512, help="Size of the test tree in MB")
+    parser.add_argument("--dst", default=None, help="Directory to copy into, defaults to a temporary directory")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        print_status(f"Creating {args.size}mb test tree")
+        files_count = create_tree(f"{work_dir}/tree", args.size * 1048576)
+        dst_dir = f"{args.dst or work_dir}/eupnea-cpdir-benchmark"
+
+        results = {
+            "cp -rp": time_copy(f"{work_dir}/tree", dst_dir, lambda src, dst: subprocess.run(
+                f"cp -rp {src}/* {dst}", shell=True, check=True)),
+            "cpdir": time_copy(f"{work_dir}/tree", dst_dir, file_ops.cpdir)
+        }
+        shutil.rmtree(dst_dir, ignore_errors=True)
+
+        print_header(f"{'method':<10}{'time':>10}{'files/s':>12}   "
+                     f"({files_count} files, {file_ops.io_threads} threads)")
+        for name, result in results.items():
+            print(f"{name:<10}{result:>9.2f}s{files_count / result:>12.0f}")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Benchmark the archive extraction in archive.py against plain single threaded tar on synthetic archives.
+# Run from the repo root: ./benchmarks/decompress.py [--size MB]. Needs no root or network access.
+
+import os
+import sys
+import argparse
+import shutil
+import subprocess
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import *
+import archive
+
+
+# create a tree of files that compresses roughly like a rootfs(~3:1)
+def create_tree(path: str, total_size: int) -> None:
+    file_size = 256 * 1024
+    for index in range(total_size // file_size):
+        dir_path = f"{path}/dir{index // 100}"
+        mkdir(dir_path, create_parents=True)
+        with open(f"{dir_path}/file{index}", "wb") as file:
+            for _ in range(file_size // 4096):
+                file.write(os.urandom(1024) + bytes(3072))
+
+
+def create_archives(work_dir: str) -> dict:
+    subprocess.run(["tar", "cf", f"{work_dir}/tree.tar", "-C", f"{work_dir}/tree", "."], check=True)
+    archives = {
+        "xz single-block": f"{work_dir}/single.tar.xz",
+        "xz multi-block": f"{work_dir}/multi.tar.xz",
+        "gz": f"{work_dir}/tree.tar.gz"
+    }
+    subprocess.run(f"xz -T1 -c {work_dir}/tree.tar > {archives['xz single-block']}", shell=True, check=True)
+    subprocess.run(f"xz -T0 --block-size=16MiB -c {work_dir}/tree.tar > {archives['xz multi-block']}", shell=True,
+                   check=True)
+    subprocess.run(f"gzip -c {work_dir}/tree.tar > {archives['gz']}", shell=True, check=True)
+    return archives
+
+
+def time_extraction(work_dir: str, extract) -> float:
+    dst_dir = f"{work_dir}/out"
+    shutil.rmtree(dst_dir, ignore_errors=True)
+    mkdir(dst_dir)
+    start = perf_counter()
+    extract(dst_dir)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256, help="Uncompressed size of the test archives in MB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        print_status(f"Creating {args.size}mb test archives")
+        create_tree(f"{work_dir}/tree", args.size * 1048576)
+        archives = create_archives(work_dir)
+
+        print_header(f"{'archive':<18}{'tar (1 core)':>14}{'extract_tar':>14}{'python':>14}   decompressor")
+        for name, archive_path in archives.items():
+            compression = archive_path.split(".")[-1]
+            results = [
+                time_extraction(work_dir, lambda dst: subprocess.run(["tar", "xf", archive_path, "-C", dst],
+                                                                           check=True)),
+                time_extraction(work_dir, lambda dst: archive.extract_tar(archive_path, dst)),
+                time_extraction(work_dir, lambda dst: archive.extract_tar(archive_path, dst, use_python=True))
+            ]
+            print("\r" + f"{name:<18}" + "".join(f"{result:>13.2f}s" for result in results) + "   " +
+                  " ".join(archive.get_decompressor(compression)))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# Benchmark suite for the file, command and archive primitives of the builder, with baselines to catch regressions.
+# Run from the repo root: ./benchmarks/suite.py [--scale N] [--work-dir DIR] [--save-baseline]. Needs no root or
+# network access.
+#
+# The payloads are generated from a fixed seed, so every run uses the same data:
+#   firmware: tree of ~2000 binary blobs from 4kb to 2mb, like linux-firmware
+#   headers: tree of ~30000 tiny text files in deep directories, like the kernel headers
+#   rootfs: xz compressed tarball of a 2gb rootfs-like tree, like the distro rootfs tarballs
+# --scale multiplies the number of files and the rootfs size, the default 0.25 runs in a few minutes. Use --work-dir
+# to keep the payloads between runs, e.g. to compare a change against the baseline without generating them again.
+#
+# The download benchmarks use a local http server with byte range support, like the GitHub and distro mirrors. The git
+# benchmarks clone the firmware payload from a local file:// repo, once without and once with the cached repo mirror.
+#
+# Every benchmark runs in its own process, so that its peak RSS can be measured with wait4(). The results are compared
+# against the baseline, a benchmark that is more than --threshold slower or bigger than its baseline is reported as a
+# regression and the suite exits with 1. Baselines only make sense on the same machine, so they are kept per host in
+# ~/.cache/eupnea-builder, next to the download cache, and not in the repo. Run --save-baseline first.
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import *
+import runner
+import archive
+import downloader
+import progress
+import file_ops
+
+baseline_path = os.path.expanduser("~/.cache/eupnea-builder/benchmark-baseline.json")
+seed = 20221001
+bash_calls = 200
+
+
+# create a tree with count files, cycling through sizes. text files compress like source code, the others are random
+def create_tree(path: str, count: int, sizes: list, depth: int, text: bool, rng: random.Random) -> None:
+    for index in range(count):
+        dir_path = path + "".join(f"/dir{index // 10 ** (level + 1) % 10}" for level in reversed(range(depth)))
+        mkdir(dir_path, create_parents=True)
+        size = sizes[index % len(sizes)]
+        with open(f"{dir_path}/file{index}{'.h' if text else '.bin'}", "wb") as file:
+            if text:
+                line = f"#define EUPNEA_BENCHMARK_{index}_".encode()
+                file.write((line * (size // len(line) + 1))[:size])
+            else:
+                file.write(rng.randbytes(size))
+
+
+# create a rootfs-like tree of about total_size bytes, that compresses about 3:1 like a real rootfs
+def create_rootfs(path: str, total_size: int, rng: random.Random) -> None:
+    sizes = [1024, 8192, 65536, 262144, 1048576]
+    created_size = 0
+    index = 0
+    while created_size < total_size:
+        dir_path = f"{path}/usr/dir{index // 200}/sub{index // 20 % 10}"
+        mkdir(dir_path, create_parents=True)
+        size = sizes[index % len(sizes)]
+        with open(f"{dir_path}/file{index}", "wb") as file:
+            for _ in range(max(size // 4096, 1)):
+                file.write(rng.randbytes(1024) + bytes(3072))
+        if index % 10 == 0:
+            os.symlink(f"file{index}", f"{dir_path}/link{index}")
+        created_size += max(size, 4096)
+        index += 1
+
+
+# Generate the payloads, unless they already exist with the same scale
+def create_payloads(work_dir: str, scale: float) -> None:
+    info_path = f"{work_dir}/payloads.json"
+    try:
+        with open(info_path, "r") as file:
+            if json.load(file)["scale"] == scale:
+                print_status(f"Using existing payloads in {work_dir}")
+                return
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    rng = random.Random(seed)
+    for name in ["firmware", "headers", "rootfs", "headers.tar.xz", "rootfs.tar.xz", "scratch", "firmware.git",
+                 "cache"]:
+        shutil.rmtree(f"{work_dir}/{name}", ignore_errors=True)
+        rmfile(f"{work_dir}/{name}")
+    print_status("Creating firmware payload")
+    create_tree(f"{work_dir}/firmware", int(2000 * scale), [4096, 32768, 131072, 524288, 2097152], 2, False, rng)
+    print_status("Creating headers payload")
+    create_tree(f"{work_dir}/headers", int(30000 * scale), [512, 1024, 2048, 4096, 8192], 3, True, rng)
+    subprocess.run(f"tar cf - -C {work_dir}/headers . | xz -T0 -c > {work_dir}/headers.tar.xz", shell=True,
+                   check=True)
+    print_status(f"Creating {2048 * scale:.0f}mb rootfs payload")
+    create_rootfs(f"{work_dir}/rootfs", int(2048 * 1048576 * scale), rng)
+    subprocess.run(f"tar cf - -C {work_dir}/rootfs . | xz -T0 -c > {work_dir}/rootfs.tar.xz", shell=True, check=True)
+    shutil.rmtree(f"{work_dir}/rootfs")  # only the tarball is used
+    with open(info_path, "w") as file:
+        json.dump({"scale": scale}, file)
+
+
+def get_tree_size(path: str) -> int:
+    return sum(os.lstat(os.path.join(root, file)).st_size for root, _, files in os.walk(path) for file in files)
+
+
+def get_tar_size(path: str) -> int:
+    return int(subprocess.run(f"xz -dc {path} | wc -c", shell=True, check=True, capture_output=True).stdout)
+
+
+def clear_scratch(work_dir: str) -> None:
+    shutil.rmtree(f"{work_dir}/scratch", ignore_errors=True)
+    rmfile(f"{work_dir}/scratch")
+
+
+# Serves the work dir with byte ranges, ETags and keep-alive connections
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        file = open(path, "rb")
+        size = os.fstat(file.fileno()).st_size
+        etag = f'"{os.fstat(file.fileno()).st_mtime_ns:x}-{size:x}"'
+        start, end = 0, size - 1
+        if self.headers.get("Range", "").startswith("bytes=") and self.headers.get("If-Range", etag) == etag:
+            range_start, range_end = self.headers["Range"][6:].split("-")
+            start, end = int(range_start), min(int(range_end or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        file.seek(start)
+        self.remaining = end - start + 1
+        return file
+
+    def copyfile(self, source, outputfile):
+        while self.remaining and (chunk := source.read(min(1048576, self.remaining))):
+            outputfile.write(chunk)
+            self.remaining -= len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+# Start a http server for work_dir in the background. Returns its url
+def serve_files(work_dir: str) -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeRequestHandler, directory=work_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def download_with_connections(work_dir: str, connections: int) -> None:
+    downloader.download_connections = connections
+    downloader.download(f"{serve_files(work_dir)}/rootfs.tar.xz", f"{work_dir}/scratch/rootfs.tar.xz")
+
+
+# Commit the firmware payload to a bare repo, if it doesn't exist yet
+def create_repo(work_dir: str) -> None:
+    if os.path.exists(f"{work_dir}/firmware.git"):
+        return
+    print_status("Creating firmware repo")
+    git = ["git", "--git-dir", f"{work_dir}/firmware.git", "--work-tree", f"{work_dir}/firmware"]
+    subprocess.run(["git", "init", "-q", "--bare", f"{work_dir}/firmware.git"], check=True)
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "commit", "-q", "-m",
+                          "firmware"], check=True)
+
+
+def fetch_firmware_repo(work_dir: str, use_cache: bool) -> None:
+    import cache
+    cache.configure(f"{work_dir}/cache", use_cache)
+    cache.fetch_repo(f"file://{work_dir}/firmware.git", f"{work_dir}/scratch/firmware")
+
+
+# name -> (setup(work_dir), run(work_dir), size(work_dir) -> bytes processed or None)
+# setup runs in the suite process, run in a new process
+benchmarks = {
+    "rmdir headers": (
+        lambda work_dir: subprocess.run(["cp", "-a", f"{work_dir}/headers", f"{work_dir}/scratch"], check=True),
+        lambda work_dir: file_ops.rmdir(f"{work_dir}/scratch", keep_dir=False),
+        lambda work_dir: get_tree_size(f"{work_dir}/headers")),
+    "cpdir firmware": (
+        clear_scratch,
+        lambda work_dir: file_ops.cpdir(f"{work_dir}/firmware", f"{work_dir}/scratch"),
+        lambda work_dir: get_tree_size(f"{work_dir}/firmware")),
+    "cpdir headers": (
+        clear_scratch,
+        lambda work_dir: file_ops.cpdir(f"{work_dir}/headers", f"{work_dir}/scratch"),
+        lambda work_dir: get_tree_size(f"{work_dir}/headers")),
+    "cpfile rootfs.tar.xz": (
+        clear_scratch,
+        lambda work_dir: file_ops.cpfile(f"{work_dir}/rootfs.tar.xz", f"{work_dir}/scratch"),
+        lambda work_dir: os.path.getsize(f"{work_dir}/rootfs.tar.xz")),
+    f"bash x{bash_calls}": (
+        clear_scratch,
+        lambda work_dir: [bash("true") for _ in range(bash_calls)],
+        lambda work_dir: None),
+    f"run x{bash_calls}": (
+        clear_scratch,
+        lambda work_dir: [runner.run(["true"]) for _ in range(bash_calls)],
+        lambda work_dir: None),
+    "progress start/stop": (
+        clear_scratch,
+        lambda work_dir: (progress.start_progress(), progress.stop_progress()),
+        lambda work_dir: None),
+    "download rootfs.tar.xz x4": (
+        lambda work_dir: (clear_scratch(work_dir), mkdir(f"{work_dir}/scratch")),
+        lambda work_dir: download_with_connections(work_dir, 4),
+        lambda work_dir: os.path.getsize(f"{work_dir}/rootfs.tar.xz")),
+    "download rootfs.tar.xz x1": (
+        lambda work_dir: (clear_scratch(work_dir), mkdir(f"{work_dir}/scratch")),
+        lambda work_dir: download_with_connections(work_dir, 1),
+        lambda work_dir: os.path.getsize(f"{work_dir}/rootfs.tar.xz")),
+    "clone firmware repo": (
+        lambda work_dir: (clear_scratch(work_dir), create_repo(work_dir)),
+        lambda work_dir: fetch_firmware_repo(work_dir, False),
+        lambda work_dir: get_tree_size(f"{work_dir}/firmware")),
+    "clone firmware repo(cached)": (
+        lambda work_dir: (create_repo(work_dir), fetch_firmware_repo(work_dir, True), clear_scratch(work_dir)),
+        lambda work_dir: fetch_firmware_repo(work_dir, True),
+        lambda work_dir: get_tree_size(f"{work_dir}/firmware")),
+    "extract headers.tar.xz": (
+        lambda work_dir: (clear_scratch(work_dir), mkdir(f"{work_dir}/scratch")),
+        lambda work_dir: archive.extract_tar(f"{work_dir}/headers.tar.xz", f"{work_dir}/scratch"),
+        lambda work_dir: get_tar_size(f"{work_dir}/headers.tar.xz")),
+    "extract rootfs.tar.xz": (
+        lambda work_dir: (clear_scratch(work_dir), mkdir(f"{work_dir}/scratch")),
+        lambda work_dir: archive.extract_tar(f"{work_dir}/rootfs.tar.xz", f"{work_dir}/scratch"),
+        lambda work_dir: get_tar_size(f"{work_dir}/rootfs.tar.xz")),
+    "extract rootfs.tar.xz(python)": (
+        lambda work_dir: (clear_scratch(work_dir), mkdir(f"{work_dir}/scratch")),
+        lambda work_dir: archive.extract_tar(f"{work_dir}/rootfs.tar.xz", f"{work_dir}/scratch", use_python=True),
+        lambda work_dir: get_tar_size(f"{work_dir}/rootfs.tar.xz"))
+}
+
+
+# Run a benchmark in a new process. Returns (seconds, peak rss in kb)
+def run_benchmark(name: str, work_dir: str) -> tuple:
+    setup, _, _ = benchmarks[name]
+    setup(work_dir)
+    subprocess.run(["sync"], check=True)  # don't measure writeback of the setup
+    with tempfile.NamedTemporaryFile("r") as result_file:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run", name, "--work-dir", work_dir,
+                                    "--result", result_file.name], stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+        return float(result_file.read()), usage.ru_maxrss
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    print_header(f"{'benchmark':<30}{'time':>10}{'throughput':>14}{'peak rss':>12}{'vs baseline':>14}")
+    for name, result in results.items():
+        throughput = f"{result['bytes'] / result['seconds'] / 1048576:.0f}mb/s" if result["bytes"] else \
+            f"{result['seconds'] * 1000 / bash_calls:.1f}ms/call" if name.startswith(("bash", "run")) else ""
+        line = f"{name:<30}{result['seconds']:>9.2f}s{throughput:>14}{result['peak_rss'] / 1024:>10.0f}mb"
+        base = baseline.get(name)
+        if base is None:
+            print(line)
+            continue
+        time_change = result["seconds"] / base["seconds"] - 1
+        rss_change = result["peak_rss"] / base["peak_rss"] - 1
+        line += f"{time_change:>+13.0%}"
+        if time_change > threshold or rss_change > threshold:
+            regressions.append(name)
+            print_error(f"{line}  REGRESSION(rss {rss_change:+.0%})")
+        else:
+            print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=0.25,
+                        help="Size of the payloads. 1 is about the size of the real files. Default: 0.25")
+    parser.add_argument("--work-dir", default=None,
+                        help="Directory for the payloads. They are kept and reused by later runs. Default: a "
+                             "temporary directory")
+    parser.add_argument("--repeat", type=int, default=1, help="Run every benchmark N times and use the fastest run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Report a regression if a benchmark is this much slower or bigger than the baseline. "
+                             "Default: 0.2(20%%)")
+    parser.add_argument("--only", nargs="+", default=None, choices=list(benchmarks), metavar="BENCHMARK",
+                        help="Only run these benchmarks")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Save the results to {baseline_path}")
+    parser.add_argument("--run", help=argparse.SUPPRESS)  # run a single benchmark, used internally
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        _, benchmark, _ = benchmarks[args.run]
+        start = perf_counter()
+        benchmark(args.work_dir)
+        seconds = perf_counter() - start
+        with open(args.result, "w") as file:
+            file.write(str(seconds))
+        exit(0)
+
+    with tempfile.TemporaryDirectory(dir="/var/tmp") as temp_dir:
+        work_dir = os.path.abspath(args.work_dir or temp_dir)
+        mkdir(work_dir, create_parents=True)
+        create_payloads(work_dir, args.scale)
+
+        results = {}
+        for name in args.only or benchmarks:
+            print_status(f"Running {name}")
+            runs = [run_benchmark(name, work_dir) for _ in range(args.repeat)]
+            results[name] = {"seconds": min(seconds for seconds, _ in runs),
+                             "peak_rss": max(peak_rss for _, peak_rss in runs),
+                             "bytes": benchmarks[name][2](work_dir)}
+        clear_scratch(work_dir)
+
+    machine = {"scale": args.scale, "cpus": os.cpu_count(), "machine": platform.machine(),
+               "python": platform.python_version()}
+    try:
+        with open(baseline_path, "r") as file:
+            baseline = json.load(file)
+        if baseline["machine"] != machine:
+            print_warning(f"Baseline was recorded with {baseline['machine']}, not comparable")
+            baseline = {"results": {}}
+    except FileNotFoundError:
+        print_warning("No baseline found, run with --save-baseline to create one")
+        baseline = {"results": {}}
+    regressions = compare(results, baseline["results"], args.threshold)
+
+    if args.save_baseline:
+        mkdir(os.path.dirname(baseline_path), create_parents=True)
+        with open(baseline_path, "w") as file:
+            json.dump({"machine": machine, "results": baseline["results"] | results}, file, indent=4)
+        print_status(f"Baseline saved to {baseline_path}")
+    elif regressions:
+        print_error(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        exit(1)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Block maps for sparse images, in the bmaptool format(https://github.com/yoctoproject/bmaptool).
+# The bmap lists which blocks of the image contain data, with a sha256 for each range. Flashing with it only writes
+# those blocks instead of the whole image, which is mostly empty space.
+
+import os
+import errno
+import hashlib
+import xml.etree.ElementTree as ElementTree
+
+from functions import *
+
+block_size = 4096
+io_size = 4 * 1048576  # read/write in 4MB chunks
+
+
+# Get (first block, last block) ranges of the image that contain data
+def get_mapped_ranges(img_path: str) -> list:
+    ranges = []
+    with open(img_path, "rb") as img:
+        img_size = os.fstat(img.fileno()).st_size
+        position = 0
+        while position < img_size:
+            try:
+                data_start = os.lseek(img.fileno(), position, os.SEEK_DATA)
+                data_end = os.lseek(img.fileno(), data_start, os.SEEK_HOLE)
+            except OSError as err:
+                if err.errno == errno.ENXIO:  # no more data until the end of the file
+                    break
+                return [(0, (img_size - 1) // block_size)]  # filesystem doesn't support sparse files
+            first_block = data_start // block_size
+            last_block = (data_end - 1) // block_size
+            if ranges and ranges[-1][1] >= first_block - 1:  # merge ranges that share a block
+                ranges[-1] = (ranges[-1][0], last_block)
+            else:
+                ranges.append((first_block, last_block))
+            position = data_end
+    return ranges
+
+
+# Write a bmap file for the image. Default path is <img_path>.bmap
+def create_bmap(img_path: str, bmap_path: str = None) -> str:
+    print_status("Creating block map")
+    if bmap_path is None:
+        bmap_path = f"{img_path}.bmap"
+    img_size = os.path.getsize(img_path)
+    ranges = get_mapped_ranges(img_path)
+
+    range_lines = []
+    with open(img_path, "rb") as img:
+        for first_block, last_block in ranges:
+            sha256 = hashlib.sha256()
+            img.seek(first_block * block_size)
+            remaining = min((last_block + 1) * block_size, img_size) - first_block * block_size
+            while remaining > 0:
+                data = img.read(min(io_size, remaining))
+                sha256.update(data)
+                remaining -= len(data)
+            blocks = f"{first_block}" if first_block == last_block else f"{first_block}-{last_block}"
+            range_lines.append(f'        <Range chksum="{sha256.hexdigest()}"> {blocks} </Range>')
+
+    mapped_blocks = sum(last_block - first_block + 1 for first_block, last_block in ranges)
+    bmap = "\n".join([
+        '<?xml version="1.0" ?>',
+        '<bmap version="2.0">',
+        f"    <ImageSize> {img_size} </ImageSize>",
+        f"    <BlockSize> {block_size} </BlockSize>",
+        f"    <BlocksCount> {(img_size + block_size - 1) // block_size} </BlocksCount>",
+        f"    <MappedBlocksCount> {mapped_blocks} </MappedBlocksCount>",
+        "    <ChecksumType> sha256 </ChecksumType>",
+        f"    <BmapFileChecksum> {'0' * 64} </BmapFileChecksum>",
+        "    <BlockMap>",
+        *range_lines,
+        "    </BlockMap>",
+        "</bmap>",
+        ""
+    ])
+    # the file checksum is calculated with the checksum field set to zeros
+    bmap = bmap.replace("0" * 64, hashlib.sha256(bmap.encode()).hexdigest(), 1)
+    with open(bmap_path, "w") as file:
+        file.write(bmap)
+    print_status(f"Block map: {mapped_blocks * block_size / 1048576:.0f}mb of {img_size / 1048576:.0f}mb are used")
+    return bmap_path
+
+
+# Read a bmap file. Returns (image size, list of (first block, last block, sha256))
+def read_bmap(bmap_path: str) -> tuple:
+    with open(bmap_path, "r") as file:
+        bmap = file.read()
+    root = ElementTree.fromstring(bmap)
+    if root.findtext("ChecksumType").strip() != "sha256":
+        raise ValueError("Only sha256 block maps are supported")
+    file_checksum = root.findtext("BmapFileChecksum").strip()
+    if hashlib.sha256(bmap.replace(file_checksum, "0" * 64, 1).encode()).hexdigest() != file_checksum:
+        raise ValueError(f"{bmap_path} is damaged")
+    if int(root.findtext("BlockSize")) != block_size:
+        raise ValueError(f"Unsupported block size in {bmap_path}")
+
+    ranges = []
+    for range_element in root.find("BlockMap"):
+        blocks = range_element.text.strip().split("-")
+        ranges.append((int(blocks[0]), int(blocks[-1]), range_element.get("chksum")))
+    return int(root.findtext("ImageSize")), ranges
+
+
+# Write only the mapped blocks of the image to a device and verify their checksums while writing
+def flash(img_path: str, device: str, bmap_path: str = None) -> None:
+    if bmap_path is None:
+        bmap_path = f"{img_path}.bmap"
+    if not path_exists(bmap_path):
+        create_bmap(img_path, bmap_path)
+    img_size, ranges = read_bmap(bmap_path)
+    if os.path.getsize(img_path) != img_size:
+        raise ValueError(f"{bmap_path} doesn't belong to {img_path}")
+
+    total_size = sum((last_block - first_block + 1) * block_size for first_block, last_block, _ in ranges)
+    written = 0
+    print_status(f"Flashing {img_path} to {device}")
+    with open(img_path, "rb") as img:
+        device_fd = os.open(device, os.O_WRONLY)
+        try:
+            for first_block, last_block, checksum in ranges:
+                sha256 = hashlib.sha256()
+                position = first_block * block_size
+                end = min((last_block + 1) * block_size, img_size)
+                img.seek(position)
+                while position < end:
+                    data = img.read(min(io_size, end - position))
+                    sha256.update(data)
+                    os.pwrite(device_fd, data, position)
+                    position += len(data)
+                    written += len(data)
+                    print(f"\rFlashed: {written / 1048576:.0f}mb/{total_size / 1048576:.0f}mb", end="", flush=True)
+                if sha256.hexdigest() != checksum:
+                    raise ValueError(f"Checksum mismatch in blocks {first_block}-{last_block}, image is damaged")
+            os.fsync(device_fd)
+        finally:
+            os.close(device_fd)
+    print("")  # break line after progress
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
@@ -1,11 +1,54 @@
 #!/usr/bin/env python3
 
 from typing import Tuple
-from urllib.request import urlretrieve
 from urllib.error import URLError
+from concurrent.futures import ThreadPoolExecutor
+import os
+import http.client
 import json
+import lzma
+import uuid
 
 from functions import *
+import runner
+import cache
+import gpt
+import bmap
+import snapshot
+import checkpoint
+import timing
+import chroot_session
+import firmware
+import archive
+import progress
+import file_ops
+
+# Download sources. Overwrite these to build from mirrors/local test servers
+kernel_release_url = "https://github.com/eupnea-linux/kernel/releases/"
+mainline_release_url = "https://github.com/eupnea-linux/mainline-kernel/releases/"
+firmware_repo = "https://chromium.googlesource.com/chromiumos/third_party/linux-firmware/"
+postinstall_repo = "https://github.com/eupnea-linux/postinstall-scripts"
+audio_repo = "https://github.com/eupnea-linux/audio-scripts"
+
+# Approximate size of a fresh install in GB, including downloaded packages, used to size the image before anything is
+# downloaded or installed. These are upper bounds, the image is shrunk at the end of the build
+rootfs_sizes = {"ubuntu": 1.5, "debian": 1, "arch": 2, "fedora": 2}
+de_sizes = {"gnome": 5, "kde": 6, "mate": 4, "xfce": 3, "lxqt": 3, "deepin": 5, "budgie": 4, "cli": 0.5}
+firmware_size = 1.5  # the whole firmware repo, --firmware all
+firmware_subset_size = 0.5  # firmware for the kernel modules, see firmware.py
+kernel_size = 1  # modules + headers
+
+# kernel files + rootfs + 3 git repos are all downloaded at the same time
+download_pool = ThreadPoolExecutor(max_workers=8)
+# files that are extracted while they are still downloading, see start_downloads(). file name -> url
+stream_urls = {}
+# files that are read in place from --local-path instead of /tmp/eupnea-build. file name -> path
+local_files = {}
+# the image file, see start_build()
+img_path = "eupnea.img"
+# partition layout of the image, in bytes. Same as partition() creates with parted
+kernel_part_start = 1048576
+rootfs_part_start = 65 * 1048576
 
 
 # Clean /tmp from eupnea files
@@ -14,194 +57,363 @@ def prepare_host(de_name: str, user_id: str) -> None:
 
     # unmount fedora remains before attempting to remove /tmp/eupnea-build
     try:
-        bash("umount -lf /tmp/eupnea-build/fedora-tmp-mnt 2>/dev/null")  # umount fedora temp if exists
+        runner.run(["umount", "-lf", "/tmp/eupnea-build/fedora-tmp-mnt"])  # umount fedora temp if exists
     except subprocess.CalledProcessError:
         print("Failed to unmount /tmp/eupnea-build/fedora-tmp-mnt, ignore")
         pass
 
     print_status("Cleaning + preparing host system")
-    rmdir("/tmp/eupnea-build")
+    file_ops.rmdir("/tmp/eupnea-build")
     mkdir("/tmp/eupnea-build", create_parents=True)
-    install_build_packages(user_id)
+    install_host_packages(de_name, user_id)
 
     print_status("Creating mount points")
     try:
-        bash("umount -lf /mnt/eupnea")  # just in case
+        runner.run(["umount", "-lf", "/mnt/eupnea"])  # just in case
     except subprocess.CalledProcessError:
         print("Failed to unmount /mnt/eupnea, ignore")
         pass
-    rmdir("/mnt/eupnea")
+    file_ops.rmdir("/mnt/eupnea")
     mkdir("/mnt/eupnea", create_parents=True)
 
-    rmfile("eupnea.img")
-    rmfile("kernel.flags")
+    rmfile(img_path)
+    rmfile(f"{img_path}.bmap")
+    rmfile(f"{img_path}.rootfs")
+    if path_exists(f"{img_path}.staging"):
+        file_ops.rmdir(f"{img_path}.staging", keep_dir=False)
+
+
+# Install the packages the build needs on the host
+def install_host_packages(distro_name: str, user_id: str) -> None:
+    install_build_packages(user_id)
 
     # install debootstrap for debian
-    if de_name == "debian" and not path_exists("/usr/sbin/debootstrap"):
+    if distro_name == "debian" and not path_exists("/usr/sbin/debootstrap"):
         print_status("Installing debootstrap")
         if path_exists("/usr/bin/apt"):
-            bash("apt-get install debootstrap -y")
+            runner.run(["apt-get", "install", "debootstrap", "-y"])
         elif path_exists("/usr/bin/pacman"):
-            bash("pacman -S debootstrap --noconfirm")
+            runner.run(["pacman", "-S", "debootstrap", "--noconfirm"])
         elif path_exists("/usr/bin/dnf"):
-            bash("dnf install debootstrap --assumeyes")
+            runner.run(["dnf", "install", "debootstrap", "--assumeyes"])
         elif path_exists("/usr/bin/zypper"):  # openSUSE
-            bash("zypper --non-interactive install debootstrap")
+            runner.run(["zypper", "--non-interactive", "install", "debootstrap"])
         else:
             print_warning("Debootstrap not found, please install it using your disotros package manager or select "
                           "another distro instead of debian")
             exit(1)
 
-    # install arch-chroot for arch
-    if de_name == "arch" and not path_exists("/usr/bin/arch-chroot"):
-        print_status("Installing arch-chroot")
-        if path_exists("/usr/bin/apt"):
-            bash("apt-get install arch-install-scripts -y")
-        elif path_exists("/usr/bin/pacman"):
-            bash("pacman -S arch-install-scripts --noconfirm")
-        elif path_exists("/usr/bin/dnf"):
-            bash("dnf install arch-install-scripts --assumeyes")
-        elif path_exists("/usr/bin/zypper"):  # openSUSE
-            bash("zypper --non-interactive install arch-install-scripts")
-        else:
-            print_warning("Arch-install-scripts not found, please install it using your distros package manager or "
-                          "select another distro instead of arch")
-            exit(1)
 
-
-# download kernel files from GitHub
-def download_kernel(kernel_type: str, dev_release: bool) -> None:
-    # select correct link
-    if dev_release:
-        url = "https://github.com/eupnea-linux/kernel/releases/download/dev-build/"
-    else:
-        url = "https://github.com/eupnea-linux/kernel/releases/latest/download/"
-
-    # download kernel files
-    start_progress()  # show fake progress
+# Shrink the rootfs filesystem to its minimum size + headroom, then shrink the partition and the image file to match.
+# The loop device is detached afterwards
+def shrink_img(img_mnt: str, headroom: int) -> None:
+    print_status("Shrinking image")
+    fs_size = shrink_fs(f"{img_mnt}p2", headroom)
+    runner.run(["losetup", "-d", img_mnt])
+
+    # The partition keeps its start and PARTUUID, as the PARTUUID is in the kernel flags and fstab
+    partition_table = gpt.read_gpt(img_path)
+    rootfs_entry = partition_table["entries"][1]
+    fs_size = min(fs_size, (rootfs_entry["last_lba"] - rootfs_entry["first_lba"] + 1) * gpt.sector_size)
+    rootfs_entry["last_lba"] = rootfs_entry["first_lba"] + fs_size // gpt.sector_size - 1
+    # backup partition table is at the end of the image
+    disk_sectors = rootfs_entry["last_lba"] + 2 + gpt.entries_sectors
+    disk_sectors = (disk_sectors + 2047) // 2048 * 2048  # round up to MiB
+    runner.run(["truncate", "-s", str(disk_sectors * gpt.sector_size), img_path])
+    gpt.write_gpt(img_path, partition_table, disk_sectors)
+    print_status(f"Image shrunk to {disk_sectors * gpt.sector_size / 1024 ** 3:.2f}GB")
+
+
+# Shrink an ext4 filesystem(partition or file) to its minimum size + headroom. Returns the new size in bytes
+def shrink_fs(fs_path: str, headroom: int) -> int:
+    # e2fsck refuses to check a mounted filesystem(exit code 8), and resizing it offline would damage it
+    with open("/proc/mounts", "r") as mounts:
+        mount_points = [line.split()[1] for line in mounts
+                        if os.path.realpath(line.split()[0]) == os.path.realpath(fs_path)]
+    if mount_points:
+        print_error(f"Can't shrink {fs_path}, it is still mounted at: {', '.join(mount_points)}")
+        print_error("Unmount it with 'umount -R' and run the build again to resume")
+        exit(1)
+    try:
+        runner.run(["e2fsck", "-fy", fs_path])  # resize2fs needs a freshly checked filesystem
+    except subprocess.CalledProcessError as err:
+        if err.returncode > 1:  # 1 means errors were fixed
+            raise
+    runner.run(["resize2fs", "-M", fs_path])
+    fs_info = runner.run(["dumpe2fs", "-h", fs_path], capture=True)
+    block_count = int(fs_info.split("Block count:")[1].split()[0])
+    block_size = int(fs_info.split("Block size:")[1].split()[0])
+    fs_size = (block_count * block_size + headroom) // 1048576 * 1048576  # round to MiB
+    runner.run(["resize2fs", fs_path, f"{fs_size // 1024}K"])
+    return fs_size
+
+
+# Assemble the image from the staging directory(--staged): the rootfs partition is created from it with mkfs.ext4 -d in
+# one sequential pass and written into the image together with the signed kernel and a new partition table
+def assemble_img(root_partuuid: str, headroom: int) -> None:
+    staging_dir = f"{img_path}.staging"
+    rootfs_path = f"{img_path}.rootfs"
+    print_status("Creating rootfs partition")
+    rmfile(rootfs_path)
+    # the filesystem is created bigger than needed and shrunk afterwards, the files are packed at its start
+    runner.run(["truncate", "-s", str(estimate_fs_size(staging_dir)), rootfs_path])
+    runner.run(["mkfs.ext4", "-q", "-F", "-d", staging_dir, rootfs_path])
+    fs_size = shrink_fs(rootfs_path, headroom)
+    runner.run(["truncate", "-s", str(fs_size), rootfs_path])
+
+    print_status("Assembling image")
+    kernel_size = os.path.getsize("/tmp/eupnea-build/bzImage.signed")
+    if kernel_part_start + kernel_size > rootfs_part_start:
+        print_error("Signed kernel doesn't fit into the kernel partition")
+        exit(1)
+    # backup partition table is at the end of the image
+    disk_sectors = (rootfs_part_start + fs_size) // gpt.sector_size + 1 + gpt.entries_sectors
+    disk_sectors = (disk_sectors + 2047) // 2048 * 2048  # round up to MiB
+    rmfile(img_path)
+    runner.run(["truncate", "-s", str(disk_sectors * gpt.sector_size), img_path])
+    with open(img_path, "r+b") as img:
+        with open("/tmp/eupnea-build/bzImage.signed", "rb") as kernel:
+            __copy_range(kernel, img, 0, kernel_part_start, kernel_size)
+        # only the used blocks of the filesystem are copied, the image stays sparse
+        with open(rootfs_path, "rb") as rootfs:
+            for first_block, last_block in bmap.get_mapped_ranges(rootfs_path):
+                start = first_block * bmap.block_size
+                end = min((last_block + 1) * bmap.block_size, fs_size)
+                __copy_range(rootfs, img, start, rootfs_part_start + start, end - start)
+    rmfile(rootfs_path)
+
+    # same partitions as partition() creates, the rootfs partition gets the PARTUUID from the kernel flags and fstab
+    gpt.write_gpt(img_path, {"disk_guid": uuid.uuid4().bytes_le, "entries": [
+        gpt.new_entry(gpt.chromeos_kernel_type, str(uuid.uuid4()), kernel_part_start // gpt.sector_size,
+                      rootfs_part_start // gpt.sector_size - 1, "Kernel", gpt.get_kernel_attributes(15, 5, True)),
+        gpt.new_entry(gpt.linux_data_type, root_partuuid, rootfs_part_start // gpt.sector_size,
+                      (rootfs_part_start + fs_size) // gpt.sector_size - 1, "Root")
+    ]}, disk_sectors)
+    file_ops.rmdir(staging_dir, keep_dir=False)
+    print_status(f"Image assembled, {disk_sectors * gpt.sector_size / 1024 ** 3:.2f}GB")
+
+
+# Get an upper bound for the size of an ext4 filesystem with the files of a directory: every file and directory rounded
+# up to 4K blocks, plus inode tables, journal and free space for mkfs.ext4 to work with
+def estimate_fs_size(directory: str) -> int:
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files + dirs:
+            size += (os.lstat(os.path.join(root, name)).st_size + 4095) // 4096 * 4096 + 4096
+    return (int(size * 1.1) + 512 * 1048576) // 1048576 * 1048576  # round to MiB
+
+
+# download a single file, exit if it can't be reached
+def download_file(url: str, path: str) -> None:
     try:
-        match kernel_type:
-            case "mainline":
-                print_status("Downloading mainline kernel")
-                url = "https://github.com/eupnea-linux/mainline-kernel/releases/latest/download/"
-                urlretrieve(f"{url}bzImage-stable", filename="/tmp/eupnea-build/bzImage")
-                urlretrieve(f"{url}modules-stable.tar.xz", filename="/tmp/eupnea-build/modules.tar.xz")
-                urlretrieve(f"{url}headers-stable.tar.xz", filename="/tmp/eupnea-build/headers.tar.xz")
-            case "alt":
-                print_status("Downloading alt kernel")
-                urlretrieve(f"{url}bzImage-alt", filename="/tmp/eupnea-build/bzImage")
-                urlretrieve(f"{url}modules-alt.tar.xz", filename="/tmp/eupnea-build/modules.tar.xz")
-                urlretrieve(f"{url}headers-alt.tar.xz", filename="/tmp/eupnea-build/headers.tar.xz")
-            case "exp":
-                print_status("Downloading experimental 5.15 kernel")
-                urlretrieve(f"{url}bzImage-exp", filename="/tmp/eupnea-build/bzImage")
-                urlretrieve(f"{url}modules-exp.tar.xz", filename="/tmp/eupnea-build/modules.tar.xz")
-                urlretrieve(f"{url}headers-exp.tar.xz", filename="/tmp/eupnea-build/headers.tar.xz")
-            case "stable":
-                print_status("Downloading stable 5.10 kernel")
-                urlretrieve(f"{url}bzImage", filename="/tmp/eupnea-build/bzImage")
-                urlretrieve(f"{url}modules.tar.xz", filename="/tmp/eupnea-build/modules.tar.xz")
-                urlretrieve(f"{url}headers.tar.xz", filename="/tmp/eupnea-build/headers.tar.xz")
+        cache.fetch(url, path)
     except URLError:
-        print_error("Failed to reach github. Check your internet connection and try again or use local files with -l")
+        print_error(f"Couldn't download {url}. Check your internet connection and try again or use local files with -l")
         exit(1)
 
-    stop_progress()  # stop fake progress
-    print_status("Kernel files downloaded successfully")
-
 
-# download the distro rootfs
-def download_rootfs(distro_name: str, distro_version: str, distro_link: str) -> None:
+# shallow clone a git repo, using the cached mirror if possible. A partial clone only contains the file list, files are
+# downloaded when they are checked out
+def clone_repo(repo_url: str, path: str, partial: bool = False) -> None:
     try:
-        match distro_name:
-            case "ubuntu":
-                print_status(f"Downloading ubuntu rootfs {distro_version}")
-                start_download_progress("/tmp/eupnea-build/ubuntu-rootfs.tar.xz")
-                urlretrieve(
-                    f"https://cloud-images.ubuntu.com/releases/{distro_version}/release/ubuntu-{distro_version}"
-                    f"-server-cloudimg-amd64-root.tar.xz",
-                    filename="/tmp/eupnea-build/ubuntu-rootfs.tar.xz")
-                stop_download_progress()
-            case "debian":
-                print_status("Debian is downloaded later, skipping download")
-            case "arch":
-                print_status("Downloading latest arch rootfs")
-                start_download_progress("/tmp/eupnea-build/arch-rootfs.tar.gz")
-                urlretrieve(distro_link, filename="/tmp/eupnea-build/arch-rootfs.tar.gz")
-                stop_download_progress()
-            case "fedora":
-                print_status(f"Downloading fedora rootfs version: {distro_version}")
-                start_download_progress("/tmp/eupnea-build/fedora-rootfs.raw.xz")
-                urlretrieve(distro_link, filename="/tmp/eupnea-build/fedora-rootfs.raw.xz")
-                stop_download_progress()
-    except URLError:
-        print_error("Couldn't download rootfs. Check your internet connection and try again. If the error persists, "
-                    "create an issue with the distro and version in the name")
+        cache.fetch_repo(repo_url, path, partial)
+    except subprocess.CalledProcessError:
+        print_error(f"Couldn't clone {repo_url}. Check your internet connection and try again.")
         exit(1)
 
 
-# Download firmware for later
-def download_firmware() -> None:
-    print_status("Downloading firmware")
-    start_progress()  # start fake progress
+# get the download links for the kernel files
+def get_kernel_urls(kernel_type: str, dev_release: bool) -> dict:
+    # select correct link
+    if dev_release:
+        url = f"{kernel_release_url}download/dev-build/"
+    else:
+        url = f"{kernel_release_url}latest/download/"
+
+    match kernel_type:
+        case "mainline":
+            url = f"{mainline_release_url}latest/download/"
+            suffix = "-stable"
+        case "alt":
+            suffix = "-alt"
+        case "exp":
+            suffix = "-exp"
+        case _:  # stable
+            suffix = ""
+    return {
+        "bzImage": f"{url}bzImage{suffix}",
+        "modules.tar.xz": f"{url}modules{suffix}.tar.xz",
+        "headers.tar.xz": f"{url}headers{suffix}.tar.xz"
+    }
+
+
+# get the download link and file name of the distro rootfs. Returns None for debian, as it is debootstrapped later
+def get_rootfs_url(distro_name: str, distro_version: str, distro_link: str) -> Tuple[str, str] | None:
+    match distro_name:
+        case "ubuntu":
+            return (f"https://cloud-images.ubuntu.com/releases/{distro_version}/release/ubuntu-{distro_version}"
+                    f"-server-cloudimg-amd64-root.tar.xz", "ubuntu-rootfs.tar.xz")
+        case "arch":
+            return distro_link, "arch-rootfs.tar.gz"
+        case "fedora":
+            return distro_link, "fedora-rootfs.raw.xz"
+    return None
+
+
+# Start downloading the kernel, rootfs, firmware and eupnea scripts in parallel.
+# Returns a dict with a future for each file/repo, use wait_downloads() to wait for them.
+# If stream is True, tarballs are not downloaded here but extracted straight from the network later on
+def start_downloads(kernel_type: str, dev_release: bool, distro_name: str, distro_version: str, distro_link: str,
+                    stream: bool = False, firmware_profile: str = "kernel") -> dict:
+    print_status("Downloading kernel, rootfs, firmware and eupnea scripts")
+    if stream:
+        set_stream_urls(kernel_type, dev_release, distro_name, distro_version, distro_link)
+    downloads = {}
+    for file_name, url in get_kernel_urls(kernel_type, dev_release).items():
+        if file_name not in stream_urls:
+            downloads[file_name] = download_pool.submit(download_file, url, f"/tmp/eupnea-build/{file_name}")
+
+    rootfs = get_rootfs_url(distro_name, distro_version, distro_link)
+    if rootfs is None:
+        print_status("Debian is downloaded later, skipping download")
+    elif rootfs[1] not in stream_urls:
+        downloads["rootfs"] = download_pool.submit(download_file, rootfs[0], f"/tmp/eupnea-build/{rootfs[1]}")
+
+    # only the selected firmware is downloaded later, see post_config()
+    downloads["firmware"] = download_pool.submit(clone_repo, firmware_repo, "/tmp/eupnea-build/firmware",
+                                                 partial=firmware_profile != "all")
+    downloads["postinstall-scripts"] = download_pool.submit(clone_repo, postinstall_repo,
+                                                            "/tmp/eupnea-build/postinstall-scripts")
+    downloads["audio-scripts"] = download_pool.submit(clone_repo, audio_repo, "/tmp/eupnea-build/audio-scripts")
+    return downloads
+
+
+# Mark the kernel tarballs and the rootfs to be streamed instead of downloaded, see get_build_file()
+def set_stream_urls(kernel_type: str, dev_release: bool, distro_name: str, distro_version: str,
+                    distro_link: str) -> None:
+    for file_name, url in get_kernel_urls(kernel_type, dev_release).items():
+        if file_name.endswith(".tar.xz"):
+            stream_urls[file_name] = url
+    rootfs = get_rootfs_url(distro_name, distro_version, distro_link)
+    if rootfs is not None:
+        stream_urls[rootfs[1]] = rootfs[0]
+
+
+# Wait for the given downloads(all if names is None) to finish.
+# Errors from the download threads(including exit()) are re-raised here, in the main thread
+def wait_downloads(downloads: dict, names: list = None) -> None:
     try:
-        bash("git clone --depth=1 https://chromium.googlesource.com/chromiumos/third_party/linux-firmware/ "
-             "/tmp/eupnea-build/firmware")
-    except URLError:
-        print_error("Couldn't download firmware. Check your internet connection and try again.")
-        exit(1)
-    stop_progress()  # stop fake progress
+        for name in names or downloads:
+            downloads[name].result()
+    except BaseException:
+        download_pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+# Get a build file for extract_tar(): the download stream if the file is streamed, otherwise the downloaded file.
+# If as_chunks is True, downloaded files are returned as chunks too
+def get_build_file(file_name: str, as_chunks: bool = False):
+    if file_name in stream_urls:
+        print_status(f"Streaming {file_name} from {stream_urls[file_name]}")
+        return cache.stream(stream_urls[file_name])
+    if as_chunks:
+        return archive.read_chunks(get_build_path(file_name))
+    return get_build_path(file_name)
 
 
-# Download postinstall scripts
-def download_postinstall_scripts() -> None:
-    print_status("Downloading postinstall scripts")
-    start_progress()  # start fake progress
+# Get the path of a downloaded or local build file
+def get_build_path(file_name: str) -> str:
+    return local_files.get(file_name, f"/tmp/eupnea-build/{file_name}")
+
+
+# Use the files in local_path directly, without copying them to /tmp/eupnea-build
+def use_local_files(local_path: str, distro_name: str) -> None:
+    file_names = ["bzImage", "modules.tar.xz", "headers.tar.xz", "firmware"]
+    match distro_name:
+        case "ubuntu":
+            file_names.append("ubuntu-rootfs.tar.xz")
+        case "debian":
+            file_names.append("debian")
+        case "arch":
+            file_names.append("arch-rootfs.tar.gz")
+        case "fedora":
+            file_names.append("fedora-rootfs.raw.xz")
+        case _:
+            print_error("Distro name not found, please create an issue")
+            exit(1)
+    for file_name in file_names:
+        path = Path(local_path).joinpath(file_name).absolute()
+        if not path.exists():
+            print_error(f"{path} could not be found. Verify all file names are correct (use --help to see correct "
+                        "names)")
+            exit(1)
+        local_files[file_name] = path.as_posix()
+
+
+# Extract a build file, exit if a streamed download fails
+def extract_build_file(file_name: str, dst_dir: str, skip_old_files: bool = False, strip_components: int = 0,
+                       members: list = None) -> None:
     try:
-        bash("git clone --depth=1 https://github.com/eupnea-linux/postinstall-scripts "
-             "/tmp/eupnea-build/postinstall-scripts")
-    except URLError:
-        print_error("Couldn't download postinstall scripts. Check your internet connection and try again.")
+        archive.extract_tar(get_build_file(file_name), dst_dir, file_name.split(".")[-1], skip_old_files=skip_old_files,
+                            strip_components=strip_components, members=members)
+    # a connection that breaks while streaming raises IncompleteRead, ConnectionResetError or a timeout, not URLError
+    except (OSError, http.client.HTTPException) as err:
+        if file_name not in stream_urls:  # reading a downloaded or local file failed
+            raise
+        print_error(f"Couldn't download {stream_urls[file_name]} ({err}). Check your internet connection and try again")
         exit(1)
-    stop_progress()  # stop fake progress
 
 
-# Download postinstall scripts
-def download_audio_scripts() -> None:
-    print_status("Downloading audio scripts")
-    start_progress()  # start fake progress
+# Get the uncompressed size of a .xz file, None if it can't be read
+def get_uncompressed_size(path: str) -> int | None:
     try:
-        bash("git clone --depth=1 https://github.com/eupnea-linux/audio-scripts "
-             "/tmp/eupnea-build/audio-scripts")
-    except URLError:
-        print_error("Couldn't download audio scripts. Check your internet connection and try again.")
-        exit(1)
-    stop_progress()  # stop fake progress
+        for line in runner.run(["xz", "--robot", "--list", path], capture=True).splitlines():
+            if line.startswith("totals"):
+                return int(line.split()[4])
+    except (subprocess.CalledProcessError, IndexError, ValueError):
+        pass
+    return None
+
+
+# Estimate how big the image needs to be during the build. The rootfs is usually still downloading at this point, so
+# table values are used for the rootfs and DE. The image is shrunk to its real size at the end of the build, so
+# overestimating only costs sparse, unallocated space
+def estimate_img_size(distro_name: str, de_name: str, firmware_profile: str) -> int:
+    size = (rootfs_sizes.get(distro_name, 2) + de_sizes.get(de_name, 6)) * 1024 ** 3
+    size += (firmware_size if firmware_profile == "all" else firmware_subset_size) * 1024 ** 3
+
+    kernel_payload = 0
+    for file_name in ["modules.tar.xz", "headers.tar.xz"]:
+        file_size = get_uncompressed_size(get_build_path(file_name))
+        if file_size is None:  # not downloaded yet
+            kernel_payload = kernel_size * 1024 ** 3
+            break
+        kernel_payload += file_size
+    size += kernel_payload
+
+    size += 1024 ** 3  # free space for package managers, temp files etc.
+    return int(size) // 1048576 * 1048576  # round to MiB
 
 
 # Create, mount, partition the img and flash the eupnea kernel
-def prepare_img() -> Tuple[str, str]:
-    print_status("Preparing image")
+def prepare_img(img_size: int) -> Tuple[str, str]:
+    print_status(f"Preparing {img_size / 1024 ** 3:.1f}GB image")
 
-    # TODO: dynamic img size
-    img_size = 10
     try:
-        bash(f"fallocate -l {img_size}G eupnea.img")
-    except subprocess.CalledProcessError:  # try fallocate, if it fails use dd
-        bash("dd if=/dev/zero of=eupnea.img status=progress bs=12884 count=1000070")
+        runner.run(["fallocate", "-l", str(img_size), img_path])
+    except subprocess.CalledProcessError:  # fallocate is not supported on all filesystems -> create a sparse file
+        runner.run(["truncate", "-s", str(img_size), img_path])
 
     print_status("Mounting empty image")
-    mnt_point = bash("losetup -f --show eupnea.img")
+    mnt_point = runner.run(["losetup", "-f", "--show", img_path], capture=True)
     if mnt_point == "":
         print_error("\033[91m" + "Failed to mount image" + "\033[0m")
         exit(1)
     return partition(mnt_point, False)
 
 
-# Prepare USB, usb is not yet fully implemented
-def prepare_usb(device: str) -> Tuple[str, str]:
-    print_status("Preparing USB")
-
+# Get the /dev path of a USB-drive/SD-card and unmount all its partitions
+def get_usb_device(device: str) -> str:
     # fix device name if needed
     if device.endswith("/") or device.endswith("1") or device.endswith("2"):
         device = device[:-1]
@@ -211,10 +423,53 @@ def prepare_usb(device: str) -> Tuple[str, str]:
 
     # unmount all partitions
     try:
-        bash(f"umount -lf {device}*")
+        runner.run(f"umount -lf {device}*")  # needs a shell for the glob
     except subprocess.CalledProcessError:
         pass
-    return partition(device, True)
+    return device
+
+
+# Prepare USB, usb is not yet fully implemented
+def prepare_usb(device: str) -> Tuple[str, str]:
+    print_status("Preparing USB")
+    return partition(get_usb_device(device), True)
+
+
+# Attach and mount the image/device of an interrupted build again, e.g. after the loop device was detached.
+# Returns the loop device/device
+def reattach_device(device: str, img_mnt: str) -> str:
+    print_status("Reattaching device/image of the previous build")
+    if img_mnt == "staging":  # --staged
+        if not os.path.ismount("/mnt/eupnea"):
+            mkdir("/mnt/eupnea", create_parents=True)
+            runner.run(["mount", "--bind", f"{img_path}.staging", "/mnt/eupnea"])
+        return img_mnt
+    if device == "image":
+        # losetup -j lists the loop devices the image is attached to: "/dev/loop0: []: (/path/eupnea.img)"
+        attached = runner.run(["losetup", "-j", get_full_path(img_path)], capture=True)
+        if attached:
+            img_mnt = attached.split(":")[0]
+        else:
+            img_mnt = runner.run(["losetup", "-f", "--show", "-P", img_path], capture=True)
+        rootfs_mnt = f"{img_mnt}p2"
+    else:
+        img_mnt = get_usb_device(device)
+        rootfs_mnt = f"{img_mnt}2"
+    if not os.path.ismount("/mnt/eupnea"):
+        mkdir("/mnt/eupnea", create_parents=True)
+        runner.run(["mount", rootfs_mnt, "/mnt/eupnea"])
+    return img_mnt
+
+
+# Write a finished image to a USB-drive/SD-card. Only blocks that are used in the image are written
+def flash_usb(img_path: str, device: str) -> None:
+    device = get_usb_device(device)
+    runner.run(["wipefs", "-af", device])  # the old partition table might not be overwritten otherwise
+    try:
+        bmap.flash(img_path, device)
+    except ValueError as err:
+        print_error(str(err))
+        exit(1)
 
 
 def partition(mnt_point: str, write_usb: bool) -> Tuple[str, str]:
@@ -230,121 +485,148 @@ def partition(mnt_point: str, write_usb: bool) -> Tuple[str, str]:
 
     # remove pre-existing partition table from usb
     if write_usb:
-        bash(f"wipefs -af {mnt_point}")
+        runner.run(["wipefs", "-af", mnt_point])
 
     # format as per depthcharge requirements,
     # READ: https://wiki.gentoo.org/wiki/Creating_bootable_media_for_depthcharge_based_devices
-    bash(f"parted -s {mnt_point} mklabel gpt")
-    bash(f"parted -s -a optimal {mnt_point} unit mib mkpart Kernel 1 65")  # kernel partition
-    bash(f"parted -s -a optimal {mnt_point} unit mib mkpart Root 65 100%")  # rootfs partition
-    bash(f"cgpt add -i 1 -t kernel -S 1 -T 5 -P 15 {mnt_point}")  # depthcharge flags
+    runner.run(["parted", "-s", mnt_point, "mklabel", "gpt"])
+    # kernel partition
+    runner.run(["parted", "-s", "-a", "optimal", mnt_point, "unit", "mib", "mkpart", "Kernel", "1", "65"])
+    # rootfs partition
+    runner.run(["parted", "-s", "-a", "optimal", mnt_point, "unit", "mib", "mkpart", "Root", "65", "100%"])
+    # depthcharge flags
+    runner.run(["cgpt", "add", "-i", "1", "-t", "kernel", "-S", "1", "-T", "5", "-P", "15", mnt_point])
 
     # get uuid of rootfs partition
-    rootfs_partuuid = bash(f"blkid -o value -s PARTUUID {rootfs_mnt}")
-
-    # write PARTUUID to kernel flags and save it as a file
-    with open("configs/kernel.flags", "r") as flags:
-        temp = flags.read().replace("${USB_ROOTFS}", rootfs_partuuid).strip()
-    with open("kernel.flags", "w") as config:
-        config.write(temp)
+    rootfs_partuuid = runner.run(["blkid", "-o", "value", "-s", "PARTUUID", rootfs_mnt], capture=True)
 
     print_status("Flashing kernel to device/image")
-    # Sign kernel
-    bash("futility vbutil_kernel --arch x86_64 --version 1 --keyblock /usr/share/vboot/devkeys/kernel.keyblock"
-         + " --signprivate /usr/share/vboot/devkeys/kernel_data_key.vbprivk --bootloader kernel.flags" +
-         " --config kernel.flags --vmlinuz /tmp/eupnea-build/bzImage --pack /tmp/eupnea-build/bzImage.signed")
+    sign_kernel(rootfs_partuuid)
 
     # Flash kernel
     if write_usb:
         # if writing to usb, then no p in partition name
-        bash(f"dd if=/tmp/eupnea-build/bzImage.signed of={mnt_point}1")
+        runner.run(["dd", "if=/tmp/eupnea-build/bzImage.signed", f"of={mnt_point}1"])
     else:
         # image is a loop device -> needs p in part name
-        bash(f"dd if=/tmp/eupnea-build/bzImage.signed of={mnt_point}p1")
+        runner.run(["dd", "if=/tmp/eupnea-build/bzImage.signed", f"of={mnt_point}p1"])
 
     print_status("Creating rootfs part")
     # Create rootfs ext4 partition
-    bash(f"yes 2>/dev/null | mkfs.ext4 {rootfs_mnt}")  # 2>/dev/null is to supress yes broken pipe warning
+    runner.run(["mkfs.ext4", "-F", rootfs_mnt])  # -F: don't ask before overwriting an old filesystem
 
     # Mount rootfs partition
-    bash(f"mount {rootfs_mnt} /mnt/eupnea")
+    runner.run(["mount", rootfs_mnt, "/mnt/eupnea"])
 
     print_status("Device/image preparation complete")
     return mnt_point, rootfs_partuuid  # return loop device, so it can be unmounted at the end
 
 
+# Prepare an image that is assembled at the end of the build(--staged). The rootfs is built in a staging directory next
+# to the image instead of on a loop device, it's bind mounted to /mnt/eupnea as the chroot session needs a mount point
+def prepare_staging() -> Tuple[str, str]:
+    print_status("Preparing staging directory")
+    mkdir(f"{img_path}.staging", create_parents=True)
+    runner.run(["mount", "--bind", f"{img_path}.staging", "/mnt/eupnea"])
+    # the partition is created at the end of the build, so its PARTUUID is chosen here
+    rootfs_partuuid = str(uuid.uuid4())
+    sign_kernel(rootfs_partuuid)
+    return "staging", rootfs_partuuid
+
+
+# Sign the kernel with the kernel flags for the rootfs partition, saved as /tmp/eupnea-build/bzImage.signed
+def sign_kernel(rootfs_partuuid: str) -> None:
+    # write PARTUUID to kernel flags and save it as a file
+    with open("configs/kernel.flags", "r") as flags:
+        temp = flags.read().replace("${USB_ROOTFS}", rootfs_partuuid).strip()
+    with open("/tmp/eupnea-build/kernel.flags", "w") as config:
+        config.write(temp)
+
+    runner.run(["futility", "vbutil_kernel", "--arch", "x86_64", "--version", "1",
+                "--keyblock", "/usr/share/vboot/devkeys/kernel.keyblock",
+                "--signprivate", "/usr/share/vboot/devkeys/kernel_data_key.vbprivk",
+                "--bootloader", "/tmp/eupnea-build/kernel.flags", "--config", "/tmp/eupnea-build/kernel.flags",
+                "--vmlinuz", get_build_path("bzImage"), "--pack", "/tmp/eupnea-build/bzImage.signed"])
+
+
 # extract the rootfs to /mnt/eupnea
 def extract_rootfs(distro_name: str) -> None:
     print_status("Extracting rootfs")
     match distro_name:
         case "ubuntu":
             print_status("Extracting ubuntu rootfs")
-            # --checkpoint is for printing real tar progress
-            bash("tar xfp /tmp/eupnea-build/ubuntu-rootfs.tar.xz -C /mnt/eupnea --checkpoint=.10000")
+            extract_build_file("ubuntu-rootfs.tar.xz", "/mnt/eupnea")
+        case "debian" if "debian" in local_files:
+            print_status("Copying pre-debootstrapped rootfs to /mnt/eupnea")
+            file_ops.cpdir(local_files["debian"], "/mnt/eupnea")
         case "debian":
             print_status("Debootstraping into /mnt/eupnea")
-            start_progress()  # start fake progress
+            progress.start_progress()  # start fake progress
             # debootstrapping directly to /mnt/eupnea
-            debian_result = bash(
-                "debootstrap stable /mnt/eupnea https://deb.debian.org/debian/")
-            stop_progress()  # stop fake progress
+            debian_result = runner.run(["debootstrap", "stable", "/mnt/eupnea", "https://deb.debian.org/debian/"],
+                                       capture=True)
+            progress.stop_progress()  # stop fake progress
             if debian_result.__contains__("Couldn't download packages:"):
                 print_error("Debootstrap failed, check your internet connection or try again later")
                 exit(1)
         case "arch":
             print_status("Extracting arch rootfs")
-            mkdir("/tmp/eupnea-build/arch-rootfs")
-            bash("tar xfp /tmp/eupnea-build/arch-rootfs.tar.gz -C /tmp/eupnea-build/arch-rootfs --checkpoint=.10000")
-            start_progress(force_show=True)  # start fake progress
-            cpdir("/tmp/eupnea-build/arch-rootfs/root.x86_64/", "/mnt/eupnea/")
-            stop_progress(force_show=True)  # stop fake progress
+            # the rootfs is in root.x86_64/ inside the tarball -> extract only that dir directly to /mnt/eupnea
+            extract_build_file("arch-rootfs.tar.gz", "/mnt/eupnea", strip_components=1, members=["root.x86_64"])
         case "fedora":
             print_status("Extracting fedora rootfs")
-            # extract raw image to temp location
-            mkdir("/tmp/eupnea-build/fedora-tmp-mnt")
-            # using unxz instead of tar
-            bash("unxz -d /tmp/eupnea-build/fedora-rootfs.raw.xz -c > /tmp/eupnea-build/fedora-raw")
+            # Only write the rootfs partition(part 5) out of the compressed disk image. Empty space is skipped, so the
+            # partition image only takes up as much space as the files in it
+            try:
+                chunks = archive.decompress_chunks(get_build_file("fedora-rootfs.raw.xz", as_chunks=True), "xz")
+                archive.extract_partition(chunks, 5, "/tmp/eupnea-build/fedora-root.img")
+            except (OSError, http.client.HTTPException) as err:
+                if "fedora-rootfs.raw.xz" not in stream_urls:  # reading a downloaded or local file failed
+                    raise
+                print_error(f"Couldn't download {stream_urls['fedora-rootfs.raw.xz']} ({err}). Check your internet "
+                            "connection and try again")
+                exit(1)
+            except (ValueError, lzma.LZMAError) as err:
+                print_error(f"Fedora image is damaged: {err}. Delete the download cache and try again")
+                exit(1)
 
-            # mount fedora raw image as loop device
-            fedora_root_part = bash("losetup -P -f --show /tmp/eupnea-build/fedora-raw") + "p5"  # part 5 is the rootfs
-            bash(f"mount {fedora_root_part} /tmp/eupnea-build/fedora-tmp-mnt")  # mount 5th root partition as filesystem
+            # mount fedora rootfs partition as loop device
+            mkdir("/tmp/eupnea-build/fedora-tmp-mnt")
+            fedora_root_part = runner.run(["losetup", "-f", "--show", "-r", "/tmp/eupnea-build/fedora-root.img"],
+                                          capture=True)
+            runner.run(["mount", "-o", "ro", fedora_root_part, "/tmp/eupnea-build/fedora-tmp-mnt"])
             print_status("Copying fedora rootfs to /mnt/eupnea")
-            cpdir("/tmp/eupnea-build/fedora-tmp-mnt/root/", "/mnt/eupnea/")  # copy mounted rootfs to /mnt/eupnea
+            # copy mounted rootfs to /mnt/eupnea
+            file_ops.cpdir("/tmp/eupnea-build/fedora-tmp-mnt/root/", "/mnt/eupnea/")
 
             # unmount fedora image to prevent errors and unused loop devices
             try:
-                bash(f"umount -fl /tmp/eupnea-build/fedora-tmp-mnt")
+                runner.run(["umount", "-fl", "/tmp/eupnea-build/fedora-tmp-mnt"])
             except subprocess.CalledProcessError:  # fails on Crostini
                 pass
-            bash(f"losetup -d {fedora_root_part[:-2]}")
+            runner.run(["losetup", "-d", fedora_root_part])
     print_status("\n" + "Rootfs extraction complete")
 
 
-# Configure distro agnostic options
-def post_extract(username: str, password: str, hostname: str, distro_name: str, de_name: str, kernel_type: str) -> None:
+# Configure distro agnostic options. User specific options are set in configure_user(), after the rootfs snapshot
+def post_extract(kernel_type: str) -> None:
     print_status("Applying distro agnostic configuration")
 
     # Extract kernel modules
-    rmdir("/mnt/eupnea/lib/modules/")  # delete old modules, if present
+    file_ops.rmdir("/mnt/eupnea/lib/modules/")  # delete old modules, if present
     # modules.tar.xz contains /lib/modules, so it's extracted to / and --skip-old-files is used to prevent it from
     # overwriting other files in /lib
-    bash("tar xpf /tmp/eupnea-build/modules.tar.xz --skip-old-files -C /mnt/eupnea/ --checkpoint=.10000")
-    print("")  # break line after tar
+    extract_build_file("modules.tar.xz", "/mnt/eupnea/", skip_old_files=True)
 
     # Extract kernel headers
     print_status("Extracting kernel headers")
     # headers.tar.xz contains /include, so it's extracted to /usr/ and --skip-old-files is used to prevent it from
     # overwriting other files in /usr/include
-    bash("tar xpf /tmp/eupnea-build/headers.tar.xz --skip-old-files -C /mnt/eupnea/usr/ --checkpoint=.10000")
-    print("")  # break line after tar
+    extract_build_file("headers.tar.xz", "/mnt/eupnea/usr/", skip_old_files=True)
 
     # Copy resolv.conf from host to eupnea
     rmfile("/mnt/eupnea/etc/resolv.conf", True)  # delete broken symlink
-    cpfile("/etc/resolv.conf", "/mnt/eupnea/etc/resolv.conf")
-
-    # Set device hostname
-    with open("/mnt/eupnea/etc/hostname", "w") as hostname_file:
-        hostname_file.write(hostname)
+    file_ops.cpfile("/etc/resolv.conf", "/mnt/eupnea/etc/resolv.conf")
 
     # Copy eupnea scripts and config
     print_status("Copying eupnea scripts and configs")
@@ -354,18 +636,19 @@ def post_extract(username: str, password: str, hostname: str, distro_name: str,
             if file.name == "LICENSE" or file.name == "README.md" or file.name == ".gitignore":
                 continue  # dont copy license, readme and gitignore
             else:
-                cpfile(file.absolute().as_posix(), f"/mnt/eupnea/usr/local/bin/{file.name}")
+                file_ops.cpfile(file.absolute().as_posix(), f"/mnt/eupnea/usr/local/bin/{file.name}")
     # copy audio setup script
-    cpfile("/tmp/eupnea-build/audio-scripts/setup-audio", "/mnt/eupnea/usr/local/bin/setup-audio")
+    file_ops.cpfile("/tmp/eupnea-build/audio-scripts/setup-audio", "/mnt/eupnea/usr/local/bin/setup-audio")
     chroot("chmod 755 /usr/local/bin/*")  # make scripts executable in system
     # copy functions file
-    cpfile("functions.py", "/mnt/eupnea/usr/local/bin/functions.py")
+    file_ops.cpfile("functions.py", "/mnt/eupnea/usr/local/bin/functions.py")
 
     # copy configs
     mkdir("/mnt/eupnea/usr/local/eupnea-configs")
-    cpdir("configs", "/mnt/eupnea/usr/local/eupnea-configs")  # installer configs
-    cpdir("/tmp/eupnea-build/postinstall-scripts/configs", "/mnt/eupnea/usr/local/eupnea-configs")  # installer configs
-    cpdir("/tmp/eupnea-build/audio-scripts/configs", "/mnt/eupnea/usr/local/eupnea-configs")  # installer configs
+    # installer configs
+    file_ops.cpdir("configs", "/mnt/eupnea/usr/local/eupnea-configs")
+    file_ops.cpdir("/tmp/eupnea-build/postinstall-scripts/configs", "/mnt/eupnea/usr/local/eupnea-configs")
+    file_ops.cpdir("/tmp/eupnea-build/audio-scripts/configs", "/mnt/eupnea/usr/local/eupnea-configs")
 
     # create eupnea settings file for postinstall scripts to read
     with open("configs/eupnea-settings.json", "r") as settings_file:
@@ -382,7 +665,7 @@ def post_extract(username: str, password: str, hostname: str, distro_name: str,
         conf.write("SuspendState=freeze\nHibernateState=freeze\n")
 
     # Enable loading modules needed for eupnea
-    cpfile("configs/eupnea-modules.conf", "/mnt/eupnea/etc/modules-load.d/eupnea-modules.conf")
+    file_ops.cpfile("configs/eupnea-modules.conf", "/mnt/eupnea/etc/modules-load.d/eupnea-modules.conf")
 
     # TODO: Fix failing services
     # The services below fail to start, so they are disabled
@@ -391,139 +674,247 @@ def post_extract(username: str, password: str, hostname: str, distro_name: str,
     rmfile("/mnt/eupnea/etc/systemd/system/multi-user.target.wants/ssh.service")
     rmfile("/mnt/eupnea/etc/systemd/system/sshd.service")
 
-    # Gnome has a first time setup if no users are detected
-    if not de_name == "gnome":
-        print_status("Configuring user")
-        chroot(f"useradd --create-home --shell /bin/bash {username}")
-        # TODO: Fix ) and ( crashing chpasswd
-        chroot(f'echo "{username}:{password}" | chpasswd')
-        match distro_name:
-            case "ubuntu" | "debian":
-                chroot(f"usermod -aG sudo {username}")
-            case "arch" | "fedora":
-                chroot(f"usermod -aG wheel {username}")
-
     print_status("Distro agnostic configuration complete")
 
 
 # post extract and distro config
-def post_config(rebind_search: bool) -> None:
+def post_config(firmware_profile: str) -> None:
     # Add chromebook layout. Needs to be done after install Xorg
     print_status("Backing up default keymap and setting Chromebook layout")
-    cpfile("/mnt/eupnea/usr/share/X11/xkb/symbols/pc", "/mnt/eupnea/usr/share/X11/xkb/symbols/pc.default")
-    cpfile("configs/xkb/xkb.chromebook", "/mnt/eupnea/usr/share/X11/xkb/symbols/pc")
-    if rebind_search:  # rebind search key to caps lock
-        print("Rebinding search key to Caps Lock")
-        cpfile("/mnt/eupnea/usr/share/X11/xkb/keycodes/evdev", "/mnt/eupnea/usr/share/X11/xkb/keycodes/evdev.default")
+    file_ops.cpfile("/mnt/eupnea/usr/share/X11/xkb/symbols/pc", "/mnt/eupnea/usr/share/X11/xkb/symbols/pc.default")
+    file_ops.cpfile("configs/xkb/xkb.chromebook", "/mnt/eupnea/usr/share/X11/xkb/symbols/pc")
 
     # Add postinstall service
     print_status("Adding postinstall service")
-    cpfile("configs/postinstall.service", "/mnt/eupnea/etc/systemd/system/postinstall.service")
+    file_ops.cpfile("configs/postinstall.service", "/mnt/eupnea/etc/systemd/system/postinstall.service")
     chroot("systemctl enable postinstall.service")
 
     # copy previously downloaded firmware
-    print_status("Copying google firmware")
-    rmdir("/mnt/eupnea/lib/firmware")
-    start_progress(force_show=True)  # start fake progress
-    cpdir("/tmp/eupnea-build/firmware", "/mnt/eupnea/lib/firmware")
-    stop_progress(force_show=True)  # stop fake progress
+    file_ops.rmdir("/mnt/eupnea/lib/firmware")
+    progress.start_progress(force_show=True)  # start fake progress
+    if firmware_profile == "all":
+        print_status("Copying google firmware")
+        file_ops.cpdir(get_build_path("firmware"), "/mnt/eupnea/lib/firmware")
+    else:
+        print_status(f"Installing google firmware for the kernel modules(profile: {firmware_profile})")
+        files, links = firmware.prepare(get_build_path("firmware"), "/mnt/eupnea/lib/modules", firmware_profile)
+        firmware.install(get_build_path("firmware"), "/mnt/eupnea/lib/firmware", files, links)
+        print_status(f"Installed {len(files)} firmware files")
+    progress.stop_progress(force_show=True)  # stop fake progress
+
+
+# Apply the user specific options. These are not part of the rootfs snapshot, so that it can be reused for other users
+def configure_user(username: str, password: str, hostname: str, distro_name: str, de_name: str,
+                   rebind_search: bool) -> None:
+    # Set device hostname
+    with open("/mnt/eupnea/etc/hostname", "w") as hostname_file:
+        hostname_file.write(hostname)
+
+    if rebind_search:  # rebind search key to caps lock
+        print("Rebinding search key to Caps Lock")
+        file_ops.cpfile("/mnt/eupnea/usr/share/X11/xkb/keycodes/evdev",
+                        "/mnt/eupnea/usr/share/X11/xkb/keycodes/evdev.default")
+
+    # Gnome has a first time setup if no users are detected
+    if not de_name == "gnome":
+        print_status("Configuring user")
+        chroot(f"useradd --create-home --shell /bin/bash {username}")
+        # the password is passed on stdin, so it never appears in a command line or the build log
+        chroot_session.run_command("chpasswd", input_text=f"{username}:{password}\n")
+        match distro_name:
+            case "ubuntu" | "debian":
+                chroot(f"usermod -aG sudo {username}")
+            case "arch" | "fedora":
+                chroot(f"usermod -aG wheel {username}")
 
 
 # chroot command
-def chroot(command: str) -> str:
-    return bash(f'chroot /mnt/eupnea /bin/sh -c "{command}"')
+def chroot(command: str) -> None:
+    chroot_session.run_command(command)
 
 
 # The main build script
 def start_build(verbose: bool, local_path: str, kernel_type: str, dev_release: bool, user_id: str,
-                build_options):
+                build_options, stream: bool = False, img_headroom: int = 512 * 1048576, use_snapshots: bool = True,
+                resume: bool = False, new_img_path: str = "eupnea.img", firmware_profile: str = "kernel",
+                staged: bool = False):
+    global img_path
+    img_path = new_img_path
     set_verbose(verbose)
     print_status("Starting build")
-
-    prepare_host(build_options["distro_name"], user_id)
-
-    # Download files first
-    if local_path is None:
-        download_kernel(kernel_type, dev_release)
-        download_rootfs(build_options["distro_name"], build_options["distro_version"], build_options["distro_link"])
-        download_firmware()
-        download_postinstall_scripts()
-        download_audio_scripts()
-    else:  # if local path is specified, copy files from it, instead of downloading from the internet
-        # clean local path string
-        if not local_path.endswith("/"):
-            local_path_posix = f"{local_path}/"
-        else:
-            local_path_posix = local_path
-
-        print_status("Copying local files to /tmp/eupnea-build")
-        try:
-            cpfile(f"{local_path_posix}bzImage", "/tmp/eupnea-build/bzImage")
-            cpfile(f"{local_path_posix}modules.tar.xz", "/tmp/eupnea-build/modules.tar.xz")
-            cpfile(f"{local_path_posix}headers.tar.xz", "/tmp/eupnea-update/headers.tar.xz")
-            cpdir(f"{local_path_posix}firmware", "/mnt/eupnea/lib/firmware/google")
-            match build_options["distro_name"]:
-                case "ubuntu":
-                    cpfile(f"{local_path_posix}ubuntu-rootfs.tar.xz", "/tmp/eupnea-build/ubuntu-rootfs.tar.xz")
-                case "debian":
-                    cpdir(f"{local_path_posix}debian", "/tmp/eupnea-build/debian")
-                case "arch":
-                    cpfile(f"{local_path_posix}arch-rootfs.tar.gz", "/tmp/eupnea-build/arch-rootfs.tar.gz")
-                case "fedora":
-                    cpfile(f"{local_path_posix}fedora-rootfs.raw.xz", "/tmp/eupnea-build/fedora-rootfs.raw.xz")
-                case _:
-                    print_error("Distro name not found, please create an issue")
-                    exit(1)
-        except FileNotFoundError:
-            print_error("A file could not be found. Verify all file names are correct (use --help to see correct names")
-            exit(1)
+    if staged and build_options["device"] != "image":
+        print_warning("--staged only works for images, writing to the USB-drive/SD-card directly")
+        staged = False
+
+    # Every stage is checkpointed. With resume, stages that were completed with the same inputs are skipped.
+    # The stages are listed in the order they are completed: the downloads finish after the device was partitioned, the
+    # partition stage only needs the kernel(signed into the kernel partition)
+    stages = [
+        ("host", [build_options["distro_name"], user_id]),
+        ("partition", [build_options["device"], build_options["de_name"], staged, kernel_type, dev_release,
+                       local_path]),
+        ("downloads", [kernel_type, dev_release, build_options["distro_name"], build_options["distro_version"],
+                       build_options["distro_link"], local_path, stream, firmware_profile]),
+        ("extract_rootfs", [use_snapshots]),
+        ("post_extract", []),
+        ("distro_config", [build_options["de_name"], build_options["distro_version"]]),
+        ("post_config", [firmware_profile]),
+        # the password is left out, the hashes are saved in the checkpoint file and a hash of a password can be cracked
+        ("configure_user", [build_options["username"], build_options["hostname"], build_options["rebind_search"]])
+    ]
+    if not checkpoint.start(stages, resume) and resume:
+        print_warning("No build to resume, starting from scratch")
+
+    timing.redact(build_options["password"])
+
+    if not checkpoint.is_done("host"):
+        with timing.stage("host"):
+            prepare_host(build_options["distro_name"], user_id)
+        checkpoint.complete("host")
+
+    # Start downloading all files in the background. Only the kernel is needed to prepare the device, everything else
+    # is downloaded while the device/image is being partitioned
+    downloads = None
+    if local_path is not None:  # if local path is specified, read the files from it directly
+        print_status(f"Using local files from {local_path}")
+        use_local_files(local_path, build_options["distro_name"])
+    elif not checkpoint.is_done("downloads"):
+        with timing.stage("downloads(kernel)"):
+            downloads = start_downloads(kernel_type, dev_release, build_options["distro_name"],
+                                        build_options["distro_version"], build_options["distro_link"], stream,
+                                        firmware_profile)
+            wait_downloads(downloads, ["bzImage"])
+    elif stream:
+        set_stream_urls(kernel_type, dev_release, build_options["distro_name"], build_options["distro_version"],
+                        build_options["distro_link"])
 
     # Setup device
-    if build_options["device"] == "image":
-        output_temp = prepare_img()
-        img_mnt = output_temp[0]
-        root_partuuid = output_temp[1]
+    if not checkpoint.is_done("partition"):
+        with timing.stage("partition"):
+            if staged:
+                img_mnt, root_partuuid = prepare_staging()
+            elif build_options["device"] == "image":
+                img_mnt, root_partuuid = prepare_img(estimate_img_size(build_options["distro_name"],
+                                                                       build_options["de_name"], firmware_profile))
+            else:
+                img_mnt, root_partuuid = prepare_usb(build_options["device"])
+        checkpoint.complete("partition", img_mnt=img_mnt, root_partuuid=root_partuuid)
     else:
-        output_temp = prepare_usb(build_options["device"])
-        img_mnt = output_temp[0]
-        root_partuuid = output_temp[1]
+        img_mnt = reattach_device(build_options["device"], checkpoint.get("img_mnt"))
+        root_partuuid = checkpoint.get("root_partuuid")
+
+    if downloads is not None:
+        print_status("Waiting for downloads to finish")
+        rootfs = get_rootfs_url(build_options["distro_name"], build_options["distro_version"],
+                                build_options["distro_link"])
+        if "rootfs" not in downloads:
+            progress.start_progress()  # start fake progress
+        else:
+            progress.start_download_progress(f"/tmp/eupnea-build/{rootfs[1]}")
+        with timing.stage("downloads"):
+            wait_downloads(downloads)
+        if "rootfs" not in downloads:
+            progress.stop_progress()  # stop fake progress
+        else:
+            progress.stop_download_progress()
+        print_status("All files downloaded successfully")
+    checkpoint.complete("downloads")
+
+    # Restore the configured rootfs of a previous build with the same distro, DE and kernel, if possible.
+    # Local files are not tracked, so snapshots are only used with downloaded files
+    snapshot_key = None
+    if use_snapshots and local_path is None and cache.enabled:
+        snapshot_key = snapshot.get_key(build_options["distro_name"], build_options["distro_version"],
+                                        build_options["distro_link"], build_options["de_name"], kernel_type,
+                                        firmware_profile, get_build_path("bzImage"))
+    if not checkpoint.is_done("extract_rootfs") and snapshot_key is not None:
+        with timing.stage("restore_snapshot"):
+            restored = snapshot.restore(snapshot_key, root_partuuid)
+    else:
+        restored = False
+    if restored:
+        for stage in ["extract_rootfs", "post_extract", "distro_config", "post_config"]:
+            checkpoint.complete(stage)
 
     # Extract rootfs and configure distro agnostic settings
-    extract_rootfs(build_options["distro_name"])
-    post_extract(build_options["username"], build_options["password"], build_options["hostname"],
-                 build_options["distro_name"], build_options["de_name"], kernel_type)
-
-    match build_options["distro_name"]:
-        case "ubuntu":
-            import distro.ubuntu as distro
-        case "debian":
-            import distro.debian as distro
-        case "arch":
-            import distro.arch as distro
-        case "fedora":
-            import distro.fedora as distro
-        case _:
-            # Just in case
-            print_error("DISTRO NAME NOT FOUND! Please create an issue")
-            exit(1)
-    distro.config(build_options["de_name"], build_options["distro_version"], root_partuuid, verbose)
-
-    post_config(build_options["rebind_search"])
+    if not checkpoint.is_done("extract_rootfs"):
+        with timing.stage("extract_rootfs"):
+            extract_rootfs(build_options["distro_name"])
+        checkpoint.complete("extract_rootfs")
+    if not checkpoint.is_done("post_extract"):
+        with timing.stage("post_extract"):
+            post_extract(kernel_type)
+        checkpoint.complete("post_extract")
+
+    if not checkpoint.is_done("distro_config"):
+        match build_options["distro_name"]:
+            case "ubuntu":
+                import distro.ubuntu as distro
+            case "debian":
+                import distro.debian as distro
+            case "arch":
+                import distro.arch as distro
+            case "fedora":
+                import distro.fedora as distro
+            case _:
+                # Just in case
+                print_error("DISTRO NAME NOT FOUND! Please create an issue")
+                exit(1)
+        with timing.stage("distro_config"):
+            distro.config(build_options["de_name"], build_options["distro_version"], root_partuuid, verbose)
+        checkpoint.complete("distro_config")
+
+    if not checkpoint.is_done("post_config"):
+        with timing.stage("post_config"):
+            post_config(firmware_profile)
+        if snapshot_key is not None:
+            with timing.stage("create_snapshot"):
+                snapshot.create(snapshot_key, root_partuuid)
+        checkpoint.complete("post_config")
+
+    if not checkpoint.is_done("configure_user"):
+        with timing.stage("configure_user"):
+            configure_user(build_options["username"], build_options["password"], build_options["hostname"],
+                           build_options["distro_name"], build_options["de_name"], build_options["rebind_search"])
+        checkpoint.complete("configure_user")
 
     # Post-install cleanup
     print_status("Cleaning up host system after build")
+    chroot_session.stop()
     try:
-        bash("umount -f /mnt/eupnea")
+        runner.run(["umount", "-R", "-f", "/mnt/eupnea"])  # -R: also unmount anything still mounted inside the rootfs
     except subprocess.CalledProcessError:  # on crostini umount fails for some reason
         pass
+    if staged:
+        with timing.stage("assemble_img"):
+            assemble_img(root_partuuid, img_headroom)
+    elif build_options["device"] == "image":
+        with timing.stage("shrink_img"):
+            shrink_img(img_mnt, img_headroom)
     if build_options["device"] == "image":
-        bash(f"losetup -d {img_mnt}")
-        print_header(f"The ready-to-boot Eupnea image is located at {get_full_path('.')}/eupnea.img")
+        with timing.stage("bmap"):
+            bmap.create_bmap(img_path)
+        print_header(f"The ready-to-boot Eupnea image is located at {get_full_path(img_path)}")
+        print_header(f"Use ./main.py --flash {img_path} <device> to quickly write it to a USB-drive/SD-card")
     else:
         print_header("USB/SD-card is ready to boot Eupnea")
         print_header("It is safe to remove the USB-drive/SD-card now.")
+    checkpoint.clear()  # the build is complete, nothing to resume
+    cache.print_report()
     print_header("Thank you for using Eupnea!")
 
 
+# Do not call this function directly
+# Copy size bytes from src_offset in src to dst_offset in dst. copy_file_range can share the blocks on btrfs/xfs
+def __copy_range(src, dst, src_offset: int, dst_offset: int, size: int) -> None:
+    while size > 0:
+        copied = os.copy_file_range(src.fileno(), dst.fileno(), size, src_offset, dst_offset)
+        if copied == 0:
+            raise OSError(f"Unexpected end of {src.name}")
+        src_offset += copied
+        dst_offset += copied
+        size -= copied
+
+
 if __name__ == "__main__":
     print_error("Do not run this file directly. Instead, run main.py")
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# Persistent cache for downloaded build files.
+# Files are stored content-addressed by their sha256 in <cache_dir>/objects. index.json maps every url to its object
+# and the ETag/Last-Modified headers it was downloaded with, so later downloads can be skipped with a conditional
+# request. Interrupted downloads are continued, see downloader.py. When the cache grows over max_size, the least
+# recently used objects are removed.
+# Files made by the builder itself(e.g. rootfs snapshots) are stored the same way, under a key instead of a url.
+# Git repos are kept as shallow bare mirrors in <cache_dir>/repos and updated with an incremental fetch, which only
+# transfers new commits. Builds get a repo that borrows the objects of the mirror(objects/info/alternates) instead of a
+# new clone. Mirrors are not counted in max_size.
+# Several builds can share the cache at the same time(see batch.py), so the index is locked with flock and re-read on
+# every access.
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import subprocess
+import http.client
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import time
+from urllib.request import Request, urlopen
+from urllib.error import URLError, HTTPError
+
+from functions import *
+import runner
+import downloader
+import progress
+import file_ops
+
+cache_dir = Path.home().joinpath(".cache/eupnea-builder")
+enabled = True
+max_size = 20 * 1024 ** 3  # 20GB
+mirror_ref = "refs/heads/eupnea-build"  # the fetched commit in a repo mirror
+hits = []
+misses = []
+
+_index_lock = Lock()
+
+
+def configure(new_cache_dir: str = None, new_state: bool = True, new_max_size: int = None) -> None:
+    global cache_dir, enabled, max_size
+    if new_cache_dir is not None:
+        cache_dir = Path(new_cache_dir).absolute()
+    if new_max_size is not None:
+        max_size = new_max_size
+    enabled = new_state
+
+
+# Download url to path, using the cache if possible. Interrupted downloads are continued on the next fetch
+def fetch(url: str, path: str) -> None:
+    if not enabled:
+        downloader.download(url, path)
+        return
+
+    # another build that downloads the same url at the same time waits, and then gets the file from the cache
+    with _lock_download(url):
+        with _lock_index():
+            entry = _get_index().get(url)
+        if entry is not None and not _object_path(entry["sha256"]).exists():
+            entry = None  # object was removed from disk
+
+        # the download has a fixed name, so that an interrupted download can be continued
+        tmp_path = cache_dir.joinpath("objects", f".download-{_hash_url(url)}").as_posix()
+        try:
+            headers = downloader.download(url, tmp_path, entry and entry["etag"], entry and entry["last_modified"],
+                                          progress_path=path)
+        except HTTPError:
+            raise
+        except URLError:
+            if entry is None:
+                raise
+            print_warning(f"Couldn't reach {url}, using cached file")
+            headers = None
+
+        if headers is None:  # cached file is still up-to-date
+            _record_hit(url, entry)
+            progress.set_download_progress(path, entry["size"], entry["size"])
+        else:
+            _add_entry(url, _add_object(tmp_path), headers["etag"], headers["last_modified"])
+        with _lock_index():  # another build could evict the object while it's being linked
+            _link_object(_get_index()[url]["sha256"], path)
+
+
+# Get repo_url at path, from its mirror if possible. With partial, only the commit and file list are downloaded and
+# nothing is checked out, see fetch_repo_files()
+def fetch_repo(repo_url: str, path: str, partial: bool = False) -> None:
+    filter_args = ["--filter=blob:none"] if partial else []
+    if not enabled:
+        runner.run(["git", "clone", "--depth=1", *filter_args, *(["--no-checkout"] if partial else []), repo_url, path])
+        return
+
+    mirror = _repo_path(repo_url)
+    with _lock_download(repo_url):
+        if not mirror.joinpath("HEAD").exists():
+            if mirror.exists():  # broken mirror
+                file_ops.rmdir(mirror.as_posix())
+            runner.run(["git", "init", "-q", "--bare", mirror.as_posix()])
+            runner.run(["git", "-C", mirror.as_posix(), "remote", "add", "origin", repo_url])
+            if partial:
+                _set_promisor(mirror.as_posix())
+        old_commit = _get_commit(mirror.as_posix())
+        old_size = _get_repo_size(mirror)
+        try:
+            runner.run(["git", "-C", mirror.as_posix(), "fetch", "-q", "--depth=1", "--no-tags", *filter_args, "origin",
+                        f"+HEAD:{mirror_ref}"])
+        except subprocess.CalledProcessError:
+            if old_commit is None:
+                raise
+            print_warning(f"Couldn't reach {repo_url}, using cached repo")
+        commit = _get_commit(mirror.as_posix())
+        if commit == old_commit:
+            hits.append((repo_url, old_size))
+        else:
+            misses.append((repo_url, _get_repo_size(mirror) - old_size))
+
+    # a repo without objects of its own, the commit and files are read from the mirror
+    if path_exists(path):
+        file_ops.rmdir(path)
+    runner.run(["git", "init", "-q", path])
+    with open(f"{path}/.git/objects/info/alternates", "w") as file:
+        file.write(mirror.joinpath("objects").as_posix() + "\n")
+    with open(f"{path}/.git/shallow", "w") as file:
+        file.write(commit + "\n")
+    runner.run(["git", "-C", path, "update-ref", "HEAD", commit])
+    runner.run(["git", "-C", path, "remote", "add", "origin", repo_url])
+    # a mirror created by a partial fetch stays partial, also for builds that need all files
+    if _is_promisor(mirror.as_posix()):
+        _set_promisor(path)  # files that are not in the mirror are downloaded by git checkout
+        if not partial:
+            fetch_repo_files(path, set(runner.run(["git", "-C", path, "ls-tree", "-r", "--name-only", "HEAD"],
+                                                  capture=True).splitlines()))
+    if not partial:
+        runner.run(["git", "-C", path, "checkout", "-q"])
+        # checkout succeeds even if files are missing from the mirror
+        missing = runner.run(["git", "-C", path, "ls-files", "--deleted"], capture=True)
+        if missing:
+            raise subprocess.CalledProcessError(1, f"git -C {path} checkout",
+                                                f"Files missing after checkout:\n{missing}\n")
+
+
+# Download files(paths relative to the repo) of a partial repo from fetch_repo() into its mirror, so that later builds
+# don't download them again. Does nothing for other repos
+def fetch_repo_files(path: str, files: set) -> None:
+    alternates = Path(path, ".git/objects/info/alternates")
+    if not alternates.exists():
+        return
+    mirror = Path(alternates.read_text().strip()).parent.as_posix()
+    wanted = set()
+    for line in runner.run(["git", "-C", path, "ls-tree", "-r", "HEAD"], capture=True).splitlines():
+        info, file = line.split("\t", 1)
+        if file in files:
+            wanted.add(info.split()[2])
+    # rev-list prints objects that are not downloaded yet as ?<object id>, without downloading them
+    rev_list = runner.run(["git", "-C", mirror, "rev-list", "--objects", "--missing=print", mirror_ref], capture=True)
+    missing = [line[1:] for line in rev_list.splitlines() if line.startswith("?") and line[1:] in wanted]
+    if not missing:
+        return
+    repo_url = runner.run(["git", "-C", mirror, "config", "remote.origin.url"], capture=True)
+    old_size = _get_repo_size(Path(mirror))
+    with _lock_download(repo_url):
+        # the same fetch git runs for missing objects of a partial clone
+        runner.run(["git", "-C", mirror, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "-q", "--no-tags",
+                    "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin", "origin"],
+                   input_text="\n".join(missing) + "\n")
+    misses.append((repo_url, _get_repo_size(Path(mirror)) - old_size))
+
+
+# Read url in chunks, e.g. to extract it while it's still downloading. The file is saved to the cache at the same time
+def stream(url: str, chunk_size: int = 1048576):
+    if not enabled:
+        with urlopen(url) as response:
+            received = 0
+            while chunk := response.read(chunk_size):
+                received += len(chunk)
+                yield chunk
+            _check_length(response, received)
+        return
+
+    response, entry = _request(url)
+    if response is None:  # cached file is still up-to-date
+        # the object could be evicted before it's opened. Once it's open, it can be read even if it's removed
+        with _lock_index():
+            try:
+                file = open(_object_path(entry["sha256"]), "rb")
+            except FileNotFoundError:
+                file = None
+        if file is not None:
+            _record_hit(url, entry)
+            with file:
+                while chunk := file.read(chunk_size):
+                    yield chunk
+            return
+        response, _ = _request(url, use_cache=False)
+    yield from _download(url, response, chunk_size)
+
+
+# Get the path and metadata of a file stored with add_file(). Returns None if it's not in the cache
+def lookup(key: str) -> tuple | None:
+    if not enabled:
+        return None
+    with _lock_index():
+        entry = _get_index().get(key)
+    if entry is None or not _object_path(entry["sha256"]).exists():
+        return None
+    _record_hit(key, entry)
+    return _object_path(entry["sha256"]), entry.get("metadata", {})
+
+
+# Get a temporary path inside the cache, for files that will be added with add_file() later. Files created there can be
+# moved into the cache without copying
+def get_tmp_path(name: str) -> Path:
+    objects_dir = cache_dir.joinpath("objects")
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    return objects_dir.joinpath(f".tmp-{os.getpid()}-{name}")
+
+
+# Move a file into the cache and store it under key. metadata is returned by lookup()
+def add_file(key: str, path: str, metadata: dict = None) -> None:
+    _add_entry(key, _add_object(path), None, None, metadata)
+
+
+# Print how many files were served from the cache
+def print_report() -> None:
+    if not enabled:
+        return
+    hit_size = sum(size for _, size in hits) / 1048576
+    miss_size = sum(size for _, size in misses) / 1048576
+    print_status(f"Download cache: {len(hits)} hits ({hit_size:.0f}mb), {len(misses)} misses ({miss_size:.0f}mb)")
+    for url, _ in misses:
+        print(f"Downloaded: {url}" if "://" in url else f"Added: {url}")
+
+
+def _repo_path(repo_url: str) -> Path:
+    return cache_dir.joinpath("repos", f"{_hash_url(repo_url)}.git")
+
+
+def _object_path(sha256: str) -> Path:
+    return cache_dir.joinpath("objects", sha256)
+
+
+# Move a file into the object store. Returns its sha256
+def _add_object(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(1048576):
+            sha256.update(chunk)
+    cache_dir.joinpath("objects").mkdir(parents=True, exist_ok=True)
+    shutil.move(path, _object_path(sha256.hexdigest()))
+    return sha256.hexdigest()
+
+
+def _hash_url(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+# Lock the index against other threads and other builder processes
+@contextmanager
+def _lock_index():
+    with _index_lock:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(cache_dir.joinpath("index.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+            yield
+
+
+# Lock a url against other threads and builder processes that download it at the same time
+@contextmanager
+def _lock_download(url: str):
+    objects_dir = cache_dir.joinpath("objects")
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    with open(objects_dir.joinpath(f".download-{_hash_url(url)}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+        yield
+
+
+def _get_index() -> dict:  # only call with the index locked
+    try:
+        with open(cache_dir.joinpath("index.json"), "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_index(index: dict) -> None:  # only call with the index locked
+    tmp_path = cache_dir.joinpath("index.json.tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(index, file, indent=4)
+    tmp_path.replace(cache_dir.joinpath("index.json"))
+
+
+# Send a conditional request for url. Returns (None, entry) if the cached file is still up-to-date,
+# otherwise (response, None). Without use_cache, the cached file is ignored
+def _request(url: str, use_cache: bool = True) -> tuple:
+    with _lock_index():
+        entry = _get_index().get(url) if use_cache else None
+    if entry is not None and not _object_path(entry["sha256"]).exists():
+        entry = None  # object was removed from disk
+
+    request = Request(url)
+    if entry is not None:
+        if entry["etag"]:
+            request.add_header("If-None-Match", entry["etag"])
+        if entry["last_modified"]:
+            request.add_header("If-Modified-Since", entry["last_modified"])
+
+    try:
+        return urlopen(request), None
+    except HTTPError as err:
+        if err.code == 304 and entry is not None:  # not modified -> use cached file
+            return None, entry
+        raise
+    except URLError:
+        if entry is None:
+            raise
+        print_warning(f"Couldn't reach {url}, using cached file")
+        return None, entry
+
+
+# Stream a http response into the object store, yielding the chunks as they arrive.
+# The file is only added to the index once it was downloaded completely
+def _download(url: str, response, chunk_size: int = 1048576):
+    objects_dir = cache_dir.joinpath("objects")
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = objects_dir.joinpath(f".tmp-{os.getpid()}-{id(response)}")
+    sha256 = hashlib.sha256()
+    try:
+        with response, open(tmp_path, "wb") as file:
+            while chunk := response.read(chunk_size):
+                sha256.update(chunk)
+                file.write(chunk)
+                yield chunk
+            _check_length(response, file.tell())
+        # identical files from different urls are only stored once
+        tmp_path.replace(_object_path(sha256.hexdigest()))
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    _add_entry(url, sha256.hexdigest(), response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+
+# Reading a response in chunks ends early without an error if the connection is closed before the whole body was sent
+def _check_length(response, received: int) -> None:
+    expected = response.headers.get("Content-Length")
+    if expected is not None and received < int(expected):
+        raise http.client.IncompleteRead(b"", int(expected) - received)
+
+
+def _add_entry(url: str, sha256: str, etag: str | None, last_modified: str | None, metadata: dict = None) -> None:
+    with _lock_index():
+        index = _get_index()
+        index[url] = {
+            "sha256": sha256,
+            "size": _object_path(sha256).stat().st_size,
+            "etag": etag,
+            "last_modified": last_modified,
+            "last_used": time()
+        }
+        if metadata is not None:
+            index[url]["metadata"] = metadata
+        misses.append((url, index[url]["size"]))
+        _evict(index, keep=sha256)
+        _save_index(index)
+
+
+def _record_hit(url: str, entry: dict) -> None:
+    hits.append((url, entry["size"]))
+    with _lock_index():
+        index = _get_index()
+        if url in index:
+            index[url]["last_used"] = time()
+            _save_index(index)
+
+
+# Hardlink the cached object to path, copy if the cache is on another filesystem
+def _link_object(sha256: str, path: str) -> None:
+    rmfile(path)
+    try:
+        os.link(_object_path(sha256), path)
+    except OSError:
+        file_ops.cpfile(_object_path(sha256).as_posix(), path)
+
+
+# Remove the least recently used objects until the cache fits into max_size. The object in keep is never removed
+def _evict(index: dict, keep: str) -> None:  # only call with the index locked
+    objects = {}  # sha256 -> (size, last_used)
+    for entry in index.values():
+        size, last_used = objects.get(entry["sha256"], (entry["size"], 0))
+        objects[entry["sha256"]] = (size, max(last_used, entry["last_used"]))
+
+    total_size = sum(size for size, _ in objects.values())
+    for sha256, (size, _) in sorted(objects.items(), key=lambda item: item[1][1]):
+        if total_size <= max_size:
+            break
+        if sha256 == keep:
+            continue
+        print(f"Removing {sha256} from download cache")
+        _object_path(sha256).unlink(missing_ok=True)
+        total_size -= size
+        for url in [url for url, entry in index.items() if entry["sha256"] == sha256]:
+            del index[url]
+
+
+# Mark a repo as partial clone: missing files are downloaded from origin when they are needed
+def _set_promisor(path: str) -> None:
+    for key, value in [("core.repositoryformatversion", "1"), ("extensions.partialclone", "origin"),
+                       ("remote.origin.promisor", "true"), ("remote.origin.partialclonefilter", "blob:none")]:
+        runner.run(["git", "-C", path, "config", key, value])
+
+
+def _is_promisor(mirror: str) -> bool:
+    try:
+        return runner.run(["git", "-C", mirror, "config", "--bool", "remote.origin.promisor"], capture=True) == "true"
+    except subprocess.CalledProcessError:  # not set
+        return False
+
+
+# Get the fetched commit of a mirror, None if nothing was fetched yet
+def _get_commit(mirror: str) -> str | None:
+    try:
+        return runner.run(["git", "-C", mirror, "rev-parse", "--verify", "-q", mirror_ref], capture=True)
+    except subprocess.CalledProcessError:
+        return None
+
+
+# Get the size of the objects of a mirror
+def _get_repo_size(mirror: Path) -> int:
+    return sum(file.stat().st_size for file in mirror.joinpath("objects").rglob("*") if file.is_file())
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Checkpoints for the build stages, so that a failed build can be continued with --resume instead of starting over.
+# Every stage has a hash of its inputs, chained with the hash of the stage before it. A stage is skipped on resume if
+# it was completed with the same hash, i.e. the same inputs for it and all stages before it.
+# The state is kept in /tmp/eupnea-build, next to the downloaded files it depends on, and removed after a successful
+# build.
+
+import os
+import json
+import hashlib
+
+from functions import *
+
+state_path = "/tmp/eupnea-build/checkpoints.json"
+
+_state = {"stages": {}}
+_hashes = {}  # stage name -> hash of the current build
+
+
+# Calculate the hashes of all stages. stages is an ordered list of (stage name, list of inputs).
+# Returns False if resume is True but there is no build to resume
+def start(stages: list, resume: bool) -> bool:
+    global _state
+    _hashes.clear()
+    previous_hash = ""
+    for name, inputs in stages:
+        previous_hash = hashlib.sha256(json.dumps([previous_hash, name, inputs]).encode()).hexdigest()
+        _hashes[name] = previous_hash
+
+    _state = {"stages": {}}
+    if not resume:
+        return True
+    try:
+        with open(state_path, "r") as file:
+            _state = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    # only the stages before the first changed/incomplete stage are kept
+    completed_stages = {}
+    for name, _ in stages:
+        if _state["stages"].get(name) != _hashes[name]:
+            break
+        completed_stages[name] = _hashes[name]
+    _state["stages"] = completed_stages
+    return bool(completed_stages)
+
+
+def is_done(stage: str) -> bool:
+    if stage in _state["stages"]:
+        print_status(f"Skipping completed stage: {stage}")
+        return True
+    return False
+
+
+# Mark a stage as completed. Keyword arguments are saved in the state and can be read with get()
+def complete(stage: str, **data) -> None:
+    _state["stages"][stage] = _hashes[stage]
+    _state.update(data)
+    __save()
+
+
+def get(key: str):
+    return _state.get(key)
+
+
+# Remove the state after a successful build, there is nothing to resume
+def clear() -> None:
+    rmfile(state_path)
+
+
+# Do not call this function directly
+# Write the state atomically and make sure it's on disk, so that a crash never leaves a broken state file behind
+def __save() -> None:
+    mkdir(os.path.dirname(state_path), create_parents=True)
+    with open(f"{state_path}.tmp", "w") as file:
+        json.dump(_state, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{state_path}.tmp", state_path)
+    dir_fd = os.open(os.path.dirname(state_path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
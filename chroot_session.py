@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# A chroot session for the whole build, instead of a new chroot(and for arch: arch-chroot mounting and unmounting all
+# pseudo filesystems) for every command.
+# The session is a shell inside the rootfs that reads commands from a pipe and runs them one after another. It lives in
+# its own mount namespace, in which /proc, /sys, /dev and /run are mounted once before it enters the chroot. These
+# mounts only exist in that namespace and disappear with the shell, so a failed or killed build can't leave them behind.
+# The rootfs is a shared mount, so mounts the builder adds to it later(e.g. the package cache) are visible in the
+# session as well.
+# The session is started by the first command and stopped with stop() at the end of the build.
+
+import os
+import shlex
+import signal
+import secrets
+from collections import deque
+from threading import Lock, Timer, Event
+from time import perf_counter
+
+import functions
+from functions import *
+import runner
+import timing
+
+root = "/mnt/eupnea"
+# mount point in the rootfs -> mount command in the namespace, {root} is replaced with the rootfs path
+pseudo_filesystems = {
+    "/proc": "mount -t proc proc {root}/proc",
+    "/sys": "mount -t sysfs -o ro sys {root}/sys",
+    "/dev": "mount --rbind /dev {root}/dev",
+    "/run": "mount -t tmpfs -o mode=0755,nosuid,nodev run {root}/run"
+}
+stop_timeout = 10  # seconds to wait for the session to exit before it's killed
+
+_session = None  # the session shell
+_marker = ""  # printed after every command, followed by its exit status
+_lock = Lock()
+
+
+# Run a command in the session, like runner.run() on the host. command is run with /bin/sh inside the rootfs, stdout and
+# stderr are merged. With capture the output is returned instead of streamed, input_text is written to stdin.
+# A timeout(in seconds) or an interrupt kills the session and everything running in it, the next command starts a
+# new one
+def run_command(command: str, capture: bool = False, timeout: float = None, input_text: str = None) -> str | None:
+    with _lock:
+        if _session is None:
+            __start()
+        session = _session
+        start = perf_counter()
+        counters = timing.read_counters(session.pid) if timing.enabled else None
+        runner.log_output(f"$ chroot {root} {command}\n", False)
+        # stdin is a pipe, so the password of chpasswd etc. is never part of a command line
+        stdin = f"printf '%s' {shlex.quote(input_text)} |" if input_text is not None else "</dev/null"
+        try:
+            session.stdin.write(f"{stdin} /bin/sh -c {shlex.quote(command)} 2>&1; printf '{_marker} %s\\n' \"$?\"\n")
+            session.stdin.flush()
+        except BrokenPipeError:  # the session exited, its output is read below
+            pass
+
+        output = []
+        output_tail = deque(maxlen=runner.error_lines)
+        exit_status = None
+        timed_out = Event()
+        timer = Timer(timeout, lambda: (timed_out.set(), __kill())) if timeout else None
+        try:
+            if timer is not None:
+                timer.start()
+            while exit_status is None:
+                line = session.stdout.readline()
+                if not line:  # the session exited or was killed
+                    break
+                if _marker in line:  # the output of the command doesn't always end with a newline
+                    line, status = line.split(_marker)
+                    exit_status = int(status)
+                if line:
+                    output_tail.append(line)
+                    if capture:
+                        output.append(line)
+                    else:
+                        runner.log_output(line, functions.verbose)
+        except BaseException:  # interrupted -> don't leave the command running
+            __kill()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if exit_status is None:
+            __kill()
+            if timed_out.is_set():
+                raise subprocess.TimeoutExpired(command, timeout, "".join(output_tail))
+            raise subprocess.CalledProcessError(-1, command, "".join(output_tail) + "chroot session exited\n")
+        if counters is not None:
+            timing.record_session_command(f"chroot {command}", start, exit_status, counters,
+                                          timing.read_counters(session.pid))
+        if exit_status != 0:
+            raise subprocess.CalledProcessError(exit_status, command, "".join(output_tail))
+        return "".join(output).strip() if capture else None
+
+
+# Stop the session and remove its mounts. Does nothing if no session is running
+def stop() -> None:
+    global _session
+    with _lock:
+        if _session is None:
+            return
+        _session.stdin.close()  # the shell exits at the end of its input
+        try:
+            _session.wait(timeout=stop_timeout)
+        except subprocess.TimeoutExpired:
+            __kill()
+        _session = None
+
+
+# Do not call this function directly
+def __start() -> None:
+    global _session, _marker
+    # a shared rootfs mount propagates new mounts(package cache) into the namespace, but not the other way round
+    runner.run(["mount", "--make-rshared", root])
+    mounts = " && ".join(f"mkdir -p {root}{mount_point} && {mount.format(root=root)}"
+                         for mount_point, mount in pseudo_filesystems.items())
+    _marker = f"eupnea-session-{secrets.token_hex(8)}"
+    _session = subprocess.Popen(["unshare", "--mount", "--propagation", "slave", "/bin/sh", "-c",
+                                 f"{mounts} && exec chroot {root} /bin/sh"],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                errors="replace", start_new_session=True)
+
+
+# Do not call this function directly
+# Kill the session with everything running in it. Its namespace and mounts go away with it
+def __kill() -> None:
+    global _session
+    if _session is None:
+        return
+    try:
+        os.killpg(_session.pid, signal.SIGKILL)
+    except ProcessLookupError:  # already exited
+        pass
+    _session.wait()
+    _session = None
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
@@ -4,6 +4,7 @@ from typing import Tuple
 import json
 from getpass import getpass
 from functions import *
+import runner
 
 
 def get_user_input() -> dict:
@@ -226,7 +227,7 @@ def get_user_input() -> dict:
 
     while True:
         usb_array = []
-        lsblk_out = bash("lsblk -o NAME,MODEL,SIZE,TRAN").splitlines()
+        lsblk_out = runner.run(["lsblk", "-o", "NAME,MODEL,SIZE,TRAN"], capture=True).splitlines()
         for line in lsblk_out[2:]:
             # MassStorageClass is not a real device, so ignore it
             if not line.find("usb") == -1 and line.find("MassStorageClass") == -1:  # Print USB devices only
@@ -1,4 +1,6 @@
 from functions import *
+import packages
+import chroot_session
 
 
 def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool) -> None:
@@ -14,7 +16,6 @@ def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool)
         write.writelines(mirrors)
 
     # Apply temporary fix for pacman
-    bash("mount --bind /mnt/eupnea /mnt/eupnea")
     with open("/mnt/eupnea/etc/pacman.conf", "r") as conf:
         temp_pacman = conf.readlines()
     # temporarily comment out CheckSpace, coz Pacman fails to check available storage space when run from a chroot
@@ -25,62 +26,13 @@ def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool)
     print_status("Preparing pacman")
     chroot("pacman-key --init")
     chroot("pacman-key --populate archlinux")
-    chroot("pacman -Syy --noconfirm")
-    chroot("pacman -Syu --noconfirm")
-
-    print_status("Installing packages")
-    start_progress()  # start fake progress
-    chroot("pacman -S --noconfirm base base-devel nano networkmanager xkeyboard-config linux-firmware sudo cloud-utils")
-    stop_progress()  # stop fake progress
-
-    print_status("Downloading and installing de, might take a while")
-    start_progress()  # start fake progress
-    match de_name:
-        case "gnome":
-            print_status("Installing GNOME")
-            chroot("pacman -S --noconfirm gnome gnome-extra gnome-initial-setup")
-            chroot("systemctl enable gdm.service")
-        case "kde":
-            print_status("Installing KDE")
-            chroot("pacman -S --noconfirm plasma-meta plasma-wayland-session kde-applications")
-            chroot("systemctl enable sddm.service")
-        case "mate":
-            print_status("Installing MATE")
-            # no wayland support in mate
-            chroot("pacman -S --noconfirm mate mate-extra xorg xorg-server lightdm lightdm-gtk-greeter")
-            chroot("systemctl enable lightdm.service")
-        case "xfce":
-            print_status("Installing Xfce")
-            # no wayland support in xfce
-            chroot("pacman -S --noconfirm xfce4 xfce4-goodies xorg xorg-server lightdm lightdm-gtk-greeter")
-            chroot("systemctl enable lightdm.service")
-        case "lxqt":
-            print_status("Installing LXQt")
-            chroot("pacman -S --noconfirm lxqt breeze-icons xorg xorg-server sddm")
-            chroot("systemctl enable sddm.service")
-        case "deepin":
-            print_status("Installing deepin")
-            chroot("pacman -S --noconfirm deepin deepin-kwin deepin-extra xorg xorg-server lightdm")
-            # enable deepin specific login style
-            with open("/mnt/eupnea/etc/lightdm/lightdm.conf", "a") as conf:
-                conf.write("greeter-session=lightdm-deepin-greeter")
-            chroot("systemctl enable lightdm.service")
-        case "budgie":
-            print_status("Installing Budgie")
-            chroot("pacman -S --noconfirm budgie-desktop budgie-desktop-view budgie-screensaver budgie-control-center "
-                   "lightdm lightdm-gtk-greeter")
-            chroot("systemctl enable lightdm.service")
-        case "cli":
-            print_status("Skipping desktop environment install")
-        case _:
-            print_error("Invalid desktop environment! Please create an issue")
-            exit(1)
-    stop_progress()  # stop fake progress
+    packages.install("arch", de_name, distro_version, chroot)
+    if de_name == "deepin":
+        # enable deepin specific login style
+        with open("/mnt/eupnea/etc/lightdm/lightdm.conf", "a") as conf:
+            conf.write("greeter-session=lightdm-deepin-greeter")
     print_status("Desktop environment setup complete")
 
-    # enable networkmanager systemd service
-    chroot("systemctl enable NetworkManager.service")
-
     # Configure sudo
     with open("/mnt/eupnea/etc/sudoers", "r") as conf:
         temp_sudoers = conf.readlines()
@@ -111,12 +63,8 @@ def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool)
     print_status("Arch configuration complete")
 
 
-# using arch-chroot for arch
-def chroot(command: str):
-    if verbose:
-        bash(f'arch-chroot /mnt/eupnea bash -c "{command}"')
-    else:
-        bash(f'arch-chroot /mnt/eupnea bash -c "{command}" 2>/dev/null 1>/dev/null')  # supress all output
+def chroot(command: str) -> None:
+    chroot_session.run_command(command)  # the output is only shown in verbose mode
 
 
 if __name__ == "__main__":
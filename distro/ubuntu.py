@@ -1,52 +1,15 @@
 from functions import *
+import packages
+import chroot_session
 
 
 def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool) -> None:
     set_verbose(verbose)
     print_status("Configuring Ubuntu")
 
-    print_status("Installing dependencies")
-    chroot("apt-get update -y")
-    chroot("apt-get install -y linux-firmware network-manager software-properties-common cloud-utils")
-
-    # TODO: Find out why we need to reinstall dbus
-    print("Reinstalling dbus")
-    chroot("apt-get reinstall -y dbus")
-
-    print_status("Downloading and installing de, might take a while")
-    start_progress()  # start fake progress
-    match de_name:
-        case "gnome":
-            print_status("Installing GNOME")
-            chroot("apt-get install -y ubuntu-desktop gnome-software")
-        case "kde":
-            print_status("Installing KDE")
-            chroot("apt-get install -y kde-standard")
-        case "mate":
-            print_status("Installing MATE")
-            chroot("apt-get install -y ubuntu-mate-desktop")
-        case "xfce":
-            print_status("Installing Xfce")
-            chroot("apt-get install -y --no-install-recommends xubuntu-desktop")
-            chroot("apt-get install -y xfce4-goodies")
-        case "lxqt":
-            print_status("Installing LXQt")
-            chroot("apt-get install -y lubuntu-desktop")
-        case "deepin":
-            print_status("Installing deepin")
-            chroot("add-apt-repository ppa:ubuntudde-dev/stable")
-            chroot("apt-get update -y")
-            chroot("apt-get install -y ubuntudde-dde")
-        case "budgie":
-            print_status("Installing Budgie")
-            chroot("apt-get install -y ubuntu-budgie-desktop")
-            chroot("dpkg-reconfigure lightdm")
-        case "cli":
-            print_status("Skipping desktop environment install")
-        case _:
-            print_error("Invalid desktop environment! Please create an issue")
-            exit(1)
-    stop_progress()  # stop fake progress
+    packages.install("ubuntu", de_name, distro_version, chroot)
+    if de_name == "budgie":
+        chroot("dpkg-reconfigure lightdm")
 
     # GDM3 auto installs gnome-minimal. Gotta remove it if user didn't choose gnome
     if not de_name == "gnome":
@@ -54,8 +17,6 @@ def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool)
             rmfile("/mnt/eupnea/usr/share/xsessions/ubuntu.desktop")
         except FileNotFoundError:
             pass
-        chroot("apt-get remove -y gnome-shell")
-        chroot("apt-get autoremove -y")
 
     # Fix gdm3, https://askubuntu.com/questions/1239503/ubuntu-20-04-and-20-10-etc-securetty-no-such-file-or-directory
     try:
@@ -64,9 +25,6 @@ def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool)
         pass
     print_status("Desktop environment setup complete")
 
-    # TODO: Figure out if removing needrestart is necessary
-    chroot("apt-get remove -y needrestart")
-
     # The default fstab file causes systemd-remount-fs to fail
     with open("configs/fstab/ubuntu.fstab", "r") as f:
         fstab = f.read()
@@ -74,11 +32,6 @@ def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool)
     with open("/mnt/eupnea/etc/fstab", "w") as f:
         f.write(fstab)
 
-    # Replace input-synaptics with newer input-libinput, for better touchpad support
-    print_status("Upgrading touchpad drivers")
-    chroot("apt-get remove -y xserver-xorg-input-synaptics")
-    # chroot("apt-get install -y xserver-xorg-input-libinput")
-
     # Add eupnea to version(this is purely cosmetic)
     with open("/mnt/eupnea/etc/os-release", "r") as f:
         os_release = f.readlines()
@@ -91,10 +44,7 @@ def config(de_name: str, distro_version: str, root_partuuid: str, verbose: bool)
 
 
 def chroot(command: str) -> None:
-    if verbose:
-        bash(f'chroot /mnt/eupnea /bin/sh -c "{command}"')
-    else:
-        bash(f'chroot /mnt/eupnea /bin/sh -c "{command}" 2>/dev/null 1>/dev/null')  # supress all output
+    chroot_session.run_command(command)  # the output is only shown in verbose mode
 
 
 if __name__ == "__main__":
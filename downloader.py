@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# Resumable, segmented http downloads for the build files, see download().
+# Only the standard library is used: http.client keeps the connections alive between the range requests, which urllib
+# can't do.
+
+import os
+import sys
+import json
+from time import sleep
+from typing import Optional
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit, urljoin
+from urllib.request import getproxies, proxy_bypass
+from urllib.error import URLError, HTTPError
+from threading import Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import *
+import progress
+
+download_connections = 4  # parallel connections for large downloads
+download_segment_size = 16 * 1048576  # bytes per range request, smaller files are downloaded with one request
+download_retries = 5  # per segment
+download_timeout = 30  # seconds
+download_user_agent = f"Python-urllib/{sys.version_info.major}.{sys.version_info.minor}"
+
+
+# Download url to path. If the server supports byte ranges, large files are downloaded in download_segment_size ranges
+# over download_connections parallel keep-alive connections. The completed ranges are saved next to the file in
+# <path>.part.json, so an interrupted download continues from <path>.part instead of starting over.
+# etag and last_modified are the headers of a previous download of the file, which is skipped if it didn't change.
+# Returns the headers of the downloaded file({"etag", "last_modified", "size"}), or None if it didn't change.
+# The progress is reported to progress.set_download_progress(progress_path or path). Errors are raised as
+# URLError/HTTPError, like urllib does
+def download(url: str, path: str, etag: str = None, last_modified: str = None,
+             progress_path: str = None) -> Optional[dict]:
+    part_path = f"{path}.part"
+    progress_path = progress_path or path
+    state = __load_download_state(url, part_path)
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    if state is not None:  # only continue the download if the file is still the same, otherwise get all of it
+        remaining = sorted(set(range(__count_segments(state))) - set(state["done"]))
+        if not remaining:  # interrupted right before the end
+            os.replace(part_path, path)
+            rmfile(f"{part_path}.json")
+            return {"etag": state["etag"], "last_modified": state["last_modified"], "size": state["size"]}
+        if validator := __get_range_validator(state):
+            headers["If-Range"] = validator
+        start = remaining[0] * state["segment_size"]
+        headers["Range"] = f"bytes={start}-{start + state['segment_size'] - 1}"
+    else:
+        headers["Range"] = f"bytes=0-{download_segment_size - 1}"
+
+    connections = {}
+    try:
+        response, target_url = __request(url, headers, connections)
+        if response.status == 304:
+            response.close()
+            return None
+        file_etag, file_last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if response.status == 206:
+            size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+            if state is None:
+                rmfile(f"{part_path}.json")
+                with open(part_path, "wb") as file:
+                    file.truncate(size)
+                state = {"url": url, "etag": file_etag, "last_modified": file_last_modified, "size": size,
+                         "segment_size": download_segment_size, "done": []}
+                if __get_range_validator(state) is None:  # can't be continued, see __get_range_validator()
+                    state["etag"] = state["last_modified"] = None
+            __download_segments(url, target_url, part_path, state, response, connections, progress_path)
+        else:  # no byte ranges, or the file changed since the interrupted download
+            rmfile(f"{part_path}.json")
+            size = __download_whole(response, part_path, progress_path)
+    except URLError:
+        raise
+    except (OSError, HTTPException) as err:
+        raise URLError(err) from err
+    finally:
+        for connection, _ in connections.values():
+            connection.close()
+
+    os.replace(part_path, path)
+    rmfile(f"{part_path}.json")
+    return {"etag": file_etag, "last_modified": file_last_modified, "size": size}
+
+
+# Do not call this function directly
+# Download the remaining segments of a file in parallel. response is the already requested first remaining segment
+def __download_segments(url: str, target_url: str, part_path: str, state: dict, response, connections: dict,
+                        progress_path: str) -> None:
+    remaining = [segment for segment in range(__count_segments(state)) if segment not in state["done"]]
+    first_segment = remaining.pop(0)
+    downloaded = sum(min(state["segment_size"], state["size"] - segment * state["segment_size"])
+                     for segment in state["done"])
+    state_lock = Lock()
+    failed = Event()
+    progress.set_download_progress(progress_path, downloaded, state["size"])
+
+    def report_progress(length: int) -> None:
+        nonlocal downloaded
+        with state_lock:
+            downloaded += length
+            progress.set_download_progress(progress_path, downloaded, state["size"])
+
+    def complete_segment(segment: int) -> None:
+        with state_lock:
+            state["done"].append(segment)
+            if __get_range_validator(state):  # a download can only be continued if the file is the same
+                __save_download_state(part_path, state)
+
+    def download_worker(worker_connections: dict) -> None:
+        try:
+            while not failed.is_set():
+                with state_lock:
+                    if not remaining:
+                        return
+                    segment = remaining.pop(0)
+                __download_segment(url, target_url, part_path, state, segment, None, worker_connections,
+                                   report_progress)
+                complete_segment(segment)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            for connection, _ in worker_connections.values():
+                connection.close()
+
+    with ThreadPoolExecutor(max_workers=download_connections) as pool:
+        # the first connection continues with the first segment, the others start with the next segments
+        workers = [pool.submit(download_worker, {}) for _ in range(min(download_connections - 1, len(remaining)))]
+        try:
+            __download_segment(url, target_url, part_path, state, first_segment, response, connections,
+                               report_progress)
+            complete_segment(first_segment)
+            download_worker(connections)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            for worker in workers:
+                worker.result()  # raises the error of a failed worker
+
+
+# Do not call this function directly
+# Download a segment to its position in the part file, retrying from where the connection broke off.
+# response is an already requested response for the segment, or None
+def __download_segment(url: str, target_url: str, part_path: str, state: dict, segment: int, response,
+                       connections: dict, report_progress) -> None:
+    position = segment * state["segment_size"]
+    end = min(position + state["segment_size"], state["size"])
+    validator = __get_range_validator(state)
+    with open(part_path, "r+b") as file:
+        for attempt in range(download_retries + 1):
+            try:
+                if response is None:
+                    headers = {"Range": f"bytes={position}-{end - 1}"}
+                    if validator:
+                        headers["If-Range"] = validator
+                    # the redirect target(e.g. a signed url) can expire -> request the original url again after errors
+                    response, _ = __request(target_url if attempt == 0 else url, headers, connections)
+                if response.status == 206:
+                    with response:
+                        while position < end and (chunk := response.read(min(1048576, end - position))):
+                            os.pwrite(file.fileno(), chunk, position)
+                            position += len(chunk)
+                            report_progress(len(chunk))
+                    if position < end:
+                        raise ConnectionError(f"Connection closed after {position} of {end} bytes")
+                    os.fdatasync(file.fileno())  # the segment is only marked as done once it's on disk
+                    return
+                response.close()
+            except (OSError, HTTPException):
+                if attempt == download_retries:
+                    raise
+                response = None
+                for connection, _ in connections.values():
+                    connection.close()
+                connections.clear()
+                sleep(min(2 ** attempt, 30))
+                continue
+            # the server sent the whole file instead of the range -> it changed since the download was started
+            rmfile(f"{part_path}.json")
+            raise URLError(f"{url} changed during the download")
+
+
+# Do not call this function directly
+# Get the If-Range value for the remaining segments. Servers ignore the range if If-Range has a weak ETag(W/"...") and
+# send the whole file, so weak ETags are not used. Returns None if the file can't be identified
+def __get_range_validator(state: dict) -> Optional[str]:
+    if state["etag"] and not state["etag"].startswith("W/"):
+        return state["etag"]
+    return state["last_modified"]
+
+
+# Do not call this function directly
+def __download_whole(response, part_path: str, progress_path: str) -> int:
+    total = int(response.headers.get("Content-Length") or 0) or None
+    downloaded = 0
+    with response, open(part_path, "wb") as file:
+        while chunk := response.read(1048576):
+            file.write(chunk)
+            downloaded += len(chunk)
+            progress.set_download_progress(progress_path, downloaded, total)
+    if total is not None and downloaded < total:
+        raise ConnectionError(f"Connection closed after {downloaded} of {total} bytes")
+    return downloaded
+
+
+# Do not call this function directly
+# Send a GET request, following redirects. connections are reused for requests to the same host.
+# Returns (response, url after redirects). Raises HTTPError for error responses
+def __request(url: str, headers: dict, connections: dict) -> tuple:
+    for _ in range(10):
+        url_parts = urlsplit(url)
+        if (url_parts.scheme, url_parts.netloc) not in connections:
+            connections[(url_parts.scheme, url_parts.netloc)] = __connect(url_parts)
+        connection, via_proxy = connections[(url_parts.scheme, url_parts.netloc)]
+        path = url if via_proxy else url_parts._replace(scheme="", netloc="", fragment="").geturl() or "/"
+        connection.request("GET", path, headers=headers | {"User-Agent": download_user_agent,
+                                                           "Accept-Encoding": "identity"})
+        response = connection.getresponse()
+        if response.status in (301, 302, 303, 307, 308) and response.headers.get("Location"):
+            response.read()
+            url = urljoin(url, response.headers["Location"])
+            continue
+        if response.status >= 400:
+            response.read()
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        return response, url
+    raise URLError(f"Too many redirects: {url}")
+
+
+# Do not call this function directly
+# Returns (connection, True if the connection goes through an http proxy)
+def __connect(url_parts) -> tuple:
+    proxy = None if proxy_bypass(url_parts.hostname) else getproxies().get(url_parts.scheme)
+    if proxy is None:
+        if url_parts.scheme == "https":
+            return HTTPSConnection(url_parts.hostname, url_parts.port, timeout=download_timeout), False
+        return HTTPConnection(url_parts.hostname, url_parts.port, timeout=download_timeout), False
+    proxy_parts = urlsplit(proxy)
+    if url_parts.scheme == "https":  # tunnel through the proxy
+        connection = HTTPSConnection(proxy_parts.hostname, proxy_parts.port, timeout=download_timeout)
+        connection.set_tunnel(url_parts.hostname, url_parts.port)
+        return connection, False
+    return HTTPConnection(proxy_parts.hostname, proxy_parts.port, timeout=download_timeout), True
+
+
+# Do not call this function directly
+def __count_segments(state: dict) -> int:
+    return max(1, -(-state["size"] // state["segment_size"]))
+
+
+# Do not call this function directly
+# Get the state of an interrupted download of url, None if there is nothing to continue
+def __load_download_state(url: str, part_path: str) -> Optional[dict]:
+    try:
+        with open(f"{part_path}.json", "r") as file:
+            state = json.load(file)
+        if state["url"] == url and os.path.getsize(part_path) == state["size"]:
+            return state
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+# Do not call this function directly
+def __save_download_state(part_path: str, state: dict) -> None:
+    with open(f"{part_path}.json.tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(f"{part_path}.json.tmp", f"{part_path}.json")
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Copying and removal of big files and directory trees(rootfs, kernel modules, firmware), done by the kernel and on
+# multiple threads.
+# Named file_ops.py and not copy.py/remove.py, as copy.py would shadow python's copy module
+
+import os
+import stat
+import errno
+import fcntl
+import concurrent.futures
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import *
+import runner
+
+io_threads = min(32, (os.cpu_count() or 1) * 4)  # file operations are limited by syscalls and disk, not cpu
+copy_chunk_size = 64 * 1048576
+FICLONE = 0x40049409  # ioctl to clone a file on CoW filesystems, from linux/fs.h
+
+
+# unlink all files in a directory and remove the directory
+# Files are unlinked relative to their directory's file descriptor, with multiple directories processed in parallel.
+# Directories are removed afterwards, deepest first
+def rmdir(rm_dir: str, keep_dir: bool = True) -> None:
+    # convert string to Path object
+    rm_dir_as_path = Path(rm_dir)
+    if not rm_dir_as_path.is_dir():
+        print(f"No such file or directory: {rm_dir_as_path.absolute().as_posix()}, ignoring")
+        return
+
+    try:
+        dirs = __unlink_tree(rm_dir_as_path.absolute().as_posix())
+        for directory in reversed(dirs[1:]):  # subdirectories are always listed after their parent
+            os.rmdir(directory)
+    except OSError as err:
+        print_warning(f"Failed to remove {rm_dir} with python ({err}), using bash")
+        runner.run(["rm", "-rf", rm_dir_as_path.absolute().as_posix()])
+        if keep_dir:
+            mkdir(rm_dir_as_path.absolute().as_posix())
+        return
+    # Remove emtpy directory
+    if not keep_dir:
+        rm_dir_as_path.rmdir()
+
+
+# Do not call this function directly, use rmdir() instead
+# Unlink all files in the tree and return all directories in it, parents before their subdirectories
+def __unlink_tree(top_dir: str) -> list:
+    dirs = [top_dir]
+    with ThreadPoolExecutor(max_workers=io_threads) as pool:
+        pending = {pool.submit(__unlink_files, top_dir)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    dirs.append(subdir)
+                    pending.add(pool.submit(__unlink_files, subdir))
+    return dirs
+
+
+# Do not call this function directly, use rmdir() instead
+# Unlink all non-directories in a directory and return the paths of its subdirectories
+def __unlink_files(directory: str) -> list:
+    subdirs = []
+    dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        with os.scandir(dir_fd) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(f"{directory}/{entry.name}")
+                else:
+                    try:
+                        os.unlink(entry.name, dir_fd=dir_fd)
+                    except FileNotFoundError:  # already removed
+                        pass
+    finally:
+        os.close(dir_fd)
+    return subdirs
+
+
+# recursively copy files from a dir into another dir
+# Copies everything(including dotfiles) with permissions, owners, timestamps, xattrs/SELinux labels, symlinks and
+# hardlinks. File data is cloned(reflink) if possible, otherwise copied in the kernel, on multiple threads
+def cpdir(src_as_str: str, dst_as_string: str) -> None:  # dst_dir must be a full path, including the new dir name
+    src_as_path = Path(src_as_str)
+    dst_as_path = Path(dst_as_string)
+    if src_as_path.exists():
+        if not dst_as_path.exists():
+            mkdir(dst_as_string, create_parents=True)
+        try:
+            __copy_tree(src_as_path.absolute().as_posix(), dst_as_path.absolute().as_posix())
+        except OSError as err:
+            print_warning(f"Failed to copy {src_as_str} to {dst_as_string} with python ({err}), using bash")
+            runner.run(["cp", "-a", f"{src_as_path.absolute().as_posix()}/.", dst_as_path.absolute().as_posix()])
+    else:
+        print("Source directory does not exist?")
+
+
+# Do not call this function directly, use cpdir() instead
+def __copy_tree(src_dir: str, dst_dir: str) -> None:
+    dirs = []  # (src path, src stat, dst path) of all copied dirs, parents before their subdirectories
+    hardlinks = []  # (first copy, dst path) of files that are hardlinked to an already copied file
+    copied_inodes = {}  # (device, inode) -> dst path of files with more than one hardlink
+
+    with ThreadPoolExecutor(max_workers=io_threads) as pool:
+        copies = []
+        walk_dirs = [(src_dir, dst_dir)]
+        while walk_dirs:
+            src, dst = walk_dirs.pop()
+            with os.scandir(src) as entries:
+                for entry in entries:
+                    src_path = f"{src}/{entry.name}"
+                    dst_path = f"{dst}/{entry.name}"
+                    src_stat = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        try:
+                            os.mkdir(dst_path, 0o700)
+                        except FileExistsError:  # merge into existing directory
+                            pass
+                        dirs.append((src_path, src_stat, dst_path))
+                        walk_dirs.append((src_path, dst_path))
+                    elif entry.is_symlink():
+                        __remove_existing(dst_path)
+                        os.symlink(os.readlink(src_path), dst_path)
+                        __copy_metadata(src_path, src_stat, dst_path)
+                    elif entry.is_file(follow_symlinks=False):
+                        if src_stat.st_nlink > 1:
+                            inode = (src_stat.st_dev, src_stat.st_ino)
+                            if inode in copied_inodes:
+                                hardlinks.append((copied_inodes[inode], dst_path))
+                                continue
+                            copied_inodes[inode] = dst_path
+                        copies.append(pool.submit(__copy_file, src_path, src_stat, dst_path))
+                    else:  # device nodes, fifos, sockets
+                        __remove_existing(dst_path)
+                        os.mknod(dst_path, src_stat.st_mode, src_stat.st_rdev)
+                        __copy_metadata(src_path, src_stat, dst_path)
+        for copy in copies:
+            copy.result()  # re-raise errors from the copy threads
+
+    for first_copy, dst_path in hardlinks:
+        __remove_existing(dst_path)
+        os.link(first_copy, dst_path)
+    # set directory permissions and timestamps last, as adding files changes them
+    for src_path, src_stat, dst_path in reversed(dirs):
+        __copy_metadata(src_path, src_stat, dst_path)
+
+
+# Do not call this function directly, use cpdir() or cpfile() instead
+# cpdir() copies the tree exactly, with owners and xattrs and without following symlinks. cpfile() behaves like a
+# normal copy and follows symlinks
+def __copy_file(src_path: str, src_stat: os.stat_result, dst_path: str, follow_symlinks: bool = False) -> None:
+    no_follow = 0 if follow_symlinks else os.O_NOFOLLOW
+    src_fd = os.open(src_path, os.O_RDONLY | no_follow)
+    try:
+        try:
+            dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | no_follow, 0o600)
+        except OSError as err:
+            if err.errno != errno.ELOOP:
+                raise
+            os.unlink(dst_path)  # never write through a symlink in the destination
+            dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        try:
+            __copy_data(src_fd, dst_fd)
+            __copy_metadata(src_path, src_stat, dst_fd, all_metadata=not follow_symlinks)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+# Do not call this function directly, use cpdir() or cpfile() instead
+# Copy file data, trying the fastest method first: reflink(only on btrfs, xfs etc.), then in-kernel copies, then
+# a read/write loop. Data never passes through python, except for the last fallback
+def __copy_data(src_fd: int, dst_fd: int) -> None:
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return
+    except OSError:
+        pass
+    try:
+        while os.copy_file_range(src_fd, dst_fd, copy_chunk_size):
+            pass
+        return
+    except OSError as err:  # older kernels can't copy across filesystems
+        if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    try:
+        while os.sendfile(dst_fd, src_fd, None, copy_chunk_size):
+            pass
+        return
+    except OSError as err:
+        if err.errno not in (errno.ENOSYS, errno.EINVAL):
+            raise
+    while data := os.read(src_fd, copy_chunk_size):
+        os.write(dst_fd, data)
+
+
+# Do not call this function directly, use cpdir() or cpfile() instead
+# dst is a path or a file descriptor. Symlinks are never followed. Owners and xattrs are only copied with all_metadata
+def __copy_metadata(src_path: str, src_stat: os.stat_result, dst, all_metadata: bool = True) -> None:
+    is_symlink = stat.S_ISLNK(src_stat.st_mode)
+    follow_symlinks = isinstance(dst, int)  # file descriptors can't be combined with follow_symlinks=False
+    if all_metadata and os.geteuid() == 0:
+        os.chown(dst, src_stat.st_uid, src_stat.st_gid, follow_symlinks=follow_symlinks)
+    try:
+        for name in os.listxattr(src_path, follow_symlinks=False) if all_metadata else []:
+            os.setxattr(dst, name, os.getxattr(src_path, name, follow_symlinks=False),
+                        follow_symlinks=follow_symlinks)
+    except OSError as err:  # e.g. SELinux labels on a host without SELinux
+        if err.errno not in (errno.ENOTSUP, errno.EPERM, errno.EINVAL, errno.EACCES):
+            raise
+    if not is_symlink:  # chmod after chown, as chown removes setuid bits
+        os.chmod(dst, stat.S_IMODE(src_stat.st_mode))
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns), follow_symlinks=follow_symlinks)
+
+
+# Do not call this function directly
+def __remove_existing(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def cpfile(src: str, dst: str) -> None:  # "/etc/resolv.conf", "/mnt/eupnea/etc/resolv.conf"
+    src_as_path = Path(src)
+    if src_as_path.exists():
+        # the data is copied in chunks by the kernel, so big files(e.g. rootfs archives) are never read into memory.
+        # Symlinks are followed, like in a normal copy. Permissions and timestamps are kept, owners are not
+        __copy_file(src_as_path.absolute().as_posix(), os.stat(src), Path(dst).absolute().as_posix(),
+                    follow_symlinks=True)
+    else:
+        print(f"{src} does not exist, ignoring")
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
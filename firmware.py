@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Firmware selection. Instead of all of linux-firmware(well over a gigabyte), only the firmware the kernel modules can
+# request is installed: the firmware= entries in the .modinfo section of every module(what modinfo -F firmware shows)
+# and in modules.builtin.modinfo for built-in drivers. Firmware that drivers request by a name built at runtime(audio
+# DSPs, bluetooth) is added from the "always" list in firmware.json, and a board profile from firmware.json can leave
+# out the firmware of other platforms. Links from the WHENCE file of linux-firmware are followed and recreated.
+# build.py clones the repo without file contents(--filter=blob:none), only the selected files are downloaded(into the
+# cached mirror of the repo, see cache.fetch_repo_files()) and checked out. Servers without partial clone support send
+# the whole repo and local firmware folders aren't clones, then only the selected files are copied.
+
+import os
+import re
+import json
+import gzip
+import lzma
+import struct
+import fnmatch
+import tarfile
+import subprocess
+
+from functions import *
+import runner
+import cache
+import archive
+import file_ops
+
+profiles_path = "firmware.json"
+# always installed, they contain the licenses of the firmware
+license_files = ["WHENCE", "LICENCE*", "LICENSE*"]
+module_suffixes = (".ko", ".ko.xz", ".ko.gz")
+
+
+# Profiles for --firmware: kernel(all firmware the kernel can request), all(the whole repo) and the board profiles
+def get_profiles() -> list:
+    with open(profiles_path, "r") as file:
+        return ["kernel", "all"] + list(json.load(file)["profiles"])
+
+
+# Select the firmware for the kernel modules in modules(modules.tar.xz or an extracted lib/modules directory) and check
+# it out if path is a clone. Returns (files, links): the files to install and WHENCE links(link -> target) to create
+def prepare(path: str, modules: str, profile: str) -> tuple:
+    is_clone = path_exists(f"{path}/.git")
+    if is_clone:
+        # WHENCE is needed for the selection
+        cache.fetch_repo_files(path, {file for file in __list_files(path)
+                                      if any(fnmatch.fnmatch(file, pattern) for pattern in license_files)})
+        __checkout(path, license_files)
+    files, links = select(path, get_required(modules), profile)
+    while is_clone:
+        cache.fetch_repo_files(path, files)
+        __checkout(path, license_files + [__escape_pattern(file) for file in sorted(files)])
+        # symlinks in the repo need their target as well
+        targets = {os.path.normpath(os.path.join(os.path.dirname(file), os.readlink(f"{path}/{file}")))
+                   for file in files if os.path.islink(f"{path}/{file}")}
+        if targets <= files:
+            break
+        files |= targets
+    return files, links
+
+
+# Get the names of all firmware files the kernel modules can request
+def get_required(modules: str) -> set:
+    required = set()
+    if os.path.isdir(modules):
+        for root, _, files in os.walk(modules):
+            for file in files:
+                if file.endswith(module_suffixes) or file == "modules.builtin.modinfo":
+                    with open(os.path.join(root, file), "rb") as module:
+                        required.update(__read_modinfo(file, module.read()))
+        return required
+
+    with open(modules, "rb") as tar_file:
+        decompressor = archive.get_decompressor(modules.split(".")[-1])
+        process = subprocess.Popen(decompressor, stdin=tar_file, stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+            for member in tar:
+                name = os.path.basename(member.name)
+                if member.isfile() and (name.endswith(module_suffixes) or name == "modules.builtin.modinfo"):
+                    required.update(__read_modinfo(name, tar.extractfile(member).read()))
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    return required
+
+
+# Select the files for the required firmware names from the repo at path. Returns (files, links), see prepare()
+def select(path: str, required: set, profile: str) -> tuple:
+    with open(profiles_path, "r") as file:
+        config = json.load(file)
+    exclude = config["profiles"].get(profile, {}).get("exclude", [])
+    repo_files = __list_files(path)
+    whence_links = __read_whence(path)
+    candidates = repo_files | set(whence_links)
+
+    names = set()
+    for name in required:
+        name = name.lstrip("/")
+        if name in candidates:
+            names.add(name)
+        else:
+            # drivers request the newest firmware version they support and fall back to older ones, which are often
+            # the only ones in the repo
+            names.update(fnmatch.filter(candidates, re.sub(r"\d+(?=\D*$)", "*", name)))
+    for pattern in config["always"] + license_files:
+        names.update(fnmatch.filter(candidates, pattern))
+
+    files = set()
+    links = {}
+    for name in names:
+        if any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+            continue
+        target = name
+        for _ in range(10):  # links can point to other links
+            if target not in whence_links:
+                break
+            target = whence_links[target]
+        if target != name:
+            links[name] = target
+        if target in repo_files:
+            files.add(target)
+    return files, links
+
+
+# Install the selected firmware to dst_dir
+def install(path: str, dst_dir: str, files: set, links: dict) -> None:
+    for file in sorted(files):
+        mkdir(os.path.dirname(f"{dst_dir}/{file}"), create_parents=True)
+        if os.path.islink(f"{path}/{file}"):
+            os.symlink(os.readlink(f"{path}/{file}"), f"{dst_dir}/{file}")
+        elif os.path.isdir(f"{path}/{file}"):  # target of a symlink
+            file_ops.cpdir(f"{path}/{file}", f"{dst_dir}/{file}")
+        else:
+            file_ops.cpfile(f"{path}/{file}", f"{dst_dir}/{file}")
+    for link, target in sorted(links.items()):
+        if not os.path.lexists(f"{dst_dir}/{link}"):
+            mkdir(os.path.dirname(f"{dst_dir}/{link}"), create_parents=True)
+            os.symlink(os.path.relpath(target, os.path.dirname(link) or "."), f"{dst_dir}/{link}")
+
+
+# Do not call this function directly
+# Get the firmware entries of a module or of modules.builtin.modinfo(entries are prefixed with the module name)
+def __read_modinfo(name: str, data: bytes) -> set:
+    if name.endswith(".xz"):
+        data = lzma.decompress(data)
+    elif name.endswith(".gz"):
+        data = gzip.decompress(data)
+    if name == "modules.builtin.modinfo":
+        entries = [entry.split(b".", 1)[-1] for entry in data.split(b"\0")]
+    else:
+        entries = __get_elf_section(data, b".modinfo").split(b"\0")
+    return {entry[9:].decode(errors="replace") for entry in entries if entry.startswith(b"firmware=")}
+
+
+# Do not call this function directly
+# Get a section of a 64 bit little endian ELF file(x86_64 kernel module). Returns b"" if it has no such section
+def __get_elf_section(data: bytes, section_name: bytes) -> bytes:
+    if data[:6] != b"\x7fELF\x02\x01":
+        return b""
+    section_offset = struct.unpack_from("<Q", data, 0x28)[0]
+    header_size, header_count, names_index = struct.unpack_from("<HHH", data, 0x3A)
+    # name offset, type, flags, address, offset, size
+    headers = [struct.unpack_from("<IIQQQQ", data, section_offset + index * header_size)
+               for index in range(header_count)]
+    names_offset = headers[names_index][4]
+    for name_offset, _, _, _, offset, size in headers:
+        name_start = names_offset + name_offset
+        if data[name_start:data.index(b"\0", name_start)] == section_name:
+            return data[offset:offset + size]
+    return b""
+
+
+# Do not call this function directly
+# Get all files and symlinks in the repo, relative to it. Works for clones without checked out files
+def __list_files(path: str) -> set:
+    if path_exists(f"{path}/.git"):
+        return set(runner.run(["git", "-C", path, "ls-tree", "-r", "--name-only", "HEAD"], capture=True).splitlines())
+    files = set()
+    for root, dirs, dir_files in os.walk(path):
+        dirs[:] = [directory for directory in dirs if directory != ".git"]
+        files.update(os.path.relpath(os.path.join(root, file), path) for file in dir_files)
+    return files
+
+
+# Do not call this function directly
+# Get the links from WHENCE(Link: link -> target, the target is relative to the directory of the link)
+def __read_whence(path: str) -> dict:
+    links = {}
+    if not path_exists(f"{path}/WHENCE"):
+        return links
+    with open(f"{path}/WHENCE", "r", errors="replace") as file:
+        for line in file:
+            if line.startswith("Link:") and "->" in line:
+                link, target = (part.strip() for part in line[5:].split("->", 1))
+                links[link] = os.path.normpath(os.path.join(os.path.dirname(link), target))
+    return links
+
+
+# Do not call this function directly
+# Check out only the files matching patterns(gitignore syntax, relative to the repo root)
+def __checkout(path: str, patterns: list) -> None:
+    runner.run(["git", "-C", path, "sparse-checkout", "set", "--no-cone", "--stdin"],
+               input_text="".join(f"/{pattern}\n" for pattern in patterns))
+    runner.run(["git", "-C", path, "checkout"])
+
+
+# Do not call this function directly
+def __escape_pattern(file: str) -> str:
+    return re.sub(r"([\\*?\[])", r"\\\1", file)
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Read and write GPT partition tables of image files.
+# READ: https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import struct
+import zlib
+import uuid
+
+from functions import *
+
+sector_size = 512
+entries_count = 128
+entry_size = 128
+entries_sectors = entries_count * entry_size // sector_size  # 32
+# partition type guids
+chromeos_kernel_type = "FE3A2A5D-4F32-41A7-B725-ACCC3285A309"
+linux_data_type = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
+
+
+# read the partition table of a disk image. Returns a dict with the disk guid and a list of partition entries.
+# Each entry is a dict with: type_guid, unique_guid, first_lba, last_lba, attributes, name. Empty entries are None
+def read_gpt(disk_path: str) -> dict:
+    with open(disk_path, "rb") as disk:
+        disk.seek(sector_size)
+        header = disk.read(sector_size)
+        if header[:8] != b"EFI PART":
+            raise ValueError(f"{disk_path} has no GPT partition table")
+        entries_lba, count, size = struct.unpack_from("<QII", header, 72)
+        disk.seek(entries_lba * sector_size)
+        raw_entries = disk.read(count * size)
+
+    entries = []
+    for index in range(count):
+        raw_entry = raw_entries[index * size:(index + 1) * size]
+        if raw_entry[:16] == bytes(16):  # unused entry
+            entries.append(None)
+            continue
+        first_lba, last_lba, attributes = struct.unpack_from("<QQQ", raw_entry, 32)
+        entries.append({
+            "type_guid": raw_entry[:16],
+            "unique_guid": raw_entry[16:32],
+            "first_lba": first_lba,
+            "last_lba": last_lba,
+            "attributes": attributes,
+            "name": raw_entry[56:128].decode("utf-16-le").rstrip("\0")
+        })
+    return {"disk_guid": header[56:72], "entries": entries}
+
+
+# create a partition entry for write_gpt(). Guids are strings like "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
+def new_entry(type_guid: str, unique_guid: str, first_lba: int, last_lba: int, name: str, attributes: int = 0) -> dict:
+    return {
+        "type_guid": uuid.UUID(type_guid).bytes_le,  # guids are stored mixed endian
+        "unique_guid": uuid.UUID(unique_guid).bytes_le,
+        "first_lba": first_lba,
+        "last_lba": last_lba,
+        "attributes": attributes,
+        "name": name
+    }
+
+
+# get the attributes of a chromeos kernel partition, like cgpt add -P priority -T tries -S successful.
+# depthcharge boots the kernel partition with the highest priority that has tries left or was booted successfully
+def get_kernel_attributes(priority: int, tries: int, successful: bool) -> int:
+    return priority << 48 | tries << 52 | int(successful) << 56
+
+
+# write a primary and backup partition table + protective MBR for a disk with disk_sectors sectors.
+# partition table is a dict like the one returned by read_gpt()
+def write_gpt(disk_path: str, partition_table: dict, disk_sectors: int) -> None:
+    raw_entries = bytearray(entries_count * entry_size)
+    for index, entry in enumerate(partition_table["entries"][:entries_count]):
+        if entry is None:
+            continue
+        struct.pack_into("<16s16sQQQ72s", raw_entries, index * entry_size, entry["type_guid"], entry["unique_guid"],
+                         entry["first_lba"], entry["last_lba"], entry["attributes"],
+                         entry["name"].encode("utf-16-le"))
+    entries_crc = zlib.crc32(raw_entries)
+
+    first_usable = 2 + entries_sectors
+    last_usable = disk_sectors - 2 - entries_sectors
+    for entry in partition_table["entries"]:
+        if entry is not None and (entry["first_lba"] < first_usable or entry["last_lba"] > last_usable):
+            raise ValueError(f"Partition {entry['name']} doesn't fit on the disk")
+
+    def header(current_lba: int, backup_lba: int, entries_lba: int) -> bytes:
+        raw_header = bytearray(92)
+        struct.pack_into("<8sIIIIQQQQ16sQIII", raw_header, 0, b"EFI PART", 0x00010000, 92, 0, 0, current_lba,
+                         backup_lba, first_usable, last_usable, partition_table["disk_guid"], entries_lba,
+                         entries_count, entry_size, entries_crc)
+        struct.pack_into("<I", raw_header, 16, zlib.crc32(raw_header))
+        return bytes(raw_header) + bytes(sector_size - 92)
+
+    # protective MBR: a single partition of type 0xEE covering the whole disk
+    mbr = bytearray(sector_size)
+    struct.pack_into("<B3sB3sII", mbr, 446, 0, b"\x00\x02\x00", 0xEE, b"\xff\xff\xff", 1,
+                     min(disk_sectors - 1, 0xFFFFFFFF))
+    mbr[510:512] = b"\x55\xaa"
+
+    with open(disk_path, "r+b") as disk:
+        disk.seek(0)
+        disk.write(mbr)
+        disk.write(header(1, disk_sectors - 1, 2))
+        disk.write(raw_entries)
+        disk.seek((disk_sectors - 1 - entries_sectors) * sector_size)
+        disk.write(raw_entries)
+        disk.write(header(disk_sectors - 1, 1, disk_sectors - 1 - entries_sectors))
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
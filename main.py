@@ -6,14 +6,16 @@ import os
 import argparse
 
 from functions import *
+import runner
 
 
 # parse arguments from the cli. Only for testing/advanced use. All other parameters are handled by cli_input.py
 def process_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--local-path', dest="local_path",
-                        help="Use local files, instead of downloading from the internet (not recommended). Required "
-                             "files: bzImage, modules.tar.xz, folder with firmware(named 'firmware'), Rootfs: "
+                        help="Use local files, instead of downloading from the internet (not recommended). The files "
+                             "are read in place, without copying. Required files: bzImage, modules.tar.xz, "
+                             "headers.tar.xz, folder with firmware(named 'firmware'), Rootfs: "
                              "ubuntu-rootfs.tar.xz or arch-rootfs.tar.gz or fedora-rootfs.raw.xz or pre-debootstrapped "
                              "folder(named 'debian')")
     parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False,
@@ -26,6 +28,47 @@ def process_args():
                         help="Use experimental 5.15 kernel.")
     parser.add_argument("--mainline", action="store_true", dest="mainline", default=False,
                         help="Use mainline linux kernel instead of modified chromeos kernel.")
+    parser.add_argument("--stream", action="store_true", dest="stream", default=False,
+                        help="Extract the rootfs and kernel tarballs while they are downloading, instead of saving "
+                             "them to /tmp first.")
+    parser.add_argument("--firmware", dest="firmware", default="kernel", metavar="PROFILE",
+                        help="Firmware to install: kernel(only the firmware the kernel modules can request), all(the "
+                             "whole linux-firmware repo) or a board profile from firmware.json, which leaves out the "
+                             "firmware of other platforms. Default: kernel")
+    parser.add_argument("--flash", dest="flash", nargs=2, metavar=("IMAGE", "DEVICE"),
+                        help="Write a previously built image to a USB-drive/SD-card(example: sdb). Only used blocks "
+                             "are written, using the IMAGE.bmap block map.")
+    parser.add_argument("--headroom", dest="headroom", type=int, default=512,
+                        help="Free space to leave on the rootfs when shrinking the image, in MB. Default: 512")
+    parser.add_argument("--no-cache", action="store_false", dest="use_cache", default=True,
+                        help="Always download files and packages, don't use or update the download and package "
+                             "caches.")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                        help="Directory for the download cache. Default: ~/.cache/eupnea-builder")
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=20,
+                        help="Maximum size of the download cache in GB. Default: 20")
+    parser.add_argument("--no-snapshot", action="store_false", dest="use_snapshots", default=True,
+                        help="Don't restore or save a snapshot of the configured rootfs. Snapshots are stored in the "
+                             "download cache and reused by later builds with the same distro, DE and kernel")
+    parser.add_argument("--resume", action="store_true", dest="resume", default=False,
+                        help="Continue a failed build with the same options. Completed stages are skipped")
+    parser.add_argument("--options", dest="options",
+                        help="Read the build options(distro, DE, user, device, ...) from a json file instead of asking "
+                             "for them. Uses the same keys as the builds in a --batch manifest")
+    parser.add_argument("--image", dest="image", default="eupnea.img",
+                        help="Path of the image file. Default: eupnea.img")
+    parser.add_argument("--staged", action="store_true", dest="staged", default=False,
+                        help="Build the rootfs in a directory next to the image and create the image from it at the "
+                             "end with mkfs.ext4 -d, without loop devices. Needs about twice the space of the image")
+    parser.add_argument("--trace", dest="trace", nargs="?", const="", default=None, metavar="FILE",
+                        help="Record the time, cpu time and disk io of every build stage and command. Saves a Chrome "
+                             "trace(chrome://tracing, ui.perfetto.dev) and prints a summary at the end. Default file: "
+                             "eupnea-trace.json next to the image")
+    parser.add_argument("--batch", dest="batch", metavar="MANIFEST",
+                        help="Build all images/devices in a json/toml manifest, each in its own workspace. All other "
+                             "arguments are used for every build. See batch.py for the manifest format")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=None,
+                        help="Number of --batch builds to run at the same time. Default: jobs in the manifest or 1")
     return parser.parse_args()
 
 
@@ -40,7 +83,8 @@ if __name__ == "__main__":
     if not os.geteuid() == 0:
         # save username
         with open("/tmp/username", "w") as file:
-            file.write(bash("whoami").strip())  # get non root username. os.getlogin() seems to fail in chroots
+            # get non root username. os.getlogin() seems to fail in chroots
+            file.write(runner.run(["whoami"], capture=True))
         sudo_args = ['sudo', sys.executable] + sys.argv + [os.environ]
         os.execlpe('sudo', *sudo_args)
 
@@ -65,8 +109,8 @@ if __name__ == "__main__":
 
                 # update and install python
                 print_status("Installing python 3.10")
-                bash("apt-get update -y")
-                bash("apt-get install -y python3")
+                runner.run(["apt-get", "update", "-y"], show_output=True)
+                runner.run(["apt-get", "install", "-y", "python3"], show_output=True)
                 print_status("Python 3.10 installed")
 
                 # revert to stable channel
@@ -84,7 +128,16 @@ if __name__ == "__main__":
 
     # import files after python version check is successful
     import build
+    import cache
     import cli_input
+    import timing
+    import chroot_session
+    import firmware
+
+    if args.flash:
+        build.flash_usb(args.flash[0], args.flash[1])
+        print_header("It is safe to remove the USB-drive/SD-card now.")
+        exit(0)
 
     # parse arguments
     dev_release = args.dev_build
@@ -104,5 +157,54 @@ if __name__ == "__main__":
         print_warning("Using local files")
     if args.verbose:
         print_warning("Verbosity increased")
-    build = build.start_build(args.verbose, local_path=args.local_path, kernel_type=kernel_type,
-                              dev_release=dev_release, user_id=user_id, build_options=cli_input.get_user_input())
+    if args.firmware not in firmware.get_profiles():
+        print_error(f"Unknown firmware profile {args.firmware}, available: {', '.join(firmware.get_profiles())}")
+        exit(1)
+    if args.firmware != "kernel":
+        print_warning(f"Using firmware profile {args.firmware}")
+    if args.stream:
+        print_warning("Streaming tarballs directly into the image")
+    if not args.use_cache:
+        print_warning("Download cache disabled")
+    if not args.use_snapshots:
+        print_warning("Rootfs snapshots disabled")
+    if args.resume:
+        print_warning("Resuming previous build")
+    if args.staged:
+        print_warning("Assembling the image from a staging directory")
+    if args.trace is not None:
+        print_warning("Tracing build stages and commands")
+    if args.batch:
+        import batch
+        batch.run(args.batch, args.jobs, user_id, sys.argv[1:],
+                  use_snapshots=args.use_snapshots and args.use_cache and args.local_path is None)
+        exit(0)
+
+    if args.options:
+        import batch
+        build_options = batch.get_builds({"builds": [batch.load_manifest(args.options)]})[0]
+    else:
+        build_options = cli_input.get_user_input()
+    cache.configure(args.cache_dir, args.use_cache, args.cache_size * 1024 ** 3)
+    if args.trace is not None:
+        timing.enable(args.trace or os.path.join(os.path.dirname(args.image), "eupnea-trace.json"))
+    # the output of all commands, also in non-verbose mode
+    log_path = os.path.join(os.path.dirname(args.image), "eupnea-build.log")
+    runner.set_command_log(log_path)
+    try:
+        build.start_build(args.verbose, local_path=args.local_path, kernel_type=kernel_type,
+                          dev_release=dev_release, user_id=user_id, build_options=build_options,
+                          stream=args.stream, img_headroom=args.headroom * 1048576,
+                          use_snapshots=args.use_snapshots, resume=args.resume, new_img_path=args.image,
+                          firmware_profile=args.firmware, staged=args.staged)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+        # the last lines of the failed command, the full output is in the build log
+        output = err.stderr or err.output or ""
+        if not args.verbose and output:
+            print(output, end="" if output.endswith("\n") else "\n")
+        print_error(f"Build failed: {err}")
+        print_error(f"The output of all commands is saved in {get_full_path(log_path)}")
+        exit(1)
+    finally:
+        chroot_session.stop()  # also after failed builds, nothing may keep running in the rootfs
+        timing.finish()  # also save the trace of failed builds
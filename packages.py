@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# Install the packages of a distro + desktop environment from the manifests in packages.json.
+# A manifest lists the repos, packages, removals and services of a distro("base") and of each desktop
+# environment("de"). Both are merged and compiled into as few package manager transactions as possible, as every call
+# re-reads the repo metadata and re-resolves all dependencies.
+#
+# Manifest keys, all optional:
+#   repos: extra repos(apt: added with add-apt-repository, needs the top level "repo_packages" installed first)
+#   components: extra apt components, added to every line in /etc/apt/sources.list
+#   upgrade: upgrade the system before installing
+#   packages: packages to install
+#   minimal_packages: packages to install without recommended/weak dependencies
+#   reinstall: packages to reinstall
+#   remove: packages to remove
+#   keep: packages to not remove, even if they are in remove
+#   autoremove: also remove the dependencies that are no longer needed after remove(apt only)
+#   services/disable_services: systemd services to enable/disable
+#   default_target: systemd default target
+#   Strings can contain {distro_version}
+#
+# Downloaded packages are kept in a host side cache(<download cache dir>/packages/<distro>-<version>), which is bind
+# mounted over the package manager cache in the chroot while installing. The image doesn't grow, and later builds only
+# download packages that changed. Old versions are pruned after each build and the cache is limited to cache_max_size.
+# While installing, the package manager output is written to a log in the chroot, which is parsed to show the progress
+# in packages. In verbose mode, the output is shown instead.
+# A package cache is only used by one build at a time, other builds running at the same time(see batch.py) download
+# their packages without it.
+
+import os
+import re
+import json
+import fcntl
+from pathlib import Path
+
+import functions
+from functions import *
+import runner
+import cache
+import progress
+
+cache_max_size = 10 * 1024 ** 3  # 10GB
+# package manager -> package cache dir in the chroot
+cache_mounts = {"apt": "/var/cache/apt/archives", "pacman": "/var/cache/pacman/pkg", "dnf": "/var/cache/dnf"}
+package_extensions = (".deb", ".rpm", ".pkg.tar.zst", ".pkg.tar.xz")
+log_path = "/tmp/eupnea-packages.log"  # in the chroot
+# "0 upgraded, 5 newly installed, 1 reinstalled, 2 to remove and 3 not upgraded."
+apt_summary = re.compile(r"^(\d+) upgraded, (\d+) newly installed, (?:(\d+) reinstalled, )?(\d+) to remove",
+                         re.MULTILINE)
+apt_steps = re.compile(r"^(?:Unpacking|Setting up|Removing) ", re.MULTILINE)
+# "(12/345): foo-1.0.x86_64.rpm"
+dnf_downloads = re.compile(r"^\(\s*(\d+)/(\d+)\): ", re.MULTILINE)
+# "  Installing       : foo-1.0.x86_64     12/345"
+dnf_steps = re.compile(r"^\s+(?:Installing|Upgrading|Reinstalling|Removing|Erasing)\s*: .*?(\d+)/(\d+)\s*$",
+                       re.MULTILINE)
+# "( 12/345) installing foo"
+pacman_steps = re.compile(r"^\(\s*(\d+)/(\d+)\) (?:installing|upgrading|reinstalling|removing) ", re.MULTILINE)
+
+_cache_lock = None  # lock file of the package cache in use
+
+
+# Merge the base and de manifests of a distro
+def load_manifest(distro_name: str, de_name: str, distro_version: str) -> dict:
+    with open("packages.json", "r") as file:
+        distro_manifest = json.load(file)[distro_name]
+    if de_name not in distro_manifest["de"]:
+        print_error(f"{de_name} is not available for {distro_manifest['name']}")
+        exit(1)
+
+    manifest = {"package_manager": distro_manifest["package_manager"],
+                "repo_packages": distro_manifest.get("repo_packages", []), "upgrade": False, "autoremove": False,
+                "default_target": None}
+    for part in [distro_manifest["base"], distro_manifest["de"][de_name]]:
+        for key, value in part.items():
+            if isinstance(value, list):
+                manifest[key] = manifest.get(key, []) + [item.format(distro_version=distro_version) for item in value]
+            else:
+                manifest[key] = value
+    for key in ["repos", "components", "packages", "minimal_packages", "reinstall", "remove", "keep", "services",
+                "disable_services"]:
+        manifest[key] = list(dict.fromkeys(manifest.get(key, [])))  # remove duplicates, keep order
+    manifest["remove"] = [package for package in manifest["remove"] if package not in manifest["keep"]]
+    return manifest
+
+
+# Compile a manifest into a list of commands to run in the chroot
+def get_transactions(manifest: dict) -> list:
+    match manifest["package_manager"]:
+        case "apt":
+            transactions = __get_apt_transactions(manifest)
+        case "pacman":
+            transactions = __get_pacman_transactions(manifest)
+        case "dnf":
+            transactions = __get_dnf_transactions(manifest)
+            if manifest.get("keep_cache"):  # dnf deletes downloaded packages by default
+                transactions = [transaction.replace("dnf ", "dnf --setopt=keepcache=True ", 1)
+                                for transaction in transactions]
+        case _:
+            print_error(f"Unknown package manager: {manifest['package_manager']}")
+            exit(1)
+
+    if manifest["services"]:
+        transactions.append(f"systemctl enable {__join(manifest['services'])}")
+    if manifest["disable_services"]:
+        transactions.append(f"systemctl disable {__join(manifest['disable_services'])}")
+    if manifest["default_target"]:
+        transactions.append(f"systemctl set-default {manifest['default_target']}")
+    return transactions
+
+
+# Install the packages of a distro + de. chroot is the chroot function of the distro
+def install(distro_name: str, de_name: str, distro_version: str, chroot) -> None:
+    manifest = load_manifest(distro_name, de_name, distro_version)
+    if manifest["components"]:
+        add_apt_components(manifest["components"])
+    package_cache = None
+    if cache.enabled:
+        package_cache = mount_package_cache(f"{distro_name}-{distro_version or 'latest'}", manifest["package_manager"])
+        manifest["keep_cache"] = package_cache is not None
+    transactions = get_transactions(manifest)
+
+    print_status("Downloading and installing packages, might take a while")
+    try:
+        for index, transaction in enumerate(transactions):
+            run_transaction(transaction, manifest["package_manager"], f"Packages({index + 1}/{len(transactions)})",
+                            chroot)
+    finally:
+        if package_cache is not None:
+            unmount_package_cache(manifest["package_manager"])
+            prune_package_cache(package_cache)
+            __unlock_package_cache()
+
+
+# Run a transaction in the chroot and show its progress. The output is only shown if the transaction fails
+def run_transaction(transaction: str, package_manager: str, label: str, chroot) -> None:
+    if functions.verbose:
+        chroot(transaction)
+        return
+    rmfile(f"/mnt/eupnea{log_path}")
+    progress.start_progress(get_progress=lambda: get_progress(package_manager), label=label, unit="")
+    try:
+        chroot(f"{transaction} > {log_path} 2>&1")
+    except subprocess.CalledProcessError:
+        progress.stop_progress()
+        with open(f"/mnt/eupnea{log_path}", "r", errors="replace") as file:
+            print_error(f"{transaction} failed:\n" + "".join(file.readlines()[-20:]))
+        raise
+    finally:
+        progress.stop_progress()
+
+
+# Parse the package manager log of the running transaction. Returns (done steps, total steps) or None if the package
+# manager hasn't started yet. apt and dnf count downloading and installing a package as separate steps, pacman only
+# reports the installation
+def get_progress(package_manager: str) -> tuple | None:
+    try:
+        with open(f"/mnt/eupnea{log_path}", "r", errors="replace") as file:
+            output = file.read()
+    except FileNotFoundError:
+        return None
+    match package_manager:
+        case "apt":
+            summary = apt_summary.search(output)
+            if summary is None:
+                return None
+            upgraded, installed, reinstalled, removed = (int(count or 0) for count in summary.groups())
+            total = 2 * (upgraded + installed + reinstalled) + removed
+            return min(len(apt_steps.findall(output)), total), total
+        case "dnf":
+            downloads = dnf_downloads.findall(output)
+            steps = dnf_steps.findall(output)
+            if not downloads and not steps:
+                return None
+            total = int((steps or downloads)[-1][1])
+            # cached packages are not downloaded -> count them as downloaded once the installation starts
+            downloaded = total if steps else int(downloads[-1][0])
+            return downloaded + (int(steps[-1][0]) if steps else 0), 2 * total
+        case "pacman":
+            steps = pacman_steps.findall(output)
+            return (int(steps[-1][0]), int(steps[-1][1])) if steps else None
+    return None
+
+
+# Add components(e.g. non-free) to all repos in /etc/apt/sources.list
+def add_apt_components(components: list) -> None:
+    with open("/mnt/eupnea/etc/apt/sources.list", "r") as file:
+        sources = file.readlines()
+    for index, line in enumerate(sources):
+        if line.startswith("deb"):
+            words = line.split()
+            sources[index] = " ".join(words + [component for component in components if component not in words[3:]])
+            sources[index] += "\n"
+    with open("/mnt/eupnea/etc/apt/sources.list", "w") as file:
+        file.writelines(sources)
+
+
+# Bind mount the host package cache into the chroot. Returns the host cache dir, or None if the cache is in use by
+# another build
+def mount_package_cache(cache_name: str, package_manager: str) -> Path | None:
+    package_cache = cache.cache_dir.joinpath("packages", cache_name)
+    package_cache.mkdir(parents=True, exist_ok=True)
+    if not __lock_package_cache(package_cache):
+        print_warning(f"Package cache {package_cache} is in use by another build, downloading packages without it")
+        return None
+    chroot_cache = f"/mnt/eupnea{cache_mounts[package_manager]}"
+    mkdir(chroot_cache, create_parents=True)
+    print_status(f"Using package cache: {package_cache}")
+    runner.run(["mount", "--bind", package_cache.as_posix(), chroot_cache])
+    if package_manager == "apt":
+        # some rootfs tarballs are configured to delete downloaded packages
+        with open("/mnt/eupnea/etc/apt/apt.conf.d/99eupnea-keep-cache", "w") as file:
+            file.write('APT::Keep-Downloaded-Packages "true";\nBinary::apt::APT::Keep-Downloaded-Packages "true";\n')
+    return package_cache
+
+
+# Unmount the host package cache from the chroot, so that no packages end up in the image
+def unmount_package_cache(package_manager: str) -> None:
+    rmfile("/mnt/eupnea/etc/apt/apt.conf.d/99eupnea-keep-cache")
+    try:
+        runner.run(["umount", f"/mnt/eupnea{cache_mounts[package_manager]}"])
+    except subprocess.CalledProcessError:  # still busy, e.g. a leftover gpg-agent
+        runner.run(["umount", "-l", f"/mnt/eupnea{cache_mounts[package_manager]}"])
+
+
+# Remove old versions of cached packages, then the least recently downloaded packages until the cache is smaller than
+# cache_max_size
+def prune_package_cache(package_cache: Path) -> None:
+    versions = {}  # (dir, package name) -> [(mtime, path)] of all cached versions
+    for root, _, files in os.walk(package_cache):
+        for file_name in files:
+            if file_name.endswith(package_extensions):
+                path = os.path.join(root, file_name)
+                versions.setdefault((root, __get_package_name(file_name)), []).append((os.stat(path).st_mtime, path))
+
+    packages = []
+    for package_versions in versions.values():
+        package_versions.sort()
+        for _, path in package_versions[:-1]:  # the newest download is the newest version
+            os.unlink(path)
+        packages.append(package_versions[-1])
+
+    total_size = sum(os.path.getsize(path) for _, path in packages)
+    for _, path in sorted(packages):
+        if total_size <= cache_max_size:
+            break
+        total_size -= os.path.getsize(path)
+        os.unlink(path)
+
+
+# Do not call this function directly
+def __lock_package_cache(package_cache: Path) -> bool:
+    global _cache_lock
+    lock_file = open(package_cache.joinpath(".lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    _cache_lock = lock_file
+    return True
+
+
+# Do not call this function directly
+def __unlock_package_cache() -> None:
+    global _cache_lock
+    _cache_lock.close()  # closing the file releases the lock
+    _cache_lock = None
+
+
+# Do not call this function directly
+# Get the name + architecture of a package from its file name, without the version
+def __get_package_name(file_name: str) -> str:
+    if file_name.endswith(".deb"):  # name_version_arch.deb
+        name_parts = file_name[:-4].split("_")
+        return f"{name_parts[0]}_{name_parts[-1]}"
+    if file_name.endswith(".rpm"):  # name-version-release.arch.rpm
+        return f"{file_name[:-4].rsplit('-', 2)[0]}.{file_name[:-4].rsplit('.', 1)[-1]}"
+    # name-version-release-arch.pkg.tar.zst
+    name_parts = file_name.split(".pkg.tar")[0].rsplit("-", 3)
+    return f"{name_parts[0]}-{name_parts[-1]}"
+
+
+# Do not call this function directly, use get_transactions() instead
+def __get_apt_transactions(manifest: dict) -> list:
+    apt = "DEBIAN_FRONTEND=noninteractive apt-get -y"  # noninteractive skips locale setup questions
+    transactions = [f"{apt} update"]
+    if manifest["repos"]:
+        transactions.append(f"{apt} install {__join(manifest['repo_packages'])}")
+        transactions.extend(f"add-apt-repository -y -n {repo}" for repo in manifest["repos"])
+        transactions.append(f"{apt} update")
+    if manifest["upgrade"]:
+        transactions.append(f"{apt} full-upgrade")
+    if manifest["minimal_packages"]:
+        transactions.append(f"{apt} install --no-install-recommends {__join(manifest['minimal_packages'])}")
+    if manifest["packages"]:
+        transactions.append(f"{apt} install {__join(manifest['packages'])}")
+    if manifest["reinstall"]:
+        transactions.append(f"{apt} install --reinstall {__join(manifest['reinstall'])}")
+    if manifest["remove"]:
+        auto_remove = " --auto-remove" if manifest["autoremove"] else ""
+        transactions.append(f"{apt} remove{auto_remove} {__join(manifest['remove'])}")
+    return transactions
+
+
+# Do not call this function directly, use get_transactions() instead
+def __get_pacman_transactions(manifest: dict) -> list:
+    transactions = []
+    # pacman has no recommended packages -> minimal packages are installed in the same transaction. The repos are
+    # synced and the system upgraded in the same transaction too
+    packages = manifest["packages"] + manifest["minimal_packages"]
+    if manifest["upgrade"]:
+        transactions.append(f"pacman -Syu --noconfirm --needed {__join(packages)}")
+    elif packages:
+        transactions.append(f"pacman -Sy --noconfirm --needed {__join(packages)}")
+    if manifest["reinstall"]:
+        transactions.append(f"pacman -S --noconfirm {__join(manifest['reinstall'])}")
+    if manifest["remove"]:
+        transactions.append(f"pacman -Rns --noconfirm {__join(manifest['remove'])}")
+    return transactions
+
+
+# Do not call this function directly, use get_transactions() instead
+def __get_dnf_transactions(manifest: dict) -> list:
+    transactions = []
+    if manifest["upgrade"]:
+        transactions.append("dnf upgrade -y")
+    if manifest["minimal_packages"]:
+        transactions.append(f"dnf install -y --setopt=install_weak_deps=False "
+                            f"{__join(manifest['minimal_packages'])}")
+    # groups, environments and packages are all resolved in one transaction
+    if manifest["packages"]:
+        transactions.append(f"dnf install -y {__join(manifest['packages'])}")
+    if manifest["reinstall"]:
+        transactions.append(f"dnf reinstall -y {__join(manifest['reinstall'])}")
+    if manifest["remove"]:
+        transactions.append(f"dnf remove -y {__join(manifest['remove'])}")
+    return transactions
+
+
+# Do not call this function directly
+# Join package names into a shell argument list. Names with spaces(e.g. dnf groups) are quoted
+def __join(packages: list) -> str:
+    return " ".join(f"'{package}'" if " " in package else package for package in packages)
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
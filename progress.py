@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Progress of long operations(downloads, extractions, package installs), shown on one line that is updated by a
+# thread, see start_progress()
+
+import os
+from time import monotonic
+from threading import Thread, Event
+from typing import Optional
+
+import functions
+from functions import *
+
+progress_interval = 0.5  # seconds between progress updates
+download_progress = {}  # path -> (downloaded bytes, total bytes or None), see set_download_progress()
+
+__progress_thread = None
+__progress_stop = Event()
+
+
+# Show the progress of a long operation until stop_progress() is called. Only one progress is shown at a time.
+# get_progress returns (done, total) of the operation, total is None if unknown. It returns None if there is nothing
+# to show yet.
+# It's called from the progress thread every progress_interval seconds, and the rate and ETA are calculated from it.
+# Without get_progress, a dot is printed every 2 seconds.
+# unit is "mb" for bytes(shown in mb) or "" for counts(e.g. packages)
+def start_progress(force_show: bool = False, get_progress=None, label: str = "Progress", unit: str = "mb") -> None:
+    global __progress_thread
+    if not force_show and functions.verbose:
+        return
+    stop_progress(force_show=True)  # stop the previous progress, if any
+    __progress_stop.clear()
+    __progress_thread = Thread(target=__print_progress, args=(get_progress, label, unit), daemon=True)
+    __progress_thread.start()
+
+
+def stop_progress(force_show: bool = False) -> None:
+    global __progress_thread
+    if __progress_thread is None:
+        return
+    __progress_stop.set()
+    __progress_thread.join()
+    __progress_thread = None
+
+
+# Show the progress of a download started with a downloader that reports to set_download_progress(). Falls back to the
+# size of the file on disk
+def start_download_progress(file_path_str: str) -> None:
+    start_progress(force_show=True, label="Downloaded",
+                   get_progress=lambda: download_progress.get(file_path_str) or __get_file_size(file_path_str))
+
+
+def stop_download_progress() -> None:
+    stop_progress(force_show=True)
+
+
+# Report the progress of a download to path, for start_download_progress()
+def set_download_progress(path: str, done: int, total: Optional[int]) -> None:
+    download_progress[path] = (done, total)
+
+
+# Do not call this function directly, use start_progress() instead
+# Event.wait() returns as soon as stop_progress() is called, so stopping never waits for the interval
+def __print_progress(get_progress, label: str, unit: str) -> None:
+    if get_progress is None:
+        while not __progress_stop.wait(2):
+            print(".", end="", flush=True)
+        return
+
+    start_time = monotonic()
+    start_done = None
+    line_length = 0
+    while True:
+        stopping = __progress_stop.wait(progress_interval)
+        progress = get_progress()
+        if progress is not None:
+            done, total = progress
+            if start_done is None:  # the rate only includes progress made while it was shown
+                start_done = done
+                start_time = monotonic()
+            line = __format_progress(label, unit, done, total, (done - start_done) / max(monotonic() - start_time,
+                                                                                          0.001))
+            print("\r" + line.ljust(line_length), end="", flush=True)
+            line_length = len(line)
+        if stopping:
+            if line_length:
+                print("")  # break line after progress
+            return
+
+
+# Do not call this function directly
+def __format_progress(label: str, unit: str, done: int, total: Optional[int], rate: float) -> str:
+    scale = 1048576 if unit == "mb" else 1
+    line = f"{label}: {done / scale:.0f}{unit}"
+    if total:
+        line += f"/{total / scale:.0f}{unit}({min(done / total, 1):.0%})"
+    if rate > 0:
+        line += f", {rate / scale:.1f}{unit}/s"
+        if total and total > done:
+            eta = int((total - done) / rate)
+            line += f", ETA {eta // 60}:{eta % 60:02d}"
+    return line
+
+
+# Do not call this function directly
+def __get_file_size(path: str) -> Optional[tuple]:
+    try:
+        return os.stat(path).st_size, None
+    except FileNotFoundError:  # download hasn't started yet
+        return None
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
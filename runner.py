@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Running of host commands: argv lists without a shell, output streamed to the console and the command log, timeouts
+# and process groups that are killed if the builder is interrupted, see run().
+# main.py imports this before checking the python version, so it must stay compatible with python 3.9
+
+import os
+import signal
+import subprocess
+from collections import deque
+from threading import Thread, Event, Lock, Timer
+from time import perf_counter
+from typing import Optional
+
+import functions
+from functions import *
+
+command_tracer = None  # waits for the commands of run() and records them if set, see timing.py
+command_log = None  # file that the output of all commands is written to, see set_command_log()
+error_lines = 50  # lines of command output kept for errors
+
+__output_lock = Lock()
+
+
+# run a command. command is an argv list, which is run directly, or a string, which is run with /bin/sh(only needed for
+# pipes, redirects, globs etc.)
+# The output(stdout + stderr) is streamed line by line to the console in verbose mode or with show_output, and to the
+# command log. Only the last error_lines lines are kept, they are the output of the CalledProcessError if the command
+# fails. With capture, stdout is returned instead and only stderr is streamed. input_text is written to stdin, otherwise
+# stdin is empty.
+# The command runs in its own process group, which is killed on timeout(in seconds) and if the builder is interrupted
+def run(command, capture: bool = False, timeout: float = None, show_output: bool = False,
+        input_text: str = None) -> Optional[str]:
+    start = perf_counter()
+    process = subprocess.Popen(["/bin/sh", "-c", command] if isinstance(command, str) else command,
+                               stdin=subprocess.PIPE if input_text is not None else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE if capture else subprocess.STDOUT, text=True, errors="replace",
+                               start_new_session=True)
+    show_output = show_output or functions.verbose
+    output_tail = deque(maxlen=error_lines)
+    log_output(f"$ {command if isinstance(command, str) else ' '.join(command)}\n", False)
+    timed_out = Event()
+    timer = Timer(timeout, lambda: (timed_out.set(), __kill_process_group(process))) if timeout else None
+    try:
+        if timer is not None:
+            timer.start()
+        if input_text is not None:
+            process.stdin.write(input_text)
+            process.stdin.close()
+        if capture:
+            stderr_thread = Thread(target=__stream_output, args=(process.stderr, output_tail, show_output), daemon=True)
+            stderr_thread.start()
+            output = process.stdout.read().strip()
+            stderr_thread.join()
+        else:
+            __stream_output(process.stdout, output_tail, show_output)
+            output = None
+        returncode = command_tracer(command, process, start) if command_tracer is not None else process.wait()
+    except BaseException:  # interrupted -> don't leave the command running
+        __kill_process_group(process)
+        process.wait()
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(command, timeout, "".join(output_tail))
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output if capture else "".join(output_tail),
+                                            "".join(output_tail) if capture else None)
+    return output
+
+
+# Write the output of all commands to a file
+def set_command_log(path: str) -> None:
+    global command_log
+    if command_log is not None:
+        command_log.close()
+    command_log = open(path, "a", buffering=1)  # line buffered
+
+
+# Write a line of command output to the console(if show_output) and the command log.
+# Commands can run in several threads at once, their lines are never mixed
+def log_output(line: str, show_output: bool) -> None:
+    with __output_lock:
+        if show_output:
+            print(line, end="", flush=True)
+        if command_log is not None:
+            command_log.write(line)
+
+
+# Do not call this function directly
+def __stream_output(pipe, output_tail: deque, show_output: bool) -> None:
+    with pipe:
+        for line in pipe:
+            output_tail.append(line)
+            log_output(line, show_output)
+
+
+# Do not call this function directly
+def __kill_process_group(process: subprocess.Popen) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:  # already exited
+        pass
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
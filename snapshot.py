@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Snapshots of the configured rootfs, taken after the distro/DE install and before any per-user configuration.
+# Builds that only differ in username, password, hostname etc. restore the snapshot instead of extracting the rootfs
+# and installing the DE again. Snapshots are stored in the download cache as compressed tar archives.
+# The key covers everything that ends up in the snapshot: the distro, DE, kernel, git repos and the builder files that
+# configure the rootfs. Changing any of them creates a new snapshot.
+
+import json
+import hashlib
+from pathlib import Path
+
+from functions import *
+import runner
+import cache
+import archive
+import file_ops
+
+# builder files that change the contents of the rootfs
+builder_files = ["build.py", "functions.py", "archive.py", "file_ops.py", "packages.py", "packages.json",
+                 "firmware.py", "firmware.json"]
+builder_dirs = ["configs"]
+# git repos that are copied into the rootfs
+repos = ["/tmp/eupnea-build/firmware", "/tmp/eupnea-build/postinstall-scripts", "/tmp/eupnea-build/audio-scripts"]
+# temporary files and downloaded packages are left out of the snapshot
+excluded_files = ["./tmp/*", "./var/tmp/*", "./var/cache/apt/archives/*.deb",
+                  "./var/cache/pacman/pkg/*", "./var/cache/dnf/*"]
+
+
+# Get the snapshot key of a build. kernel_path is the downloaded bzImage
+def get_key(distro_name: str, distro_version: str, distro_link: str, de_name: str, kernel_type: str,
+            firmware_profile: str, kernel_path: str) -> str:
+    key_hash = hashlib.sha256()
+    key_hash.update(json.dumps([distro_name, distro_version, distro_link, de_name, kernel_type,
+                                firmware_profile]).encode())
+    for file in builder_files + [f"distro/{distro_name}.py", kernel_path]:
+        key_hash.update(__hash_file(file).encode())
+    for directory in builder_dirs:
+        for file in sorted(Path(directory).rglob("*")):
+            if file.is_file():
+                key_hash.update(file.as_posix().encode() + __hash_file(file.as_posix()).encode())
+    for repo in repos:
+        try:
+            key_hash.update(runner.run(["git", "-C", repo, "rev-parse", "HEAD"], capture=True).encode())
+        except subprocess.CalledProcessError:
+            key_hash.update(b"none")
+    return f"snapshot:{distro_name}-{distro_version or 'latest'}-{de_name}-{kernel_type}-{key_hash.hexdigest()[:16]}"
+
+
+# Restore a snapshot to /mnt/eupnea. Returns False if there is no snapshot for the key
+def restore(key: str, root_partuuid: str) -> bool:
+    snapshot = cache.lookup(key)
+    if snapshot is None:
+        return False
+    path, metadata = snapshot
+    print_status(f"Restoring rootfs snapshot {key}")
+    try:
+        archive.extract_tar(path.as_posix(), "/mnt/eupnea", metadata["compression"], preserve_all=True)
+    except (subprocess.CalledProcessError, ValueError) as err:
+        print_warning(f"Failed to restore snapshot: {err}, building rootfs from scratch")
+        file_ops.rmdir("/mnt/eupnea")
+        return False
+    # fstab contains the PARTUUID of the image the snapshot was taken from
+    if path_exists("/mnt/eupnea/etc/fstab"):
+        with open("/mnt/eupnea/etc/fstab", "r") as file:
+            fstab = file.read()
+        with open("/mnt/eupnea/etc/fstab", "w") as file:
+            file.write(fstab.replace(metadata["root_partuuid"], root_partuuid))
+    return True
+
+
+# Save /mnt/eupnea as a snapshot
+def create(key: str, root_partuuid: str) -> None:
+    print_status("Saving rootfs snapshot for future builds")
+    tmp_path = cache.get_tmp_path("snapshot")
+    try:
+        compression = archive.create_tar("/mnt/eupnea", tmp_path.as_posix(), excluded_files)
+        cache.add_file(key, tmp_path.as_posix(), {"compression": compression, "root_partuuid": root_partuuid})
+    except (subprocess.CalledProcessError, OSError) as err:
+        print_warning(f"Failed to save snapshot: {err}")  # the build itself is not affected
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+# Do not call this function directly
+def __hash_file(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(1048576):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")
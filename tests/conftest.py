@@ -0,0 +1,140 @@
+# Fixtures for the download and cache tests: a local http server with byte ranges and ETags, like the GitHub and
+# distro mirrors, and local git repos that are cloned over file://. Run from the repo root: python -m pytest tests
+
+import os
+import sys
+import subprocess
+import threading
+from time import sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cache
+import downloader
+
+
+# Serves the files of its server from memory. Supports Range, If-Range, If-None-Match and keep-alive connections
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            self.__send_file()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def __send_file(self):
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data, etag = self.server.files[self.path]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        # a range is only sent if the file is still the one the client has parts of
+        if self.headers.get("Range", "").startswith("bytes=") and self.headers.get("If-Range", etag) == etag:
+            range_start, range_end = self.headers["Range"][6:].split("-")
+            start, end = int(range_start), min(int(range_end or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        sleep(self.server.delay)  # keeps the requests open long enough to see if they overlap
+        if start in self.server.broken_ranges:  # the connection breaks off in the middle of the response
+            self.wfile.write(data[start:start + (end - start + 1) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class FileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RangeRequestHandler)
+        self.files = {}  # path -> (data, etag)
+        self.requests = []  # (path, headers) of every request
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = 0
+        self.broken_ranges = set()  # start offsets of ranges that are only sent halfway
+
+    def add_file(self, path: str, data: bytes, etag: str = '"v1"') -> str:
+        self.files[path] = (data, etag)
+        return self.url(path)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+    # headers of the requests for path
+    def get_requests(self, path: str) -> list:
+        return [headers for request_path, headers in self.requests if request_path == path]
+
+
+@pytest.fixture
+def http_server():
+    server = FileServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Small segments, so that files of a few hundred kb are downloaded in several ranges
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(downloader, "download_segment_size", 65536)
+    monkeypatch.setattr(downloader, "download_connections", 4)
+    monkeypatch.setattr(downloader, "download_retries", 0)
+
+
+@pytest.fixture
+def download_cache(tmp_path):
+    old_settings = (cache.cache_dir, cache.enabled, cache.max_size)
+    cache.configure(tmp_path.joinpath("cache").as_posix(), True)
+    cache.hits.clear()
+    cache.misses.clear()
+    yield cache
+    cache.cache_dir, cache.enabled, cache.max_size = old_settings
+
+
+# Create a bare git repo with files({path: content}) in one commit. Returns its file:// url
+def create_repo(path: str, files: dict) -> str:
+    subprocess.run(["git", "init", "-q", "--bare", path], check=True)
+    # partial clones fetch single files by their object id
+    subprocess.run(["git", "-C", path, "config", "uploadpack.allowFilter", "true"], check=True)
+    subprocess.run(["git", "-C", path, "config", "uploadpack.allowAnySHA1InWant", "true"], check=True)
+    commit_files(path, files)
+    return f"file://{path}"
+
+
+# Add a commit with files({path: content}) to a bare repo created with create_repo()
+def commit_files(path: str, files: dict) -> None:
+    work_tree = f"{path}.work"
+    for file_path, content in files.items():
+        os.makedirs(os.path.dirname(f"{work_tree}/{file_path}"), exist_ok=True)
+        with open(f"{work_tree}/{file_path}", "w") as file:
+            file.write(content)
+    git = ["git", "--git-dir", path, "--work-tree", work_tree]
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "-q", "-m", "update"],
+                   check=True)
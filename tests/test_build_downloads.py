@@ -0,0 +1,53 @@
+# start_downloads() downloads the kernel files, the rootfs and the git repos of a build at the same time
+
+import os
+import shutil
+
+import pytest
+
+from conftest import create_repo
+import build
+
+kernel_files = ["bzImage", "modules.tar.xz", "headers.tar.xz"]
+
+
+# start_downloads() always downloads to /tmp/eupnea-build, which every build clears at the start
+@pytest.fixture
+def build_sources(http_server, download_cache, tmp_path, monkeypatch):
+    shutil.rmtree("/tmp/eupnea-build", ignore_errors=True)
+    os.makedirs("/tmp/eupnea-build")
+    monkeypatch.setattr(build, "stream_urls", {})
+    monkeypatch.setattr(build, "kernel_release_url", http_server.url("/kernel/"))
+    for file_name in kernel_files:
+        http_server.add_file(f"/kernel/latest/download/{file_name}", file_name.encode() * 1000)
+    http_server.add_file("/arch-rootfs.tar.gz", b"rootfs" * 1000)
+    for name in ["firmware", "postinstall", "audio"]:
+        monkeypatch.setattr(build, f"{name}_repo", create_repo(f"{tmp_path}/{name}.git", {"README": name}))
+    yield http_server.url("/arch-rootfs.tar.gz")
+    shutil.rmtree("/tmp/eupnea-build", ignore_errors=True)
+
+
+def test_downloads_run_at_the_same_time(http_server, build_sources):
+    http_server.delay = 0.5
+    downloads = build.start_downloads("stable", False, "arch", "latest", build_sources, firmware_profile="all")
+    build.wait_downloads(downloads)
+
+    for file_name in kernel_files:
+        with open(f"/tmp/eupnea-build/{file_name}", "rb") as file:
+            assert file.read() == file_name.encode() * 1000
+    with open("/tmp/eupnea-build/arch-rootfs.tar.gz", "rb") as file:
+        assert file.read() == b"rootfs" * 1000
+    with open("/tmp/eupnea-build/audio-scripts/README", "r") as file:
+        assert file.read() == "audio"
+    # every file is a single request, which the server holds open for 0.5s
+    assert http_server.max_in_flight == 4
+
+
+def test_streamed_files_are_not_downloaded(http_server, build_sources):
+    downloads = build.start_downloads("stable", False, "arch", "latest", build_sources, stream=True)
+    build.wait_downloads(downloads)
+
+    assert os.path.exists("/tmp/eupnea-build/bzImage")
+    assert set(build.stream_urls) == {"modules.tar.xz", "headers.tar.xz", "arch-rootfs.tar.gz"}
+    assert not http_server.get_requests("/arch-rootfs.tar.gz")
+    assert not os.path.exists("/tmp/eupnea-build/arch-rootfs.tar.gz")
@@ -0,0 +1,63 @@
+# The download cache keeps files by content, skips unchanged files with conditional requests and removes the least
+# recently used files when it grows over max_size
+
+import os
+
+import cache
+
+file_size = 100000
+
+
+def get_cached_urls() -> set:
+    with cache._lock_index():
+        return set(cache._get_index())
+
+
+def get_objects_size() -> int:
+    objects_dir = cache.cache_dir.joinpath("objects")
+    return sum(path.stat().st_size for path in objects_dir.iterdir() if not path.name.startswith("."))
+
+
+def test_unchanged_file_is_not_downloaded_again(http_server, download_cache, tmp_path):
+    url = http_server.add_file("/file", os.urandom(file_size))
+    cache.fetch(url, f"{tmp_path}/first")
+    cache.fetch(url, f"{tmp_path}/second")
+
+    with open(f"{tmp_path}/first", "rb") as first, open(f"{tmp_path}/second", "rb") as second:
+        assert first.read() == second.read() == http_server.files["/file"][0]
+    assert http_server.get_requests("/file")[-1]["If-None-Match"] == '"v1"'
+    assert [size for _, size in cache.hits] == [file_size]
+
+
+def test_identical_files_are_stored_once(http_server, download_cache, tmp_path):
+    data = os.urandom(file_size)
+    cache.fetch(http_server.add_file("/mirror1/file", data), f"{tmp_path}/first")
+    cache.fetch(http_server.add_file("/mirror2/file", data), f"{tmp_path}/second")
+
+    assert len(get_cached_urls()) == 2
+    assert get_objects_size() == file_size
+
+
+def test_least_recently_used_files_are_evicted(http_server, download_cache, tmp_path):
+    cache.configure(cache.cache_dir.as_posix(), True, int(file_size * 2.5))
+    urls = {name: http_server.add_file(f"/{name}", os.urandom(file_size)) for name in ["a", "b", "c"]}
+    cache.fetch(urls["a"], f"{tmp_path}/a")
+    cache.fetch(urls["b"], f"{tmp_path}/b")
+    cache.fetch(urls["a"], f"{tmp_path}/a")  # a is now used more recently than b
+    cache.fetch(urls["c"], f"{tmp_path}/c")
+
+    assert get_cached_urls() == {urls["a"], urls["c"]}
+    assert get_objects_size() <= cache.max_size
+    # files that were already fetched are not affected by the eviction
+    with open(f"{tmp_path}/b", "rb") as file:
+        assert file.read() == http_server.files["/b"][0]
+
+
+def test_file_that_is_bigger_than_the_cache_is_kept_until_the_next_download(http_server, download_cache, tmp_path):
+    cache.configure(cache.cache_dir.as_posix(), True, file_size // 2)
+    url = http_server.add_file("/big", os.urandom(file_size))
+    cache.fetch(url, f"{tmp_path}/big")
+
+    assert get_cached_urls() == {url}
+    cache.fetch(http_server.add_file("/next", os.urandom(file_size)), f"{tmp_path}/next")
+    assert url not in get_cached_urls()
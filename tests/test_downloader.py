@@ -0,0 +1,84 @@
+# Segmented downloads over several connections, and continuing interrupted downloads with If-Range
+
+import os
+import json
+from urllib.error import URLError
+
+import pytest
+
+import downloader
+
+segment_size = 65536  # see the small_segments fixture
+file_size = 5 * segment_size + 1000
+
+
+# Get the start offsets of the range requests for path
+def get_range_starts(requests: list) -> list:
+    return [int(headers["Range"][6:].split("-")[0]) for headers in requests if "Range" in headers]
+
+
+# Download a file with a broken segment, which leaves <path>.part and <path>.part.json behind. Returns the state
+def interrupt_download(http_server, url: str, path: str) -> dict:
+    http_server.broken_ranges = {2 * segment_size}
+    with pytest.raises(URLError):
+        downloader.download(url, path)
+    http_server.broken_ranges = set()
+    with open(f"{path}.part.json", "r") as file:
+        return json.load(file)
+
+
+def test_segments_are_downloaded_in_parallel(http_server, small_segments, tmp_path):
+    data = os.urandom(file_size)
+    http_server.delay = 0.2
+    headers = downloader.download(http_server.add_file("/rootfs", data), f"{tmp_path}/rootfs")
+
+    with open(f"{tmp_path}/rootfs", "rb") as file:
+        assert file.read() == data
+    assert headers == {"etag": '"v1"', "last_modified": None, "size": file_size}
+    assert sorted(get_range_starts(http_server.get_requests("/rootfs"))) == [segment * segment_size
+                                                                            for segment in range(6)]
+    assert http_server.max_in_flight > 1
+    assert os.listdir(tmp_path) == ["rootfs"]
+
+
+def test_interrupted_download_is_continued(http_server, small_segments, tmp_path):
+    data = os.urandom(file_size)
+    url = http_server.add_file("/rootfs", data)
+    state = interrupt_download(http_server, url, f"{tmp_path}/rootfs")
+    assert 2 not in state["done"]
+
+    http_server.requests.clear()
+    downloader.download(url, f"{tmp_path}/rootfs")
+    with open(f"{tmp_path}/rootfs", "rb") as file:
+        assert file.read() == data
+    # only the missing segments are downloaded again, if the file is still the same
+    requests = http_server.get_requests("/rootfs")
+    assert requests[0]["If-Range"] == '"v1"'
+    range_starts = get_range_starts(requests)
+    assert 2 * segment_size in range_starts
+    assert not {segment * segment_size for segment in state["done"]} & set(range_starts)
+    assert os.listdir(tmp_path) == ["rootfs"]
+
+
+def test_changed_file_is_downloaded_from_the_start(http_server, small_segments, tmp_path):
+    url = http_server.add_file("/rootfs", os.urandom(file_size))
+    interrupt_download(http_server, url, f"{tmp_path}/rootfs")
+
+    # the server ignores the range if the ETag in If-Range doesn't match anymore, and sends the whole new file
+    new_data = os.urandom(file_size + 5000)
+    http_server.add_file("/rootfs", new_data, etag='"v2"')
+    http_server.requests.clear()
+    headers = downloader.download(url, f"{tmp_path}/rootfs")
+
+    with open(f"{tmp_path}/rootfs", "rb") as file:
+        assert file.read() == new_data
+    assert headers["etag"] == '"v2"'
+    assert headers["size"] == len(new_data)
+    assert http_server.get_requests("/rootfs")[0]["If-Range"] == '"v1"'
+    assert os.listdir(tmp_path) == ["rootfs"]
+
+
+def test_unchanged_file_is_skipped(http_server, small_segments, tmp_path):
+    url = http_server.add_file("/rootfs", os.urandom(file_size))
+    assert downloader.download(url, f"{tmp_path}/rootfs", etag='"v1"') is None
+    assert not os.path.exists(f"{tmp_path}/rootfs")
@@ -0,0 +1,76 @@
+# Git repos are fetched into cached mirrors, which builds borrow their objects from. Partial mirrors only contain the
+# commit and the file list, files are downloaded when they are needed
+
+import os
+import subprocess
+
+from conftest import create_repo, commit_files
+import cache
+
+files = {"intel/a.bin": "a", "intel/b.bin": "b", "amd/c.bin": "c", "README": "readme"}
+
+
+def git(path: str, *args) -> str:
+    return subprocess.run(["git", "-C", path, *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+# ids of the objects of the fetched commit that are not in the mirror of repo_url
+def get_missing_objects(repo_url: str) -> set:
+    output = git(cache._repo_path(repo_url).as_posix(), "rev-list", "--objects", "--missing=print", cache.mirror_ref)
+    return {line[1:] for line in output.splitlines() if line.startswith("?")}
+
+
+def test_mirror_is_updated_incrementally(download_cache, tmp_path):
+    repo_url = create_repo(f"{tmp_path}/origin.git", files)
+    cache.fetch_repo(repo_url, f"{tmp_path}/first")
+    commit_files(f"{tmp_path}/origin.git", {"intel/a.bin": "new a"})
+    cache.fetch_repo(repo_url, f"{tmp_path}/second")
+    cache.fetch_repo(repo_url, f"{tmp_path}/third")
+
+    with open(f"{tmp_path}/second/intel/a.bin", "r") as file:
+        assert file.read() == "new a"
+    assert git(f"{tmp_path}/third", "rev-parse", "HEAD") == git(f"{tmp_path}/origin.git", "rev-parse", "HEAD")
+    # the build repos have no objects of their own
+    assert git(f"{tmp_path}/second", "count-objects").startswith("0 objects")
+    assert [url for url, _ in cache.misses] == [repo_url, repo_url]
+    assert [url for url, _ in cache.hits] == [repo_url]
+
+
+def test_cached_mirror_is_used_if_origin_is_unreachable(download_cache, tmp_path):
+    repo_url = create_repo(f"{tmp_path}/origin.git", files)
+    cache.fetch_repo(repo_url, f"{tmp_path}/first")
+    os.rename(f"{tmp_path}/origin.git", f"{tmp_path}/moved.git")
+    cache.fetch_repo(repo_url, f"{tmp_path}/second")
+
+    with open(f"{tmp_path}/second/README", "r") as file:
+        assert file.read() == "readme"
+
+
+def test_partial_mirror_only_downloads_requested_files(download_cache, tmp_path):
+    repo_url = create_repo(f"{tmp_path}/origin.git", files)
+    cache.fetch_repo(repo_url, f"{tmp_path}/build", partial=True)
+
+    # the file list is there, the files are not
+    assert set(git(f"{tmp_path}/build", "ls-tree", "-r", "--name-only", "HEAD").splitlines()) == set(files)
+    assert not os.path.exists(f"{tmp_path}/build/README")
+    assert len(get_missing_objects(repo_url)) == len(files)
+
+    cache.fetch_repo_files(f"{tmp_path}/build", {"intel/a.bin", "intel/b.bin"})
+    assert len(get_missing_objects(repo_url)) == len(files) - 2
+    # the requested files are in the mirror now, checking them out doesn't need the origin
+    os.rename(f"{tmp_path}/origin.git", f"{tmp_path}/moved.git")
+    git(f"{tmp_path}/build", "checkout", "HEAD", "--", "intel")
+    with open(f"{tmp_path}/build/intel/b.bin", "r") as file:
+        assert file.read() == "b"
+
+
+def test_full_checkout_from_partial_mirror(download_cache, tmp_path):
+    repo_url = create_repo(f"{tmp_path}/origin.git", files)
+    cache.fetch_repo(repo_url, f"{tmp_path}/partial", partial=True)
+    cache.fetch_repo(repo_url, f"{tmp_path}/full")
+
+    for file_path, content in files.items():
+        with open(f"{tmp_path}/full/{file_path}", "r") as file:
+            assert file.read() == content
+    # the files were added to the mirror, later builds don't download them again
+    assert not get_missing_objects(repo_url)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# Timing trace of a build, enabled with --trace.
+# Every build stage and every command run with runner.run()/chroot() is recorded with its wall time, cpu time(rusage of
+# the command and all its children), bytes read/written(/proc/<pid>/io) and exit status. The trace is saved in the
+# Chrome trace format, which can be opened in chrome://tracing or https://ui.perfetto.dev, and a summary of the slowest
+# stages and commands is printed at the end of the build.
+# Stages are measured for the whole builder process, so they include python work(downloads, copying) and all
+# commands that run in the background at the same time.
+
+import os
+import sys
+import json
+import resource
+import threading
+from contextlib import contextmanager
+from time import time, perf_counter
+
+from functions import *
+import runner
+
+enabled = False
+trace_path = "eupnea-trace.json"
+summary_length = 15  # number of commands in the summary
+
+_events = []
+_secrets = []  # strings that are replaced in the trace, e.g. the user password
+_start_time = 0.0
+
+
+def enable(new_trace_path: str) -> None:
+    global enabled, trace_path, _start_time
+    enabled = True
+    trace_path = new_trace_path
+    _start_time = perf_counter()
+    _events.clear()
+    runner.command_tracer = record_command
+
+
+# Hide a string in all recorded commands
+def redact(secret: str) -> None:
+    if secret:
+        _secrets.append(secret)
+
+
+# Record a build stage. Stages can be nested
+@contextmanager
+def stage(name: str):
+    if not enabled:
+        yield
+        return
+    start = perf_counter()
+    start_usage = __get_rusage()
+    start_io = __read_io("self")
+    try:
+        yield
+    finally:
+        end_usage = __get_rusage()
+        end_io = __read_io("self")
+        __add_event(name, "stage", start, perf_counter(), {
+            "cpu_time": round(end_usage - start_usage, 3),
+            "read_bytes": end_io.get("read_bytes", 0) - start_io.get("read_bytes", 0),
+            "write_bytes": end_io.get("write_bytes", 0) - start_io.get("write_bytes", 0)
+        })
+
+
+# Wait for a command started by runner.run() and record it. Returns the exit status
+def record_command(command, process: subprocess.Popen, start: float) -> int:
+    if not isinstance(command, str):
+        command = " ".join(command)
+    # /proc/<pid>/io is only readable until the process is reaped -> wait without reaping first. It includes the io
+    # of all children the command waited for
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    io_counters = __read_io(str(process.pid))
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    __add_event(__redact(command), "command", start, perf_counter(), {
+        "exit_status": process.returncode,
+        "cpu_time": round(usage.ru_utime + usage.ru_stime, 3),
+        "max_rss_kb": usage.ru_maxrss,
+        "read_bytes": io_counters.get("read_bytes", 0),
+        "write_bytes": io_counters.get("write_bytes", 0),
+        "rchar": io_counters.get("rchar", 0),
+        "wchar": io_counters.get("wchar", 0)
+    })
+    return process.returncode
+
+
+# Get the cpu time and io of the children a process waited for, see record_session_command()
+def read_counters(pid: int) -> dict:
+    counters = __read_io(str(pid))
+    try:
+        with open(f"/proc/{pid}/stat", "r") as file:
+            # cutime and cstime are the 16th and 17th field, the command name before them can contain spaces
+            fields = file.read().rsplit(")", 1)[1].split()
+        counters["cpu_time"] = (int(fields[13]) + int(fields[14])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        counters["cpu_time"] = 0.0
+    return counters
+
+
+# Record a command that ran as a child of a long-lived process(the chroot session), which waits for it instead of
+# runner.run(). before and after are read_counters() of that process
+def record_session_command(command: str, start: float, exit_status: int, before: dict, after: dict) -> None:
+    __add_event(__redact(command), "command", start, perf_counter(), {
+        "exit_status": exit_status,
+        "cpu_time": round(after["cpu_time"] - before["cpu_time"], 3),
+        "read_bytes": after.get("read_bytes", 0) - before.get("read_bytes", 0),
+        "write_bytes": after.get("write_bytes", 0) - before.get("write_bytes", 0),
+        "rchar": after.get("rchar", 0) - before.get("rchar", 0),
+        "wchar": after.get("wchar", 0) - before.get("wchar", 0)
+    })
+
+
+# Save the trace and print the summary. Does nothing if tracing is disabled
+def finish() -> None:
+    if not enabled:
+        return
+    runner.command_tracer = None
+    with open(trace_path, "w") as file:
+        json.dump({"traceEvents": _events, "displayTimeUnit": "ms",
+                   "otherData": {"created": time(), "command": __redact(" ".join(sys.argv))}}, file)
+
+    print_header(f"Build trace saved to {get_full_path(trace_path)}")
+    stages = [event for event in _events if event["cat"] == "stage"]
+    commands = sorted((event for event in _events if event["cat"] == "command"), key=lambda event: -event["dur"])
+    print_status("Stages:")
+    __print_table(stages)
+    print_status(f"Slowest commands({min(summary_length, len(commands))} of {len(commands)}):")
+    __print_table(commands[:summary_length])
+
+
+# Do not call this function directly
+def __add_event(name: str, category: str, start: float, end: float, args: dict) -> None:
+    # list.append is thread safe, commands can run in the download threads
+    _events.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": round((start - _start_time) * 1000000), "dur": round((end - start) * 1000000),
+                    "args": args})
+
+
+# Do not call this function directly
+def __print_table(events: list) -> None:
+    print(f"{'wall':>9} {'cpu':>9} {'read':>9} {'written':>9} {'exit':>4}  name")
+    for event in events:
+        args = event["args"]
+        name = event["name"] if len(event["name"]) <= 80 else event["name"][:77] + "..."
+        print(f"{event['dur'] / 1000000:>8.1f}s {args['cpu_time']:>8.1f}s {args['read_bytes'] / 1048576:>7.0f}mb "
+              f"{args['write_bytes'] / 1048576:>7.0f}mb {args.get('exit_status', ''):>4}  {name}")
+
+
+# Do not call this function directly
+# Get the cpu time of the builder process and all its children that were waited for
+def __get_rusage() -> float:
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+# Do not call this function directly
+def __read_io(pid: str) -> dict:
+    try:
+        with open(f"/proc/{pid}/io", "r") as file:
+            return {key: int(value) for key, value in (line.split(": ") for line in file.read().splitlines())}
+    except OSError:  # no io accounting in the kernel
+        return {}
+
+
+# Do not call this function directly
+def __redact(command: str) -> str:
+    for secret in _secrets:
+        command = command.replace(secret, "***")
+    return command
+
+
+if __name__ == "__main__":
+    print_error("Do not run this file directly. Instead, run main.py")